@@ -0,0 +1,117 @@
+################################################################
+# Benchmark the peak memory vs. step time trade-off of activation
+# checkpointing (`checkpoint_every`) for one training step
+# (forward + backward) of gRNAde models, as a function of the
+# RNA length, on synthetic backbones.
+#
+# Peak memory is the maximum allocated CUDA memory on GPU, and
+# the peak RSS on CPU; each configuration runs in a fresh
+# process, as peak RSS is only ever increasing within a process.
+#
+# Usage: python benchmarks/activation_checkpointing.py \
+#            --model ARv2 --lengths 500 1000 2000 --checkpoint_every 0 1 2
+################################################################
+
+import os
+import sys
+import time
+import resource
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.data.featurizer import RNAGraphFeaturizer
+from src.models import AutoregressiveMultiGNNv1, AutoregressiveMultiGNNv2, NonAutoregressiveMultiGNNv1
+
+
+MODELS = {
+    'ARv1': AutoregressiveMultiGNNv1,
+    'ARv2': AutoregressiveMultiGNNv2,
+    'NARv1': NonAutoregressiveMultiGNNv1,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Peak memory vs. step time of activation checkpointing')
+    parser.add_argument('--model', type=str, default='ARv2', help='Model type (ARv1/ARv2/NARv1)')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[500, 1000, 2000], help='RNA lengths')
+    parser.add_argument('--checkpoint_every', type=int, nargs='+', default=[0, 1, 2], help='Layers per checkpointed segment (0 disables checkpointing)')
+    parser.add_argument('--num_layers', type=int, default=4, help='Number of encoder/decoder layers')
+    parser.add_argument('--num_conformers', type=int, default=1, help='Number of conformers per backbone')
+    parser.add_argument('--n_steps', type=int, default=3, help='Number of timed training steps')
+    parser.add_argument('--device', type=str, default='cpu', help='Device (cpu/cuda)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    return parser.parse_args()
+
+
+def synthetic_backbone(length, num_conformers, generator):
+    """
+    Raw RNA data for random-walk backbones with 3 atoms per nucleotide.
+    """
+    steps = torch.randn(num_conformers, length, 1, 3, generator=generator)
+    centres = torch.cumsum(6.0 * steps / steps.norm(dim=-1, keepdim=True), dim=1)
+    coords = centres + torch.randn(num_conformers, length, 3, 3, generator=generator)
+    sequence = ''.join('AGCU'[i] for i in torch.randint(4, (length,), generator=generator).tolist())
+    return {'sequence': sequence, 'coords_list': list(coords), 'sec_struct_list': ['.' * length]}
+
+
+def peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+
+
+def run(args, length, checkpoint_every):
+    """
+    Returns the peak memory and the mean time of training steps.
+    """
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    featurizer = RNAGraphFeaturizer(split='train', top_k=32, max_num_conformers=args.num_conformers)
+    data = featurizer(synthetic_backbone(length, args.num_conformers, torch.Generator().manual_seed(args.seed)))
+    data = data.to(device)
+
+    model = MODELS[args.model](
+        node_in_dim=(15, 4), edge_in_dim=(131, 3), num_layers=args.num_layers,
+        checkpoint_every=checkpoint_every or None
+    ).to(device).train()
+    optimizer = torch.optim.Adam(model.parameters())
+    loss_fn = torch.nn.CrossEntropyLoss()
+
+    def step():
+        optimizer.zero_grad()
+        loss_fn(model(data), data.seq).backward()
+        optimizer.step()
+
+    # Warm-up step (optimizer state is allocated at the first step)
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(args.n_steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elapsed = (time.perf_counter() - start) / args.n_steps
+    return peak_memory_mb(device), elapsed
+
+
+def main(args):
+    context = multiprocessing.get_context('spawn')
+    print(f"{'length':>8} {'checkpoint_every':>16} {'peak memory (MB)':>17} {'step time (s)':>14}")
+    for length in args.lengths:
+        for checkpoint_every in args.checkpoint_every:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                peak, elapsed = executor.submit(run, args, length, checkpoint_every).result()
+            print(f"{length:>8} {checkpoint_every or '-':>16} {peak:>17.1f} {elapsed:>14.3f}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,108 @@
+################################################################
+# Benchmark the per-step cost of the beam search update used in
+# autoregressive sampling, as a function of the decoded position.
+#
+# Usage: python benchmarks/beam_search.py --num_nodes 1000
+################################################################
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.sampling import choose_nts, BeamSearch
+
+
+def legacy_step(i, seq, h_S, logits, scores, lgts, top_tokens, probs, W_s, beam_branch, num_nodes):
+    """
+    Beam update as previously implemented in `sample()`, which copies the
+    full sequence, embedding and logit buffers at every position.
+    """
+    new_beam_seq = seq.clone().repeat(beam_branch, 1)
+    new_beam_h_S = h_S.clone().repeat(beam_branch, 1, 1)
+    new_beam_logits = logits.clone().repeat(beam_branch, 1, 1)
+
+    top_log_probs_beam = probs.gather(dim=1, index=top_tokens).transpose(0, 1)
+    new_beam_scores = scores.repeat(beam_branch, 1) + top_log_probs_beam
+    new_beam_seq[:,i::num_nodes] = top_tokens.transpose(0,1)
+    new_beam_logits[:,i::num_nodes] = lgts
+    new_beam_h_S[:,i::num_nodes] = W_s(new_beam_seq[:,i::num_nodes])
+
+    sorted_scores, sorted_indices = torch.sort(new_beam_scores, dim=0, descending=True)
+    new_beam_seq[:,i::num_nodes] = torch.gather(new_beam_seq[:,i::num_nodes], dim=0, index=sorted_indices)
+    expanded_indices = sorted_indices.unsqueeze(-1).expand(-1, -1, new_beam_h_S[:, i::num_nodes].size(-1))
+    new_beam_h_S[:,i::num_nodes] = torch.gather(new_beam_h_S[:,i::num_nodes], dim=0, index=expanded_indices)
+    new_beam_logits[:,i::num_nodes] = torch.gather(new_beam_logits[:,i::num_nodes], dim=0, index=expanded_indices)
+
+    seq[i::num_nodes] = new_beam_seq[0,i::num_nodes]
+    logits[i::num_nodes] = new_beam_logits[0,i::num_nodes]
+    h_S[i::num_nodes] = new_beam_h_S[0,i::num_nodes]
+    return sorted_scores[0]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Per-step cost of the beam search update')
+    parser.add_argument('--num_nodes', type=int, default=1000, help='Number of positions to decode')
+    parser.add_argument('--n_samples', type=int, default=16, help='Number of samples')
+    parser.add_argument('--beam_width', type=int, default=2, help='Number of beams per sample')
+    parser.add_argument('--beam_branch', type=int, default=6, help='Number of candidate tokens per beam')
+    parser.add_argument('--n_buckets', type=int, default=5, help='Number of position buckets to report')
+    parser.add_argument('--out_dim', type=int, default=4, help='Number of token types')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def main(args):
+    torch.manual_seed(args.seed)
+    device = torch.device('cpu')
+    num_nodes, out_dim = args.num_nodes, args.out_dim
+    n_copies = args.beam_width * args.n_samples
+    W_s = torch.nn.Embedding(out_dim, out_dim)
+
+    # Legacy state: flat buffers over all copies and positions
+    seq = torch.zeros(n_copies * num_nodes, dtype=torch.int, device=device)
+    h_S = torch.zeros(n_copies * num_nodes, out_dim, device=device)
+    logits = torch.zeros(n_copies * num_nodes, out_dim, device=device)
+    scores = torch.zeros(n_copies, device=device)
+
+    # Back-pointer beam search state
+    beam = BeamSearch(args.n_samples, args.beam_width, args.beam_branch, num_nodes, out_dim, device)
+    h_S_beam = torch.zeros(n_copies * num_nodes, out_dim, device=device)
+
+    legacy_times, beam_times = [], []
+    for i in range(num_nodes):
+        lgts = torch.randn(n_copies, out_dim, device=device)
+        top_tokens, probs = choose_nts(lgts, beam_branch=args.beam_branch)
+
+        t0 = time.perf_counter()
+        scores = legacy_step(i, seq, h_S, logits, scores, lgts, top_tokens, probs,
+                             W_s, args.beam_branch, num_nodes)
+        legacy_times.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        tokens = beam.step(i, top_tokens, probs, lgts)
+        h_S_beam[i::num_nodes] = W_s(tokens)
+        beam_times.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    beam.finalize()
+    finalize_time = time.perf_counter() - t0
+
+    print(f"num_nodes={num_nodes} n_samples={args.n_samples} beam_width={args.beam_width} beam_branch={args.beam_branch}")
+    print(f"{'positions':>16} {'legacy (ms/step)':>18} {'beam (ms/step)':>16}")
+    bucket = max(num_nodes // args.n_buckets, 1)
+    for start in range(0, num_nodes, bucket):
+        end = min(start + bucket, num_nodes)
+        legacy_ms = 1000 * sum(legacy_times[start:end]) / (end - start)
+        beam_ms = 1000 * sum(beam_times[start:end]) / (end - start)
+        print(f"{f'{start}-{end-1}':>16} {legacy_ms:>18.4f} {beam_ms:>16.4f}")
+    print(f"Total: legacy {sum(legacy_times):.3f}s, beam {sum(beam_times):.3f}s (+ finalize {finalize_time:.3f}s)")
+
+
+if __name__ == "__main__":
+    main(parse_args())
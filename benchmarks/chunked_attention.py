@@ -0,0 +1,98 @@
+################################################################
+# Benchmark peak memory (RSS) and wall time of dense vs. chunked
+# attention in GraphAttentionLayer on CPU, as a function of the
+# sequence length, and check that both give the same outputs.
+#
+# Each configuration runs in a fresh process, as peak RSS is
+# only ever increasing within a process.
+#
+# Usage: python benchmarks/chunked_attention.py \
+#            --lengths 500 1000 2000 5000 --chunk_size 256
+################################################################
+
+import os
+import sys
+import time
+import resource
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.layers import GraphAttentionLayer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Peak RSS of dense vs. chunked attention')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[500, 1000, 2000, 5000], help='Sequence lengths')
+    parser.add_argument('--chunk_size', type=int, default=256, help='Tile size for chunked attention')
+    parser.add_argument('--node_h_dim', type=int, nargs=2, default=[128, 16], help='Node dimensions (scalar, vector)')
+    parser.add_argument('--n_heads', type=int, default=4, help='Number of attention heads')
+    parser.add_argument('--causal', action='store_true', help='Use causal attention (as in the decoder)')
+    parser.add_argument('--check_length', type=int, default=300, help='Sequence length for the parity check')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    return parser.parse_args()
+
+
+def make_layer(args, chunk_size):
+    torch.manual_seed(args.seed)
+    layer = GraphAttentionLayer(args.node_h_dim[0], args.node_h_dim[1], n_heads=args.n_heads, chunk_size=chunk_size)
+    return layer.eval()
+
+
+def make_inputs(args, length):
+    generator = torch.Generator().manual_seed(args.seed)
+    s = torch.randn(length, args.node_h_dim[0], generator=generator)
+    v = torch.randn(length, args.node_h_dim[1], 3, generator=generator)
+    return s, v
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+
+
+@torch.no_grad()
+def run(args, length, chunk_size):
+    """
+    Returns the peak RSS before and after one forward pass, and its wall time.
+    """
+    torch.set_num_threads(1)
+    layer = make_layer(args, chunk_size)
+    x = make_inputs(args, length)
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    layer(x, causal=args.causal)
+    elapsed = time.perf_counter() - start
+    return before, peak_rss_mb(), elapsed
+
+
+@torch.no_grad()
+def check(args):
+    """
+    Returns the maximum absolute difference between dense and chunked outputs.
+    """
+    x = make_inputs(args, args.check_length)
+    dense, _ = make_layer(args, None)(x, causal=args.causal)
+    chunked, _ = make_layer(args, args.chunk_size)(x, causal=args.causal)
+    return (dense - chunked).abs().max().item()
+
+
+def main(args):
+    print(f"Max abs. difference (length={args.check_length}): {check(args):.2e}")
+
+    context = multiprocessing.get_context('spawn')
+    print(f"{'length':>8} {'mode':>8} {'peak RSS (MB)':>14} {'attention (MB)':>15} {'time (s)':>9}")
+    for length in args.lengths:
+        for mode, chunk_size in (('dense', None), ('chunked', args.chunk_size)):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                before, after, elapsed = executor.submit(run, args, length, chunk_size).result()
+            print(f"{length:>8} {mode:>8} {after:>14.1f} {after - before:>15.1f} {elapsed:>9.3f}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,126 @@
+################################################################
+# Export the encoder and single-step decoder of gRNAde (ARv2)
+# to TorchScript and ONNX, and validate the exported graphs
+# against eager outputs on the demo PDBs: pooled encoder
+# features vs. `model.encode`, and teacher-forced logits
+# decoded one position at a time vs. `model.decode`. Graphs
+# are exported for the first PDB and run on all of them, which
+# also checks that shapes are not baked in at export time.
+# ONNX graphs are only run if onnxruntime is installed.
+# Exits with a non-zero status if outputs differ beyond the
+# tolerance.
+#
+# Usage: python benchmarks/export_validation.py \
+#            --out_dir ./exported/ --model_split das
+################################################################
+
+import os
+import sys
+import glob
+import time
+import argparse
+
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from gRNAde import gRNAde
+from src.constants import PROJECT_PATH
+from src.export import (
+    EncoderExport, DecoderStepExport, export_torchscript, export_onnx, teacher_forced_decode
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='TorchScript/ONNX export of gRNAde and validation against eager outputs')
+    parser.add_argument('--pdb_dir', type=str, default=os.path.join(PROJECT_PATH, 'tutorial/demo_data'), help='Directory of PDB files')
+    parser.add_argument('--out_dir', type=str, default='./exported/', help='Directory to save exported graphs to')
+    parser.add_argument('--model_split', type=str, default='das', help='Data split used to train the model checkpoint')
+    parser.add_argument('--max_num_conformers', type=int, default=1, help='Number of conformers (fixed in exported graphs)')
+    parser.add_argument('--opset_version', type=int, default=17, help='ONNX opset version')
+    parser.add_argument('--tol', type=float, default=1e-3, help='Tolerance on the maximum absolute difference of outputs')
+    return parser.parse_args()
+
+
+class OnnxStep(object):
+    """
+    Runs an exported ONNX graph with onnxruntime on `torch.Tensor` inputs.
+    """
+    def __init__(self, path, input_names):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.input_names = input_names
+
+    def __call__(self, *inputs):
+        outputs = self.session.run(None, {
+            name: x.cpu().numpy() for name, x in zip(self.input_names, inputs)
+        })
+        return tuple(torch.from_numpy(x) for x in outputs)
+
+
+def max_diff(outputs, reference):
+    return max(float((x - y).abs().max()) for x, y in zip(outputs, reference))
+
+
+@torch.no_grad()
+def main(args):
+    os.makedirs(args.out_dir, exist_ok=True)
+    g = gRNAde(split=args.model_split, max_num_conformers=args.max_num_conformers, model_type='ARv2')
+    # Exported graphs are validated on CPU
+    model = g.model.cpu().eval()
+    encoder, decoder_step = EncoderExport(model), DecoderStepExport(model)
+
+    pdb_filepaths = sorted(glob.glob(os.path.join(args.pdb_dir, '*.pdb')))
+    examples = [g.featurizer.featurize_from_pdb_file(pdb_filepath)[0].cpu() for pdb_filepath in pdb_filepaths]
+
+    # Export for the first backbone (decoder step at its middle position)
+    data = examples[0]
+    encoder_inputs = EncoderExport.example_inputs(data)
+    h_V_s, h_V_v, h_E_s, h_E_v = encoder(*encoder_inputs)
+    step_inputs = DecoderStepExport.example_inputs(
+        model, (h_V_s, h_V_v), (h_E_s, h_E_v), data.edge_index, data.seq, data.num_nodes // 2)
+
+    runtimes = {}
+    paths = {name: os.path.join(args.out_dir, name) for name in (
+        'encoder.pt', 'decoder_step.pt', 'encoder.onnx', 'decoder_step.onnx')}
+    runtimes['torchscript'] = (
+        export_torchscript(encoder, encoder_inputs, paths['encoder.pt']),
+        export_torchscript(decoder_step, step_inputs, paths['decoder_step.pt']),
+    )
+    export_onnx(encoder, encoder_inputs, paths['encoder.onnx'], args.opset_version)
+    export_onnx(decoder_step, step_inputs, paths['decoder_step.onnx'], args.opset_version)
+    print(f"Exported to {args.out_dir}")
+    try:
+        runtimes['onnx'] = (
+            OnnxStep(paths['encoder.onnx'], EncoderExport.INPUT_NAMES),
+            OnnxStep(paths['decoder_step.onnx'], DecoderStepExport.INPUT_NAMES),
+        )
+    except ImportError:
+        print("onnxruntime is not installed, skipping validation of ONNX graphs")
+
+    passed = True
+    print(f"\n{'pdb':>20} {'length':>6} {'runtime':>11} {'encoder diff':>12} {'logits diff':>11} {'time (s)':>9}")
+    for pdb_filepath, data in zip(pdb_filepaths, examples):
+        name = os.path.basename(pdb_filepath).split('.')[0]
+        # Eager reference: pooled encoder features and teacher-forced logits
+        h_V, h_E = model.encode(data)
+        logits = model.decode(h_V, h_E, data.edge_index, data.seq)
+
+        for runtime, (encoder_, decoder_step_) in runtimes.items():
+            start = time.perf_counter()
+            h_V_s, h_V_v, h_E_s, h_E_v = encoder_(*EncoderExport.example_inputs(data))
+            logits_ = teacher_forced_decode(
+                decoder_step_, model, (h_V_s, h_V_v), (h_E_s, h_E_v), data.edge_index, data.seq)
+            elapsed = time.perf_counter() - start
+
+            encoder_diff = max_diff((h_V_s, h_V_v, h_E_s, h_E_v), (*h_V, *h_E))
+            logits_diff = max_diff((logits_,), (logits,))
+            passed = passed and encoder_diff <= args.tol and logits_diff <= args.tol
+            print(f"{name:>20} {data.num_nodes:>6} {runtime:>11} {encoder_diff:>12.2e} {logits_diff:>11.2e} {elapsed:>9.3f}")
+
+    print("PASSED" if passed else "FAILED")
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
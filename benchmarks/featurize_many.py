@@ -0,0 +1,65 @@
+################################################################
+# Benchmark bulk featurization of PDB files with
+# `RNAGraphFeaturizer.featurize_many` (process pool) vs. one
+# file at a time with `featurize_from_pdb_file`, and check that
+# featurized graphs are returned in the order of the inputs.
+#
+# Usage: python benchmarks/featurize_many.py \
+#            --pdb_dir ./tutorial/demo_data/ --n_repeats 50 --n_workers 1 4 8
+################################################################
+
+import os
+import sys
+import glob
+import time
+import argparse
+
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.data.featurizer import RNAGraphFeaturizer
+from src.constants import PROJECT_PATH
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Bulk featurization of PDB files in a process pool')
+    parser.add_argument('--pdb_dir', type=str, default=os.path.join(PROJECT_PATH, 'tutorial/demo_data'), help='Directory of PDB files')
+    parser.add_argument('--n_repeats', type=int, default=50, help='Number of times each PDB file is featurized')
+    parser.add_argument('--n_workers', type=int, nargs='+', default=[1, 4, 8], help='Numbers of worker processes')
+    parser.add_argument('--max_nodes', type=int, default=None, help='Node budget per batch (one batch if not given)')
+    parser.add_argument('--top_k', type=int, default=32, help='Number of edges per node')
+    return parser.parse_args()
+
+
+def main(args):
+    featurizer = RNAGraphFeaturizer(split='test', top_k=args.top_k, max_num_conformers=1)
+    pdb_filepaths = sorted(glob.glob(os.path.join(args.pdb_dir, '*.pdb'))) * args.n_repeats
+
+    start = time.perf_counter()
+    reference = [featurizer.featurize_from_pdb_file(pdb_filepath)[0] for pdb_filepath in pdb_filepaths]
+    serial = time.perf_counter() - start
+    print(f"{len(pdb_filepaths)} PDB files, {sum(data.num_nodes for data in reference)} nodes")
+    print(f"{'n_workers':>9} {'time (s)':>9} {'speedup':>8} {'batches':>8}")
+    print(f"{'serial':>9} {serial:>9.2f} {1.0:>7.2f}x {'-':>8}")
+
+    passed = True
+    for n_workers in args.n_workers:
+        start = time.perf_counter()
+        batches = featurizer.featurize_many(pdb_filepaths, n_workers=n_workers, max_nodes=args.max_nodes)
+        batches = [batches] if args.max_nodes is None else list(batches)
+        elapsed = time.perf_counter() - start
+
+        data_list = [data for batch in batches for data in batch.to_data_list()]
+        passed = passed and len(data_list) == len(reference) and all(
+            torch.equal(data.seq, ref.seq) and torch.equal(data.edge_index, ref.edge_index)
+            for data, ref in zip(data_list, reference)
+        )
+        print(f"{n_workers:>9} {elapsed:>9.2f} {serial / elapsed:>7.2f}x {len(batches):>8}")
+
+    print("PASSED" if passed else "FAILED")
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
@@ -0,0 +1,92 @@
+################################################################
+# Check that sampling in mixed precision (bf16/fp16 autocast)
+# matches fp32 on the demo PDBs, in terms of the perplexity of
+# the native sequence and the recovery and perplexity of the
+# designed sequences. Exits with a non-zero status if the mean
+# differences exceed the tolerances.
+#
+# Usage: python benchmarks/mixed_precision_parity.py \
+#            --precision bf16 --model_type ARv2
+################################################################
+
+import os
+import sys
+import glob
+import time
+import argparse
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from gRNAde import gRNAde, set_seed
+from src.precision import autocast
+from src.constants import PROJECT_PATH
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Parity of mixed precision vs. fp32 sampling')
+    parser.add_argument('--pdb_dir', type=str, default=os.path.join(PROJECT_PATH, 'tutorial/demo_data'), help='Directory of PDB files')
+    parser.add_argument('--precision', type=str, default='bf16', help='Reduced precision to compare against fp32 (bf16/fp16)')
+    parser.add_argument('--model_type', type=str, default='ARv2', help='Model type (ARv1/ARv2/NARv1)')
+    parser.add_argument('--gpu_id', type=int, default=0, help='GPU ID (cpu if no GPU is available)')
+    parser.add_argument('--n_samples', type=int, default=16, help='Number of samples per backbone')
+    parser.add_argument('--temperature', type=float, default=0.1, help='Sampling temperature')
+    parser.add_argument('--perplexity_tol', type=float, default=0.05, help='Tolerance on the mean relative difference of perplexities')
+    parser.add_argument('--recovery_tol', type=float, default=0.02, help='Tolerance on the mean absolute difference of recoveries')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def run(g, raw_data, featurized_data, args):
+    """
+    Returns the perplexity of the native sequence, and the mean recovery
+    and perplexity of designed sequences, at the current precision of `g`.
+    """
+    native_perplexity = float(g.perplexity(raw_data['sequence'], raw_data, featurized_data, seed=args.seed))
+
+    set_seed(args.seed)
+    data = featurized_data.to(g.device)
+    start = time.perf_counter()
+    with autocast(g.device, g.precision):
+        samples, logits = g.model.sample(data, args.n_samples, args.temperature, return_logits=True)
+    elapsed = time.perf_counter() - start
+    perplexity, recovery = g._perplexity_and_recovery(data, samples, logits)
+    return native_perplexity, float(np.mean(recovery)), float(np.mean(perplexity)), elapsed
+
+
+def main(args):
+    g = gRNAde(model_type=args.model_type, gpu_id=args.gpu_id)
+
+    rows = []
+    print(f"{'pdb':>20} {'precision':>9} {'native perp.':>12} {'recovery':>9} {'perplexity':>10} {'time (s)':>9}")
+    for pdb_filepath in sorted(glob.glob(os.path.join(args.pdb_dir, '*.pdb'))):
+        featurized_data, raw_data = g.featurizer.featurize_from_pdb_file(pdb_filepath)
+        name = os.path.basename(pdb_filepath).split('.')[0]
+        results = {}
+        for precision in ('fp32', args.precision):
+            g.precision = precision
+            results[precision] = run(g, raw_data, featurized_data, args)
+            native, rec, perp, elapsed = results[precision]
+            print(f"{name:>20} {precision:>9} {native:>12.4f} {rec:>9.4f} {perp:>10.4f} {elapsed:>9.3f}")
+        rows.append((results['fp32'], results[args.precision]))
+
+    fp32, reduced = (np.array(results) for results in zip(*rows))
+    native_diff = np.mean(np.abs(reduced[:, 0] - fp32[:, 0]) / fp32[:, 0])
+    recovery_diff = np.mean(np.abs(reduced[:, 1] - fp32[:, 1]))
+    perplexity_diff = np.mean(np.abs(reduced[:, 2] - fp32[:, 2]) / fp32[:, 2])
+    print(f"\nMean relative difference of native perplexity: {native_diff:.4f}")
+    print(f"Mean absolute difference of recovery: {recovery_diff:.4f}")
+    print(f"Mean relative difference of design perplexity: {perplexity_diff:.4f}")
+    print(f"Speedup of {args.precision}: {fp32[:, 3].sum() / reduced[:, 3].sum():.2f}x")
+
+    passed = native_diff <= args.perplexity_tol and perplexity_diff <= args.perplexity_tol \
+        and recovery_diff <= args.recovery_tol
+    print("PASSED" if passed else "FAILED")
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
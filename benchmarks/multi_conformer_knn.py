@@ -0,0 +1,76 @@
+################################################################
+# Benchmark the construction of the merged kNN graph of multi-
+# conformer RNA backbones: one kNN search per conformer followed
+# by `coalesce` and `to_undirected` (previous implementation) vs.
+# one batched kNN search over all conformers with a sort-based
+# union (`multi_conformer_knn_graph`), on synthetic backbones.
+# Also checks that both give the same edges, and that the edge
+# provenance matches the kNN graph of each conformer.
+#
+# Usage: python benchmarks/multi_conformer_knn.py \
+#            --lengths 100 500 2000 --num_conformers 1 3 5
+################################################################
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch_cluster
+from torch_geometric.utils import coalesce, to_undirected
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.data.featurizer import multi_conformer_knn_graph
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Merged kNN graph construction over conformers')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[100, 500, 2000], help='RNA lengths')
+    parser.add_argument('--num_conformers', type=int, nargs='+', default=[1, 3, 5], help='Numbers of conformers')
+    parser.add_argument('--top_k', type=int, default=32, help='Number of neighbours per node')
+    parser.add_argument('--n_repeats', type=int, default=20, help='Number of timed repeats')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    return parser.parse_args()
+
+
+def per_conformer_knn_graph(centroids, top_k):
+    edge_index = [torch_cluster.knn_graph(coord, top_k) for coord in centroids]
+    return to_undirected(coalesce(torch.concat(edge_index, dim=1)))
+
+
+def timed(fn, n_repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        out = fn()
+    return out, (time.perf_counter() - start) / n_repeats
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    print(f"{'length':>8} {'num_conf':>8} {'num_edges':>9} {'per-conformer (ms)':>18} {'batched (ms)':>12} {'speedup':>8}")
+    passed = True
+    for length in args.lengths:
+        for num_conf in args.num_conformers:
+            # Random-walk backbones (conformers are perturbations of the first)
+            centroids = torch.cumsum(torch.randn(1, length, 3), dim=1) * 3.0
+            centroids = centroids + torch.randn(num_conf, length, 3)
+
+            reference, t_ref = timed(lambda: per_conformer_knn_graph(centroids, args.top_k), args.n_repeats)
+            edge_index, t_new = timed(lambda: multi_conformer_knn_graph(centroids, args.top_k), args.n_repeats)
+            _, edge_confs = multi_conformer_knn_graph(centroids, args.top_k, return_edge_confs=True)
+
+            passed = passed and torch.equal(edge_index, reference)
+            for conf in range(num_conf):
+                conf_edges = per_conformer_knn_graph(centroids[conf:conf + 1], args.top_k)
+                passed = passed and torch.equal(edge_index[:, edge_confs[:, conf]], conf_edges)
+            print(f"{length:>8} {num_conf:>8} {edge_index.shape[1]:>9} {1e3 * t_ref:>18.2f} {1e3 * t_new:>12.2f} {t_ref / t_new:>7.2f}x")
+
+    print("PASSED" if passed else "FAILED")
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
@@ -0,0 +1,120 @@
+################################################################
+# Accuracy regression of dynamic INT8 quantization for CPU
+# inference: reports the recovery and perplexity deltas of the
+# quantized model vs. fp32 on a fixed test split (or on the demo
+# PDBs), along with the sampling speedup and the fraction of
+# linear layer weights that are quantized. Exits with a non-zero
+# status if the mean deltas exceed the tolerances.
+#
+# Usage: python benchmarks/quantization_regression.py \
+#            --data_path ./data/ --split das --max_structures 100
+################################################################
+
+import os
+import sys
+import glob
+import time
+import argparse
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from gRNAde import gRNAde, set_seed
+from src.constants import PROJECT_PATH
+from src.precision import quantized_fraction
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Accuracy regression of INT8 quantization vs. fp32')
+    parser.add_argument('--data_path', type=str, default=None, help='Directory with processed.pt and {split}_split.pt (demo PDBs if not given)')
+    parser.add_argument('--split', type=str, default='das', help='Data split whose test set is evaluated')
+    parser.add_argument('--pdb_dir', type=str, default=os.path.join(PROJECT_PATH, 'tutorial/demo_data'), help='Directory of PDB files, if no data_path')
+    parser.add_argument('--max_structures', type=int, default=None, help='Maximum number of test structures')
+    parser.add_argument('--model_type', type=str, default='ARv2', help='Model type (ARv1/ARv2/NARv1)')
+    parser.add_argument('--model_split', type=str, default='das', help='Data split used to train the model checkpoint')
+    parser.add_argument('--n_samples', type=int, default=16, help='Number of samples per structure')
+    parser.add_argument('--temperature', type=float, default=0.1, help='Sampling temperature')
+    parser.add_argument('--n_threads', type=int, default=None, help='Number of CPU threads')
+    parser.add_argument('--perplexity_tol', type=float, default=0.05, help='Tolerance on the mean relative delta of perplexities')
+    parser.add_argument('--recovery_tol', type=float, default=0.02, help='Tolerance on the mean absolute delta of recoveries')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    return parser.parse_args()
+
+
+def load_test_set(g, args):
+    """
+    Returns the (raw_data, featurized_data) pairs of the test structures.
+    """
+    if args.data_path is not None:
+        data_list = list(torch.load(os.path.join(args.data_path, "processed.pt")).values())
+        _, _, test_idx_list = torch.load(os.path.join(args.data_path, f"{args.split}_split.pt"))
+        test_set = [g._prepare_data(data_list[idx]) for idx in test_idx_list]
+    else:
+        test_set = [
+            g.featurizer.featurize_from_pdb_file(pdb_filepath)[::-1]
+            for pdb_filepath in sorted(glob.glob(os.path.join(args.pdb_dir, '*.pdb')))
+        ]
+    return test_set[:args.max_structures]
+
+
+@torch.no_grad()
+def run(g, raw_data, featurized_data, args):
+    """
+    Returns the perplexity of the native sequence, the mean recovery and
+    perplexity of designed sequences, and the sampling time.
+    """
+    native_perplexity = float(g.perplexity(raw_data['sequence'], raw_data, featurized_data, seed=args.seed))
+
+    set_seed(args.seed)
+    start = time.perf_counter()
+    samples, logits = g.model.sample(featurized_data, args.n_samples, args.temperature, return_logits=True)
+    elapsed = time.perf_counter() - start
+    perplexity, recovery = g._perplexity_and_recovery(featurized_data, samples, logits)
+    return native_perplexity, float(np.mean(recovery)), float(np.mean(perplexity)), elapsed
+
+
+def main(args):
+    if args.n_threads is not None:
+        torch.set_num_threads(args.n_threads)
+
+    models = {
+        'fp32': gRNAde(split=args.model_split, model_type=args.model_type),
+        'int8': gRNAde(split=args.model_split, model_type=args.model_type, quantize=True),
+    }
+    # Compare against fp32 on CPU as well (quantized models always run on CPU)
+    models['fp32'].device = torch.device('cpu')
+    models['fp32'].model.cpu()
+    test_set = load_test_set(models['fp32'], args)
+    print(f"Quantized fraction of linear layer weights: {quantized_fraction(models['int8'].model):.4f}")
+
+    rows = []
+    print(f"{'idx':>5} {'length':>6} {'model':>5} {'native perp.':>12} {'recovery':>9} {'perplexity':>10} {'time (s)':>9}")
+    for idx, (raw_data, featurized_data) in enumerate(test_set):
+        featurized_data = featurized_data.cpu()
+        results = {}
+        for name, g in models.items():
+            results[name] = run(g, raw_data, featurized_data, args)
+            native, rec, perp, elapsed = results[name]
+            print(f"{idx:>5} {featurized_data.num_nodes:>6} {name:>5} {native:>12.4f} {rec:>9.4f} {perp:>10.4f} {elapsed:>9.3f}")
+        rows.append((results['fp32'], results['int8']))
+
+    fp32, int8 = (np.array(results) for results in zip(*rows))
+    native_delta = np.mean((int8[:, 0] - fp32[:, 0]) / fp32[:, 0])
+    recovery_delta = np.mean(int8[:, 1] - fp32[:, 1])
+    perplexity_delta = np.mean((int8[:, 2] - fp32[:, 2]) / fp32[:, 2])
+    print(f"\nStructures: {len(rows)}")
+    print(f"Recovery: fp32 {fp32[:, 1].mean():.4f}, int8 {int8[:, 1].mean():.4f} (mean delta {recovery_delta:+.4f})")
+    print(f"Design perplexity: fp32 {fp32[:, 2].mean():.4f}, int8 {int8[:, 2].mean():.4f} (mean relative delta {perplexity_delta:+.4f})")
+    print(f"Native perplexity: fp32 {fp32[:, 0].mean():.4f}, int8 {int8[:, 0].mean():.4f} (mean relative delta {native_delta:+.4f})")
+    print(f"Sampling speedup of int8: {fp32[:, 3].sum() / int8[:, 3].sum():.2f}x")
+
+    passed = abs(recovery_delta) <= args.recovery_tol \
+        and abs(perplexity_delta) <= args.perplexity_tol and abs(native_delta) <= args.perplexity_tol
+    print("PASSED" if passed else "FAILED")
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
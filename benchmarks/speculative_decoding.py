@@ -0,0 +1,106 @@
+################################################################
+# Benchmark speculative decoding with a non-autoregressive draft
+# model against plain autoregressive sampling on the demo PDBs,
+# reporting the draft acceptance rate and the speedup.
+#
+# Usage: python benchmarks/speculative_decoding.py \
+#            --model_type ARv2 --draft_checkpoint checkpoints/<NARv1>.h5
+################################################################
+
+import os
+import sys
+import glob
+import time
+import argparse
+
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from gRNAde import (
+    gRNAde, set_seed,
+    NODE_IN_DIM, NODE_H_DIM, EDGE_IN_DIM, EDGE_H_DIM, NUM_LAYERS, DROP_RATE, OUT_DIM
+)
+from src.models import NonAutoregressiveMultiGNNv1
+from src.sampling import speculative_sample
+from src.constants import PROJECT_PATH
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Speculative decoding vs autoregressive sampling')
+    parser.add_argument('--model_type', type=str, default='ARv2', choices=['ARv1', 'ARv2'], help='Autoregressive model to sample from')
+    parser.add_argument('--split', type=str, default='das', help='Data split of the autoregressive checkpoint')
+    parser.add_argument('--draft_checkpoint', type=str, required=True, help='Checkpoint of the NARv1 draft model')
+    parser.add_argument('--pdb_dir', type=str, default=os.path.join(PROJECT_PATH, 'tutorial/demo_data'), help='Directory of PDB files')
+    parser.add_argument('--n_samples', type=int, default=16, help='Number of samples per backbone')
+    parser.add_argument('--temperature', type=float, default=0.5, help='Sampling temperature')
+    parser.add_argument('--draft_temperature', type=float, default=None, help='Temperature of the draft model')
+    parser.add_argument('--sampling_strategy', type=str, default='categorical', help='Sampling strategy')
+    parser.add_argument('--sampling_value', type=float, default=0.0, help='Value for sampling strategy')
+    parser.add_argument('--n_repeats', type=int, default=3, help='Number of timed repeats per backbone')
+    parser.add_argument('--gpu_id', type=int, default=0, help='GPU ID')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    return parser.parse_args()
+
+
+def timed(fn, device, n_repeats):
+    """
+    Returns the output of the last call and the mean wall time of `fn()`.
+    """
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        out = fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+    return out, (time.perf_counter() - start) / n_repeats
+
+
+@torch.no_grad()
+def main(args):
+    module = gRNAde(split=args.split, max_num_conformers=1, gpu_id=args.gpu_id, model_type=args.model_type)
+    model, device = module.model, module.device
+
+    draft_model = NonAutoregressiveMultiGNNv1(
+        node_in_dim=NODE_IN_DIM, node_h_dim=NODE_H_DIM,
+        edge_in_dim=EDGE_IN_DIM, edge_h_dim=EDGE_H_DIM,
+        num_layers=NUM_LAYERS, drop_rate=DROP_RATE, out_dim=OUT_DIM
+    )
+    draft_model.load_state_dict(torch.load(args.draft_checkpoint, map_location=torch.device('cpu')))
+    draft_model = draft_model.to(device)
+    draft_model.eval()
+
+    print(f"{'pdb':>20} {'n_nodes':>8} {'accept rate':>12} {'passes':>7} {'AR (s)':>8} {'spec (s)':>9} {'speedup':>8}")
+    total_ar, total_spec, total_proposed, total_accepted = 0.0, 0.0, 0, 0
+    for pdb_filepath in sorted(glob.glob(os.path.join(args.pdb_dir, '*.pdb'))):
+        data, _ = module.featurizer.featurize_from_pdb_file(pdb_filepath)
+        data = data.to(device)
+
+        set_seed(args.seed)
+        _, ar_time = timed(lambda: model.sample(
+            data, args.n_samples, args.temperature,
+            beam_width=1, beam_branch=1, temperature_factor=0.0,
+            sampling_strategy=args.sampling_strategy, sampling_value=args.sampling_value
+        ), device, args.n_repeats)
+
+        set_seed(args.seed)
+        (_, stats), spec_time = timed(lambda: speculative_sample(
+            model, draft_model, data, args.n_samples, args.temperature,
+            draft_temperature=args.draft_temperature,
+            sampling_strategy=args.sampling_strategy, sampling_value=args.sampling_value,
+            return_stats=True
+        ), device, args.n_repeats)
+
+        accept_rate = stats['n_accepted'] / max(stats['n_proposed'], 1)
+        print(f"{os.path.basename(pdb_filepath):>20} {data.num_nodes:>8} {accept_rate:>12.3f} {stats['n_passes']:>7} "
+              f"{ar_time:>8.3f} {spec_time:>9.3f} {ar_time / spec_time:>7.2f}x")
+        total_ar += ar_time
+        total_spec += spec_time
+        total_proposed += stats['n_proposed']
+        total_accepted += stats['n_accepted']
+
+    print(f"Overall: acceptance rate {total_accepted / max(total_proposed, 1):.3f}, "
+          f"AR {total_ar:.3f}s, speculative {total_spec:.3f}s, speedup {total_ar / total_spec:.2f}x")
+
+
+if __name__ == "__main__":
+    main(parse_args())
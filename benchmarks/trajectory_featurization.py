@@ -0,0 +1,111 @@
+################################################################
+# Benchmark featurization of an MD trajectory of an RNA: one PDB
+# file per frame with `featurize_from_pdb_filelist` (previous
+# multi-state design input) vs. reading the trajectory directly
+# with `featurize_from_trajectory`, on a synthetic trajectory of
+# a demo PDB (random perturbations of all atoms per frame).
+# Also checks that backbone coordinates read from the trajectory
+# match those parsed from the PDB files, up to centering, and
+# that clustering selects the requested number of frames.
+#
+# Usage: python benchmarks/trajectory_featurization.py \
+#            --n_frames 100 1000 --stride 10 --n_clusters 5
+################################################################
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+
+import numpy as np
+import torch
+import MDAnalysis as mda
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.data.featurizer import RNAGraphFeaturizer
+from src.data.data_utils import pdb_to_tensor, get_backbone_coords, trajectory_to_tensor
+from src.constants import PROJECT_PATH, FILL_VALUE
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Featurization of MD trajectories vs. one PDB file per frame')
+    parser.add_argument('--pdb_filepath', type=str, default=os.path.join(PROJECT_PATH, 'tutorial/demo_data/1ET4_1_A.pdb'), help='PDB file used as topology')
+    parser.add_argument('--n_frames', type=int, nargs='+', default=[100, 1000], help='Numbers of frames of the synthetic trajectory')
+    parser.add_argument('--stride', type=int, default=10, help='Read every stride-th frame')
+    parser.add_argument('--n_clusters', type=int, default=5, help='Number of clusters of frames')
+    parser.add_argument('--max_pdb_frames', type=int, default=100, help='Maximum number of frames written as PDB files')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    return parser.parse_args()
+
+
+def write_trajectory(universe, n_frames, out_dir, max_pdb_frames, generator):
+    """
+    Writes a synthetic trajectory as an XTC file, and its first
+    `max_pdb_frames` frames as one PDB file each.
+    """
+    reference = universe.atoms.positions.copy()
+    trajectory_filepath = os.path.join(out_dir, f'traj_{n_frames}.xtc')
+    pdb_filelist = []
+    with mda.Writer(trajectory_filepath, universe.atoms.n_atoms) as writer:
+        for frame in range(n_frames):
+            universe.atoms.positions = reference + generator.normal(scale=0.5, size=reference.shape)
+            writer.write(universe.atoms)
+            if frame < max_pdb_frames:
+                pdb_filelist.append(os.path.join(out_dir, f'frame_{n_frames}_{frame}.pdb'))
+                universe.atoms.write(pdb_filelist[-1])
+    universe.atoms.positions = reference
+    return trajectory_filepath, pdb_filelist
+
+
+def centered(coords):
+    mask = (coords != FILL_VALUE).all(dim=-1)
+    return torch.where(mask[..., None], coords - coords[mask].mean(dim=0), coords)
+
+
+def main(args):
+    featurizer = RNAGraphFeaturizer(split='test', top_k=32, max_num_conformers=5)
+    universe = mda.Universe(args.pdb_filepath)
+    generator = np.random.default_rng(args.seed)
+
+    # Topology alone: same sequence and backbone as parsing the PDB file
+    sequence, coords = pdb_to_tensor(args.pdb_filepath, return_sec_struct=False, return_sasa=False)[:2]
+    coords = get_backbone_coords(coords, sequence)
+    sequence_, coords_ = trajectory_to_tensor(args.pdb_filepath)
+    passed = sequence_ == sequence and torch.allclose(centered(coords_[0]), centered(coords), atol=1e-3)
+
+    print(f"{'n_frames':>8} {'pdb files (s/frame)':>19} {'trajectory (s/frame)':>20} {'speedup':>8} {'stride':>7} {'clusters':>8}")
+    with tempfile.TemporaryDirectory() as out_dir:
+        for n_frames in args.n_frames:
+            trajectory_filepath, pdb_filelist = write_trajectory(
+                universe, n_frames, out_dir, args.max_pdb_frames, generator)
+
+            start = time.perf_counter()
+            _, rna = featurizer.featurize_from_pdb_filelist(pdb_filelist)
+            t_pdb = (time.perf_counter() - start) / len(pdb_filelist)
+
+            start = time.perf_counter()
+            _, rna_ = featurizer.featurize_from_trajectory(args.pdb_filepath, trajectory_filepath)
+            t_traj = (time.perf_counter() - start) / n_frames
+
+            passed = passed and len(rna_['coords_list']) == n_frames and all(
+                torch.allclose(centered(x_), centered(x), atol=1e-2)  # XTC precision
+                for x_, x in zip(rna_['coords_list'], rna['coords_list'])
+            )
+
+            _, rna_stride = featurizer.featurize_from_trajectory(
+                args.pdb_filepath, trajectory_filepath, stride=args.stride)
+            _, rna_clusters = featurizer.featurize_from_trajectory(
+                args.pdb_filepath, trajectory_filepath, stride=args.stride, n_clusters=args.n_clusters)
+            n_stride, n_clusters = len(rna_stride['coords_list']), len(rna_clusters['coords_list'])
+            passed = passed and n_stride == len(range(0, n_frames, args.stride)) \
+                and 0 < n_clusters <= min(args.n_clusters, n_stride)
+            print(f"{n_frames:>8} {t_pdb:>19.4f} {t_traj:>20.4f} {t_pdb / t_traj:>7.2f}x {n_stride:>7} {n_clusters:>8}")
+
+    print("PASSED" if passed else "FAILED")
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
@@ -0,0 +1,73 @@
+################################################################
+# Shared fixtures of the tests: a demo RNA backbone, its
+# featurized graph, and gRNAde models with random weights
+# (tests do not depend on released checkpoints).
+################################################################
+
+import os
+
+import pytest
+import torch
+
+from src.constants import PROJECT_PATH
+from src.data.data_utils import pdb_to_tensor, get_backbone_coords
+
+DEMO_PDB_FILEPATH = os.path.join(PROJECT_PATH, "tutorial/demo_data/1ET4_1_A.pdb")
+
+
+def demo_rna(pdb_filepath=DEMO_PDB_FILEPATH):
+    """
+    Raw RNA data dictionary of a demo PDB file, with a dummy
+    secondary structure (no external tool is needed).
+    """
+    sequence, coords = pdb_to_tensor(pdb_filepath, return_sec_struct=False, return_sasa=False)[:2]
+    return {
+        'sequence': sequence,
+        'coords_list': [get_backbone_coords(coords, sequence)],
+        'sec_struct_list': ['.' * len(sequence)],
+    }
+
+
+def grnade_featurizer(**kwargs):
+    """
+    Featurizer with the hyperparameters of the gRNAde API.
+    """
+    import gRNAde as api
+    from src.data.featurizer import RNAGraphFeaturizer
+    params = dict(
+        split='test', radius=api.RADIUS, top_k=api.TOP_K, num_rbf=api.NUM_RBF,
+        num_posenc=api.NUM_POSENC, max_num_conformers=1, noise_scale=api.NOISE_SCALE,
+    )
+    params.update(kwargs)
+    return RNAGraphFeaturizer(**params)
+
+
+def grnade_designer(model_type="ARv2", seed=0, **model_kwargs):
+    """
+    `gRNAde` instance on CPU with a randomly initialised model,
+    bypassing checkpoint loading.
+    """
+    import gRNAde as api
+    torch.manual_seed(seed)
+    designer = api.gRNAde.__new__(api.gRNAde)
+    designer.version = api.VERSION
+    designer.select_model(model_type, **model_kwargs)
+    designer.split = "das"
+    designer.max_num_conformers = 1
+    designer.device = torch.device("cpu")
+    designer.precision = "fp32"
+    designer.featurizer = grnade_featurizer()
+    designer.model_path = None
+    designer.model.eval()
+    designer.encoder_cache = None
+    return designer
+
+
+@pytest.fixture(scope="session")
+def rna():
+    return demo_rna()
+
+
+@pytest.fixture(scope="session")
+def featurized_rna(rna):
+    return grnade_featurizer()(rna)
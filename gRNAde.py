@@ -3,8 +3,11 @@ dotenv.load_dotenv(".env")
 
 import os
 import random
+import hashlib
 import argparse
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 import yaml
 
@@ -19,6 +22,8 @@ from Bio.SeqRecord import SeqRecord
 from src.data.featurizer import RNAGraphFeaturizer
 from src.models import AutoregressiveMultiGNNv1, AutoregressiveMultiGNNv2, NonAutoregressiveMultiGNNv1
 from src.data.data_utils import get_backbone_coords
+from src.precision import autocast, quantize_linear_layers
+from src.sampling import chunk_params
 from src.evaluator import edit_distance, self_consistency_score_eternafold
 from src.constants import (
     NUM_TO_LETTER, 
@@ -90,6 +95,63 @@ MAX_TEMPERATURE = 0.5
 TEMPERATURE_FACTOR = 0.01
 MODEL_TYPE = "ARv2"
 
+class EncoderCache(object):
+    """
+    LRU cache of pooled encoder outputs for featurized RNA backbones.
+
+    Entries are keyed by a content hash of the featurized graph and the
+    model checkpoint, so that repeated design calls on the same backbone 
+    (e.g. sweeping temperatures, seeds, partial sequences or avoid lists) 
+    only run the decoder. Once `max_size` entries are stored, the least 
+    recently used entry is evicted.
+
+    Args:
+        max_size (int): maximum number of backbones to cache
+        checkpoint (str): model checkpoint the cached outputs come from
+    """
+    # Featurized graph attributes the encoder outputs depend on
+    KEYS = ('node_s', 'node_v', 'edge_s', 'edge_v', 'edge_posenc', 'edge_index', 'mask_confs')
+
+    def __init__(self, max_size, checkpoint):
+        self.max_size = max_size
+        self.checkpoint = checkpoint
+        self.entries = OrderedDict()
+
+    def key(self, data):
+        """
+        Content hash of a featurized graph (`torch_geometric.data.Data`).
+        Attributes missing from the graph (e.g. `edge_posenc` for graphs 
+        featurized by older versions) are skipped.
+        """
+        h = hashlib.sha256(str(self.checkpoint).encode())
+        for attr in self.KEYS:
+            tensor = getattr(data, attr, None)
+            if tensor is None:
+                continue
+            tensor = tensor.detach().cpu()
+            h.update(f"{attr}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+            h.update(tensor.contiguous().numpy().tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
 class gRNAde(object):
     """
     gRNAde: a Geometric Deep Learning pipeline for 3D RNA Inverse Design.
@@ -102,6 +164,19 @@ class gRNAde(object):
         split (str): data split used to train the model (all/das/multi)
         max_num_conformers (int): maximum number of conformers for an input RNA backbone
         gpu_id (int): GPU ID to use for inference (defaults to cpu if no GPU is available)
+        encoder_cache_size (int): maximum number of backbones for which to cache 
+            encoder outputs across design calls (autoregressive models only);
+            0 disables the cache
+        attention_chunk_size (int): tile size for memory-efficient chunked 
+            attention over long RNAs (ARv2 only); None uses dense attention
+        attention_mode (str): 'dense' attention over all pairs of nodes, or 'edge'
+            attention over edges of the kNN graph only (ARv2 only)
+        precision (str): 'fp32', or 'bf16'/'fp16' to run the model in mixed 
+            precision via autocast (bf16 on CPU, fp16 or bf16 on GPU)
+        quantize (bool): whether to apply dynamic INT8 quantization to the 
+            linear layers for CPU inference (on CPU, even if a GPU is available);
+            the quantized checkpoint is cached in a user cache directory, see
+            `load_quantized_checkpoint`
     """
 
     def __init__(
@@ -110,6 +185,11 @@ class gRNAde(object):
             max_num_conformers: Optional[int] = 1,
             gpu_id: Optional[int] = 0,
             model_type: Optional[str] = "ARv2",
+            encoder_cache_size: Optional[int] = 0,
+            attention_chunk_size: Optional[int] = None,
+            attention_mode: Optional[str] = "dense",
+            precision: Optional[str] = "fp32",
+            quantize: Optional[bool] = False,
         ):
 
         # Set version
@@ -119,7 +199,7 @@ class gRNAde(object):
         # Set maximum number of conformers
         # Initialise model
         print(f"    Initialising GNN encoder-decoder model {model_type}")
-        self.select_model(model_type)
+        self.select_model(model_type, attention_chunk_size, attention_mode)
         
         if max_num_conformers > max(list(self.checkpoint[split].keys())):
             max_num_conformers = max(list(self.checkpoint[split].keys()))
@@ -127,10 +207,12 @@ class gRNAde(object):
         self.split = split
         self.max_num_conformers = max_num_conformers
         
-        # Set device (GPU/CPU)
-        device = torch.device("cuda:{}".format(gpu_id) if torch.cuda.is_available() else "cpu")
+        # Set device (GPU/CPU); quantized models run on CPU
+        device = torch.device("cuda:{}".format(gpu_id) if torch.cuda.is_available() and not quantize else "cpu")
         print(f"    Using device: {device}")
         self.device = device
+        print(f"    Using precision: {precision}")
+        self.precision = precision
 
         # Define data featurizer
         print(f"    Creating RNA graph featurizer for max_num_conformers={max_num_conformers}")
@@ -146,16 +228,24 @@ class gRNAde(object):
 
         # Load model checkpoint
         self.model_path = self.checkpoint[split][max_num_conformers]
-        print(f"    Loading model checkpoint: {self.model_path}")
-        self.model.load_state_dict(torch.load(self.model_path, map_location=torch.device('cpu')))
+        if quantize:
+            self.load_quantized_checkpoint()
+        else:
+            print(f"    Loading model checkpoint: {self.model_path}")
+            self.model.load_state_dict(torch.load(self.model_path, map_location=torch.device('cpu')))
 
         # Transfer model to device in eval mode
         self.model = self.model.to(device)
         self.model.eval()
 
+        # Cache of encoder outputs for repeated design calls (opt-in)
+        if encoder_cache_size > 0 and not hasattr(self.model, 'encode'):
+            raise ValueError(f"Model type {model_type} does not support encoder caching, set encoder_cache_size=0")
+        self.encoder_cache = EncoderCache(encoder_cache_size, self.model_path) if encoder_cache_size > 0 else None
+
         print(f"Finished initialising gRNAde v{self.version}\n")
 
-    def select_model(self, model_type):
+    def select_model(self, model_type, attention_chunk_size=None, attention_mode="dense"):
         model_params = {
                 "node_in_dim": NODE_IN_DIM,
                 "node_h_dim": NODE_H_DIM, 
@@ -176,7 +266,9 @@ class gRNAde(object):
             self.model = AutoregressiveMultiGNNv2(
                 **model_params,
                 attention_heads=ATTENTION_HEADS,
-                attention_dropout=ATTENTION_DROPOUT
+                attention_dropout=ATTENTION_DROPOUT,
+                attention_chunk_size=attention_chunk_size,
+                attention_mode=attention_mode
             )
             self.checkpoint = CHECKPOINT_PATH_GRNADEX
 
@@ -188,6 +280,49 @@ class gRNAde(object):
         else:
             raise ValueError(f"Invalid model type: {model_type}")
 
+    def load_quantized_checkpoint(self):
+        """
+        Replaces `self.model` by its dynamically INT8-quantized version. 
+
+        The quantized checkpoint is cached in a user cache directory 
+        (`$GRNADE_CACHE_DIR`, or `~/.cache/grnade`), under a name including 
+        the modification time of the fp32 checkpoint and the torch version, 
+        as the format of packed quantized weights may change across torch 
+        versions. If the cached checkpoint cannot be loaded or saved, the 
+        model is quantized in memory from the fp32 checkpoint.
+        """
+        cache_dir = os.environ.get("GRNADE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "grnade"))
+        name = os.path.splitext(os.path.basename(self.model_path))[0]
+        mtime = int(os.path.getmtime(self.model_path))
+        quantized_path = os.path.join(cache_dir, f"{name}_int8_{mtime}_torch{torch.__version__}.h5")
+
+        quantized_model = None
+        if os.path.exists(quantized_path):
+            print(f"    Loading quantized model checkpoint: {quantized_path}")
+            try:
+                quantized_model = quantize_linear_layers(self.model)
+                quantized_model.load_state_dict(torch.load(quantized_path, map_location=torch.device('cpu')))
+            except Exception as e:
+                print(f"    Failed to load quantized model checkpoint ({e}), quantizing in memory")
+                quantized_model = None
+
+        if quantized_model is None:
+            print(f"    Loading model checkpoint: {self.model_path}")
+            self.model.load_state_dict(torch.load(self.model_path, map_location=torch.device('cpu')))
+            quantized_model = quantize_linear_layers(self.model)
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                # Written atomically, in case of concurrent instances
+                tmp_path = f"{quantized_path}.{os.getpid()}.tmp"
+                torch.save(quantized_model.state_dict(), tmp_path)
+                os.replace(tmp_path, quantized_path)
+                print(f"    Cached quantized model checkpoint: {quantized_path}")
+            except OSError as e:
+                print(f"    Failed to cache quantized model checkpoint ({e})")
+
+        self.model = quantized_model
+        self.model_path = quantized_path
+
     def load_nullomers_from_file(self, nullomers_filepath: str):
         """
         Load nullomers from a file.
@@ -224,7 +359,9 @@ class gRNAde(object):
             pdb_filepath (str): filepath to PDB file
             output_filepath (str): filepath to write designed sequences to
             n_samples (int): number of samples to generate
-            temperature (float): temperature for sampling
+            temperature (float or list): temperature for sampling (per sample,
+                if a list; `sampling_strategy` and `sampling_value` can also be
+                lists, to sweep several sampling settings in one pass)
             partial_seq (str): partial sequence used to fix nucleotides in 
                 designed sequences, provided as a string of nucleotides 
                 and underscores (e.g. "AUG___") where letters are fixed 
@@ -288,7 +425,9 @@ class gRNAde(object):
             directory_filepath (str): filepath to directory of PDB files
             output_filepath (str): filepath to write designed sequences to
             n_samples (int): number of samples to generate
-            temperature (float): temperature for sampling
+            temperature (float or list): temperature for sampling (per sample,
+                if a list; `sampling_strategy` and `sampling_value` can also be
+                lists, to sweep several sampling settings in one pass)
             partial_seq (str): partial sequence used to fix nucleotides in 
                 designed sequences, provided as a string of nucleotides 
                 and underscores (e.g. "AUG___") where letters are fixed 
@@ -330,6 +469,92 @@ class gRNAde(object):
             avoid_sequences,
         )
 
+    def design_from_trajectory(
+            self,
+            topology_filepath: str,
+            trajectory_filepath: Optional[str] = None,
+            output_filepath: Optional[str] = None, 
+            nullomers_filepath: Optional[str] = None,
+            selection: Optional[str] = "nucleic",
+            stride: Optional[int] = 1,
+            n_clusters: Optional[int] = None,
+            sec_struct: Optional[str] = None,
+            n_samples: Optional[int] = DEFAULT_N_SAMPLES,
+            temperature: Optional[float] = DEFAULT_TEMPERATURE,
+            partial_seq: Optional[str] = None,
+            seed: Optional[int] = 0,
+            sampling_strategy: Optional[str] = SAMPLING_STRATEGY,
+            sampling_value: Optional[float] = SAMPLING_VALUE,
+            beam_width: Optional[int] = BEAM_WIDTH,
+            beam_branch: Optional[int] = BEAM_BRANCH,
+            max_temperature: Optional[float] = MAX_TEMPERATURE,
+            temperature_factor: Optional[float] = TEMPERATURE_FACTOR,
+            avoid_sequences: Optional[list] = None
+        ):
+        """
+        Design RNA sequences for an MD trajectory of an RNA molecule, i.e.
+        fixed backbone re-design given multiple conformations of the RNA
+        structure sampled from the trajectory.
+
+        Args:
+            topology_filepath (str): filepath to topology file
+            trajectory_filepath (str): filepath to trajectory file (frames
+                are read from the topology file if not provided)
+            output_filepath (str): filepath to write designed sequences to
+            selection (str): MDAnalysis selection of the RNA residues
+            stride (int): read every `stride`-th frame of the trajectory
+            n_clusters (int): number of clusters of frames to keep one
+                representative frame of (all frames are kept if not provided)
+            sec_struct (str): secondary structure in dotbracket notation
+                (computed from the topology if it is a PDB file)
+            n_samples (int): number of samples to generate
+            temperature (float or list): temperature for sampling (per sample,
+                if a list; `sampling_strategy` and `sampling_value` can also be
+                lists, to sweep several sampling settings in one pass)
+            partial_seq (str): partial sequence used to fix nucleotides in 
+                designed sequences, provided as a string of nucleotides 
+                and underscores (e.g. "AUG___") where letters are fixed 
+                and underscores represent designable positions.
+            seed (int): random seed for reproducibility
+            sampling_strategy (str): strategy for sampling ("min_p", "top_k", "top_p")
+            sampling_value (float): value for sampling strategy
+            beam_width (int): number of beams to maintain during search
+            beam_branch (int): number of samples to get from sampling strategy
+        Returns:
+            sequences (List[SeqRecord]): designed sequences in fasta format
+            samples (Tensor): designed sequences with shape `(n_samples, seq_len)`
+            perplexity (Tensor): perplexity per sample with shape `(n_samples, 1)`
+            recovery (Tensor): sequence recovery per sample with shape `(n_samples, 1)`
+            sc_score (Tensor): global self consistency score per sample with shape `(n_samples, 1)`
+        """
+        featurized_data, raw_data = self.featurizer.featurize_from_trajectory(
+            topology_filepath,
+            trajectory_filepath,
+            selection=selection,
+            stride=stride,
+            n_clusters=n_clusters,
+            sec_struct=sec_struct,
+        )
+        # load nullomers if provided
+        if nullomers_filepath is not None:
+            avoid_sequences = self.load_nullomers_from_file(nullomers_filepath)
+        return self.design(
+            raw_data,
+            featurized_data,
+            output_filepath,
+            n_samples,
+            temperature,
+            partial_seq,
+            seed,
+            sampling_strategy,
+            sampling_value,
+            beam_width,
+            beam_branch,
+            max_temperature,
+            temperature_factor,
+            avoid_sequences,
+        )
+
     @torch.no_grad()
     def design(
         self, 
@@ -361,7 +586,9 @@ class gRNAde(object):
             featurized_data (torch_geometric.data.Data): featurized RNA data
             output_filepath (str): filepath to write designed sequences to
             n_samples (int): number of samples to generate
-            temperature (float): temperature for sampling
+            temperature (float or list): temperature for sampling (per sample,
+                if a list; `sampling_strategy` and `sampling_value` can also be
+                lists, to sweep several sampling settings in one pass)
             partial_seq (str): partial sequence used to fix nucleotides in 
                 designed sequences, provided as a string of nucleotides 
                 and underscores (e.g. "AUG___") where letters are fixed 
@@ -382,6 +609,311 @@ class gRNAde(object):
         # set random seed
         set_seed(seed)
 
+        raw_data, featurized_data = self._prepare_data(raw_data, featurized_data)
+        logit_bias = self._partial_seq_to_logit_bias(partial_seq)
+        
+        print('Avoiding sequences:', avoid_sequences)
+        # sample n_samples from model for single data point: n_samples x seq_len
+        with autocast(self.device, self.precision):
+            samples, logits = self.model.sample(
+                featurized_data,
+                n_samples,
+                temperature,
+                logit_bias=logit_bias,
+                return_logits=True,
+                sampling_strategy=sampling_strategy,
+                sampling_value=sampling_value,
+                beam_width=beam_width,
+                beam_branch=beam_branch,
+                max_temperature=max_temperature,
+                temperature_factor=temperature_factor,
+                avoid_sequences=avoid_sequences,
+                **self._encoder_outputs([featurized_data])
+            )
+
+        return self._collate_designs(
+            raw_data, featurized_data, samples, logits, 
+            output_filepath, seed, temperature
+        )
+
+    @torch.no_grad()
+    def design_batch(
+        self, 
+        raw_data_list: list, 
+        featurized_data_list: Optional[list] = None, 
+        output_filepaths: Optional[list] = None, 
+        n_samples = DEFAULT_N_SAMPLES,
+        temperature: Optional[float] = DEFAULT_TEMPERATURE,
+        partial_seqs: Optional[list] = None,
+        seed: Optional[int] = 0,
+        sampling_strategy: Optional[str] = SAMPLING_STRATEGY,
+        sampling_value: Optional[float] = SAMPLING_VALUE,
+        beam_width: Optional[int] = BEAM_WIDTH,
+        beam_branch: Optional[int] = BEAM_BRANCH,
+        max_temperature: Optional[float] = MAX_TEMPERATURE,
+        temperature_factor: Optional[float] = TEMPERATURE_FACTOR,
+        avoid_sequences: Optional[list] = None,
+    ):
+        """
+        Design RNA sequences for several RNA backbones in one batched pass
+        of the model, see `design` for single backbones. 
+        
+        All backbones are collated into a `torch_geometric.data.Batch` and 
+        decoded together, so that the cost of sampling is shared across 
+        backbones. Note that designs are not identical to calling `design`
+        on each backbone with the same seed, as random numbers are drawn 
+        for all backbones jointly.
+
+        Args:
+            raw_data_list (List[dict]): raw RNA data dictionaries, see `design`
+            featurized_data_list (List[torch_geometric.data.Data]): featurized
+                RNA data for each backbone (featurized on the fly if None)
+            output_filepaths (List[str]): filepaths to write designed 
+                sequences to for each backbone
+            n_samples (int or List[int]): number of samples to generate
+                (per backbone, if a list)
+            temperature (float or list): temperature for sampling (per sample
+                over all backbones in order, if a list; as are 
+                `sampling_strategy` and `sampling_value`)
+            partial_seqs (List[str]): partial sequences used to fix nucleotides 
+                in designed sequences for each backbone (or None), see `design`
+            seed (int): random seed for reproducibility
+            sampling_strategy (str): strategy for sampling ("min_p", "top_k", "top_p")
+            sampling_value (float): value for sampling strategy
+            beam_width (int): number of beams to maintain during search
+            beam_branch (int): number of samples to get from sampling strategy
+        
+        Returns:
+            List of (sequences, samples, perplexity, recovery, sc_score) tuples,
+            one per backbone, as returned by `design`
+        """
+        # set random seed
+        set_seed(seed)
+
+        n_graphs = len(raw_data_list)
+        if featurized_data_list is None:
+            featurized_data_list = [None] * n_graphs
+        if output_filepaths is None:
+            output_filepaths = [None] * n_graphs
+        if partial_seqs is None:
+            partial_seqs = [None] * n_graphs
+
+        raw_data_list, featurized_data_list = zip(*[
+            self._prepare_data(raw_data, featurized_data)
+            for raw_data, featurized_data in zip(raw_data_list, featurized_data_list)
+        ])
+        batch = torch_geometric.data.Batch.from_data_list(featurized_data_list)
+
+        # logit bias over all nodes of the batch
+        if any(partial_seq is not None for partial_seq in partial_seqs):
+            logit_bias = torch.cat([
+                self._partial_seq_to_logit_bias(partial_seq)
+                if partial_seq is not None else
+                torch.zeros(data.num_nodes, self.model.out_dim, device=self.device)
+                for partial_seq, data in zip(partial_seqs, featurized_data_list)
+            ])
+        else:
+            logit_bias = None
+
+        # sample n_samples from model for each data point: [n_samples x seq_len] per graph
+        with autocast(self.device, self.precision):
+            samples, logits = self.model.sample(
+                batch,
+                n_samples,
+                temperature,
+                logit_bias=logit_bias,
+                return_logits=True,
+                sampling_strategy=sampling_strategy,
+                sampling_value=sampling_value,
+                beam_width=beam_width,
+                beam_branch=beam_branch,
+                max_temperature=max_temperature,
+                temperature_factor=temperature_factor,
+                avoid_sequences=avoid_sequences,
+                **self._encoder_outputs(featurized_data_list)
+            )
+
+        # temperatures of the samples of each backbone, if given per sample
+        if isinstance(temperature, (list, tuple)) or torch.is_tensor(temperature):
+            sample_ptr = np.cumsum([0] + [len(_samples) for _samples in samples])
+            temperatures = [temperature[sample_ptr[g]:sample_ptr[g+1]] for g in range(n_graphs)]
+        else:
+            temperatures = [temperature] * n_graphs
+
+        return [
+            self._collate_designs(
+                raw_data, featurized_data, _samples, _logits, 
+                output_filepath, seed, _temperature
+            )
+            for raw_data, featurized_data, _samples, _logits, output_filepath, _temperature in zip(
+                raw_data_list, featurized_data_list, samples, logits, output_filepaths, temperatures
+            )
+        ]
+
+    @torch.no_grad()
+    def design_iter(
+        self, 
+        raw_data: dict, 
+        featurized_data: Optional[torch_geometric.data.Data] = None, 
+        n_samples: Optional[int] = DEFAULT_N_SAMPLES,
+        chunk_size: Optional[int] = 4,
+        temperature: Optional[float] = DEFAULT_TEMPERATURE,
+        partial_seq: Optional[str] = None,
+        seed: Optional[int] = 0,
+        sampling_strategy: Optional[str] = SAMPLING_STRATEGY,
+        sampling_value: Optional[float] = SAMPLING_VALUE,
+        beam_width: Optional[int] = BEAM_WIDTH,
+        beam_branch: Optional[int] = BEAM_BRANCH,
+        max_temperature: Optional[float] = MAX_TEMPERATURE,
+        temperature_factor: Optional[float] = TEMPERATURE_FACTOR,
+        avoid_sequences: Optional[list] = None,
+        n_workers: Optional[int] = 1,
+    ):
+        """
+        Design RNA sequences from raw data, yielding designs as they complete.
+
+        Sequences are decoded in chunks of `chunk_size` samples, reusing the
+        encoder outputs across chunks (for autoregressive models). Each design is yielded with its 
+        perplexity and recovery as soon as its chunk is decoded, while its
+        EternaFold self consistency score is computed by background workers,
+        pipelined with decoding of the next chunks. Stopping the iteration 
+        early skips decoding and scoring of the remaining designs.
+
+        Note that designs are not identical to calling `design` with the same 
+        seed, as random numbers are drawn chunk by chunk.
+
+        Args:
+            raw_data (dict): raw RNA data dictionary, see `design`
+            featurized_data (torch_geometric.data.Data): featurized RNA data
+            n_samples (int): number of samples to generate
+            chunk_size (int): number of samples to decode at a time
+            temperature (float or list): temperature for sampling (per sample,
+                if a list of length `n_samples`; `sampling_strategy` and 
+                `sampling_value` can also be lists, to sweep several sampling 
+                settings in one pass)
+            partial_seq (str): partial sequence used to fix nucleotides in 
+                designed sequences, see `design`
+            seed (int): random seed for reproducibility
+            sampling_strategy (str): strategy for sampling ("min_p", "top_k", "top_p")
+            sampling_value (float): value for sampling strategy
+            beam_width (int): number of beams to maintain during search
+            beam_branch (int): number of samples to get from sampling strategy
+            n_workers (int): number of threads for self consistency scoring
+        
+        Yields:
+            design (dict): with keys
+                - idx (int): index of the design
+                - sequence (str): designed sequence
+                - sample (Tensor): designed sequence with shape `(seq_len,)`
+                - perplexity (float): perplexity of the design
+                - recovery (float): sequence recovery of the design
+                - sc_score (concurrent.futures.Future): future resolving to 
+                    the global self consistency score of the design
+        """
+        # set random seed
+        set_seed(seed)
+
+        raw_data, featurized_data = self._prepare_data(raw_data, featurized_data)
+        logit_bias = self._partial_seq_to_logit_bias(partial_seq)
+        encoder_outputs = self._encoder_outputs([featurized_data])
+        if len(encoder_outputs) == 0 and hasattr(self.model, 'encode'):
+            # encode once for all chunks (models without a separate encoder, 
+            # i.e. NARv1, encode the graph in each chunk)
+            with autocast(self.device, self.precision):
+                encoder_outputs = {"encoder_outputs": self.model.encode(featurized_data)}
+        mask_coords = featurized_data.mask_coords.cpu().numpy()
+
+        def sc_score(sample):
+            return self_consistency_score_eternafold(
+                sample[None], raw_data['sec_struct_list'], mask_coords
+            )[0]
+
+        executor = ThreadPoolExecutor(max_workers=n_workers)
+        # scoring futures of decoded designs which were not yielded yet
+        pending = []
+        try:
+            for start in range(0, n_samples, chunk_size):
+                end = min(start + chunk_size, n_samples)
+                # sampling parameters of the chunk, if given per sample
+                temperature_, sampling_strategy_, sampling_value_ = chunk_params(
+                    start, end, temperature, sampling_strategy, sampling_value)
+                # sample a chunk of designs from model: chunk_size x seq_len
+                with autocast(self.device, self.precision):
+                    samples, logits = self.model.sample(
+                        featurized_data,
+                        end - start,
+                        temperature_,
+                        logit_bias=logit_bias,
+                        return_logits=True,
+                        sampling_strategy=sampling_strategy_,
+                        sampling_value=sampling_value_,
+                        beam_width=beam_width,
+                        beam_branch=beam_branch,
+                        max_temperature=max_temperature,
+                        temperature_factor=temperature_factor,
+                        avoid_sequences=avoid_sequences,
+                        **encoder_outputs
+                    )
+                perplexity, recovery = self._perplexity_and_recovery(featurized_data, samples, logits)
+
+                # score designs in the background, then yield them
+                samples_np = samples.cpu().numpy()
+                pending = [executor.submit(sc_score, sample) for sample in samples_np]
+                for idx, (sample, perp, rec) in enumerate(zip(samples, perplexity, recovery)):
+                    future = pending.pop(0)
+                    yield {
+                        "idx": start + idx,
+                        "sequence": "".join([NUM_TO_LETTER[num] for num in samples_np[idx]]),
+                        "sample": sample,
+                        "perplexity": perp,
+                        "recovery": rec,
+                        "sc_score": future,
+                    }
+        finally:
+            # cancel scoring of designs which were not yielded; scores of 
+            # yielded designs are still computed, so their futures resolve
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _encoder_outputs(self, featurized_data_list):
+        """
+        Pooled encoder outputs for a list of featurized graphs, concatenated
+        in order, as keyword arguments for `self.model.sample`. Outputs of 
+        graphs missing from the encoder cache are computed in one batched pass 
+        and cached. Returns no arguments (the model encodes the graphs itself) 
+        when the cache is disabled, or for models without a separate encoder.
+        """
+        if self.encoder_cache is None or not hasattr(self.model, 'encode'):
+            return {}
+
+        keys = [self.encoder_cache.key(data) for data in featurized_data_list]
+        outputs = [self.encoder_cache.get(key) for key in keys]
+        missing = [idx for idx, output in enumerate(outputs) if output is None]
+        if len(missing) > 0:
+            data_list = [featurized_data_list[idx] for idx in missing]
+            with autocast(self.device, self.precision):
+                h_V, h_E = self.model.encode(torch_geometric.data.Batch.from_data_list(data_list))
+            # Split pooled features per graph (nodes and edges are stored graph by graph)
+            node_sizes = [data.num_nodes for data in data_list]
+            edge_sizes = [data.num_edges for data in data_list]
+            for idx, h_V0, h_V1, h_E0, h_E1 in zip(
+                missing, 
+                h_V[0].split(node_sizes), h_V[1].split(node_sizes), 
+                h_E[0].split(edge_sizes), h_E[1].split(edge_sizes)
+            ):
+                outputs[idx] = ((h_V0, h_V1), (h_E0, h_E1))
+                self.encoder_cache.put(keys[idx], outputs[idx])
+
+        h_V = tuple(torch.cat(feats) for feats in zip(*[h_V for h_V, _ in outputs]))
+        h_E = tuple(torch.cat(feats) for feats in zip(*[h_E for _, h_E in outputs]))
+        return {"encoder_outputs": (h_V, h_E)}
+
+    def _prepare_data(self, raw_data, featurized_data=None):
+        """
+        Keep backbone atoms of the raw data, featurize it if needed 
+        and transfer the featurized data to device.
+        """
         if raw_data['coords_list'][0].shape[1] == 3:
             # Expected input: num_conf x num_res x num_bb_atoms x 3
             # Backbone atoms: (P, C4', N1 or N9)
@@ -407,52 +939,52 @@ class gRNAde(object):
 
         # transfer data to device
         featurized_data = featurized_data.to(self.device)
-        
-        # create logit bias matrix if partial sequence is provided
-        if partial_seq is not None:
-            # convert partial sequence to tensor
-            _partial_seq = []
-            for residue in partial_seq:
-                if residue in self.featurizer.letter_to_num.keys():
-                    # fixed nucleotide
-                    _partial_seq.append(self.featurizer.letter_to_num[residue])
-                else:
-                    # designable position
-                    _partial_seq.append(len(self.featurizer.letter_to_num.keys()))
-            _partial_seq = torch.as_tensor(_partial_seq, device=self.device, dtype=torch.long)
-            # convert to one-hot and create bias matrix used during sampling
-            logit_bias = F.one_hot(_partial_seq, num_classes=self.model.out_dim+1).float()
-            logit_bias = logit_bias[:, :-1] * 100.0
-        else:
-            logit_bias = None
-        
-        print('Avoiding sequences:', avoid_sequences)
-        # sample n_samples from model for single data point: n_samples x seq_len
-        samples, logits = self.model.sample(
-            featurized_data,
-            n_samples,
-            temperature,
-            logit_bias=logit_bias,
-            return_logits=True,
-            sampling_strategy=sampling_strategy,
-            sampling_value=sampling_value,
-            beam_width=beam_width,
-            beam_branch=beam_branch,
-            max_temperature=max_temperature,
-            temperature_factor=temperature_factor,
-            avoid_sequences=avoid_sequences
-        )
+        return raw_data, featurized_data
 
+    def _partial_seq_to_logit_bias(self, partial_seq):
+        """
+        Create logit bias matrix of shape `(seq_len, 4)` if partial sequence is provided.
+        """
+        if partial_seq is None:
+            return None
+        # convert partial sequence to tensor
+        _partial_seq = []
+        for residue in partial_seq:
+            if residue in self.featurizer.letter_to_num.keys():
+                # fixed nucleotide
+                _partial_seq.append(self.featurizer.letter_to_num[residue])
+            else:
+                # designable position
+                _partial_seq.append(len(self.featurizer.letter_to_num.keys()))
+        _partial_seq = torch.as_tensor(_partial_seq, device=self.device, dtype=torch.long)
+        # convert to one-hot and create bias matrix used during sampling
+        logit_bias = F.one_hot(_partial_seq, num_classes=self.model.out_dim+1).float()
+        logit_bias = logit_bias[:, :-1] * 100.0
+        return logit_bias
+
+    def _perplexity_and_recovery(self, featurized_data, samples, logits):
+        """
+        Perplexity and sequence recovery per designed sequence of one backbone, 
+        each of shape `(n_samples,)`.
+        """
         # perplexity per sample: n_samples x 1
-        n_nodes = logits.shape[1]
+        n_samples, n_nodes = samples.shape
         perplexity = torch.exp(F.cross_entropy(
-            logits.view(n_samples * n_nodes, self.model.out_dim), 
-            samples.view(n_samples * n_nodes).long(), 
+            logits.reshape(n_samples * n_nodes, self.model.out_dim), 
+            samples.reshape(n_samples * n_nodes).long(), 
             reduction="none"
         ).view(n_samples, n_nodes).mean(dim=1)).cpu().numpy()
         
         # sequence recovery per sample: n_samples x 1
         recovery = samples.eq(featurized_data.seq).float().mean(dim=1).cpu().numpy()
+        return perplexity, recovery
+
+    def _collate_designs(self, raw_data, featurized_data, samples, logits, output_filepath, seed, temperature):
+        """
+        Compute metrics for designed sequences of one backbone and 
+        collate them in fasta format, see `design`.
+        """
+        perplexity, recovery = self._perplexity_and_recovery(featurized_data, samples, logits)
 
         # global self consistency score per sample: n_samples x 1
         sc_score = self_consistency_score_eternafold(
@@ -472,19 +1004,24 @@ class gRNAde(object):
             )
         ]
         # remaining records: designed sequences and metrics
+        if torch.is_tensor(temperature):
+            temperature = temperature.tolist()
+        if not isinstance(temperature, (list, tuple)):
+            temperature = [temperature] * len(samples)
         for idx, zipped in enumerate(zip(
             samples.cpu().numpy(),
             perplexity,
             recovery,
-            sc_score
+            sc_score,
+            temperature
         )):
-            seq, perp, rec, sc = zipped
+            seq, perp, rec, sc, temp = zipped
             seq = "".join([NUM_TO_LETTER[num] for num in seq])
             edit_dist = edit_distance(seq, raw_data['sequence'])
             sequences.append(SeqRecord(
                 Seq(seq), 
                 id=f"sample={idx},",
-                description=f"seed={seed}, temperature={temperature}, perplexity={perp:.4f}, recovery={rec:.4f}, edit_dist={edit_dist}, sc_score={sc:.4f}"
+                description=f"seed={seed}, temperature={temp}, perplexity={perp:.4f}, recovery={rec:.4f}, edit_dist={edit_dist}, sc_score={sc:.4f}"
             ))
         
         if output_filepath is not None:
@@ -610,11 +1147,12 @@ class gRNAde(object):
         featurized_data.seq = _seq
 
         # raw logits for perplexity calculation: seq_len x out_dim
-        logits = self.model.forward(featurized_data)
+        with autocast(self.device, self.precision):
+            logits = self.model.forward(featurized_data)
 
         # compute perplexity
         perplexity = torch.exp(F.cross_entropy(
-            logits / temperature, 
+            logits.float() / temperature, 
             _seq,
             reduction="none"
         ).mean()).cpu().numpy()
@@ -674,6 +1212,51 @@ if __name__ == "__main__":
         type=int,
         help="Maximum number of conformers for input RNA backbone (multi-state design)"
     )
+    parser.add_argument(
+        '--topology_filepath', 
+        dest='topology_filepath', 
+        default=None,
+        type=str,
+        help="Filepath to topology file of an MD trajectory to be re-designed \
+            (multi-state design)"
+    )
+    parser.add_argument(
+        '--trajectory_filepath', 
+        dest='trajectory_filepath', 
+        default=None,
+        type=str,
+        help="Filepath to MD trajectory file (frames are read from the \
+            topology file if not provided)"
+    )
+    parser.add_argument(
+        '--selection', 
+        dest='selection', 
+        default="nucleic",
+        type=str,
+        help="MDAnalysis selection of the RNA residues in the MD trajectory"
+    )
+    parser.add_argument(
+        '--stride', 
+        dest='stride', 
+        default=1,
+        type=int,
+        help="Read every stride-th frame of the MD trajectory"
+    )
+    parser.add_argument(
+        '--n_clusters', 
+        dest='n_clusters', 
+        default=None,
+        type=int,
+        help="Number of clusters of MD frames to keep one representative frame of"
+    )
+    parser.add_argument(
+        '--sec_struct', 
+        dest='sec_struct', 
+        default=None,
+        type=str,
+        help="Secondary structure of the MD trajectory in dotbracket notation \
+            (required if the topology file is not a PDB file)"
+    )
     parser.add_argument(
         '--n_samples', 
         dest='n_samples', 
@@ -766,17 +1349,32 @@ if __name__ == "__main__":
         type=str,
         help="Filepath to nullomers fasta file"
     )
+    parser.add_argument(
+        '--quantize',
+        dest='quantize',
+        action='store_true',
+        help="Apply dynamic INT8 quantization for CPU inference"
+    )
+    parser.add_argument(
+        '--precision',
+        dest='precision',
+        default="fp32",
+        type=str,
+        help="Numerical precision (fp32, or bf16/fp16 for mixed precision)"
+    )
 
     args, unknown = parser.parse_known_args()
 
-    if args.pdb_filepath is None and args.directory_filepath is None:
-        raise ValueError("Please specify either pdb_filepath or directory_filepath")
+    if args.pdb_filepath is None and args.directory_filepath is None and args.topology_filepath is None:
+        raise ValueError("Please specify either pdb_filepath, directory_filepath or topology_filepath")
 
     g = gRNAde(
         split=args.split,
         max_num_conformers=args.max_num_conformers, 
         gpu_id=args.gpu_id,
-        model_type=args.model_type
+        model_type=args.model_type,
+        precision=args.precision,
+        quantize=args.quantize
     )
 
     if args.pdb_filepath is not None:
@@ -811,6 +1409,27 @@ if __name__ == "__main__":
             temperature_factor=args.temperature_factor,
             nullomers_filepath=args.nullomers_filepath
         )
+    elif args.topology_filepath is not None:
+        sequences, samples, logits, recovery_sample, sc_score = g.design_from_trajectory(
+            topology_filepath=args.topology_filepath,
+            trajectory_filepath=args.trajectory_filepath,
+            output_filepath=args.output_filepath,
+            selection=args.selection,
+            stride=args.stride,
+            n_clusters=args.n_clusters,
+            sec_struct=args.sec_struct,
+            n_samples=args.n_samples,
+            temperature=args.temperature,
+            partial_seq=args.partial_seq,
+            seed=args.seed,
+            sampling_strategy=args.sampling_strategy,
+            sampling_value=args.sampling_value,
+            beam_width=args.beam_width,
+            beam_branch=args.beam_branch,
+            max_temperature=args.max_temperature,
+            temperature_factor=args.temperature_factor,
+            nullomers_filepath=args.nullomers_filepath
+        )
 
     for seq in sequences:
         print(seq.format("fasta"))
@@ -68,7 +68,9 @@ def main(config, device):
             beam_width=config.beam_width,
             beam_branch=config.beam_branch,
             max_temperature=config.max_temperature,
-            temperature_factor=config.temperature_factor
+            temperature_factor=config.temperature_factor,
+            precision=config.precision,
+            batch_size=config.eval_batch_size
         )
         
         """df, samples_list, recovery_list, perplexity_list, \
@@ -191,7 +193,8 @@ def get_dataset(config, data_list, split="train"):
         num_rbf = config.num_rbf,
         num_posenc = config.num_posenc,
         max_num_conformers = config.max_num_conformers,
-        noise_scale = config.noise_scale
+        noise_scale = config.noise_scale,
+        cache_dir = config.featurizer_cache_dir
     )
 
 
@@ -243,13 +246,17 @@ def get_model(config):
             'edge_h_dim': tuple(config.edge_h_dim), 
             'num_layers': config.num_layers,
             'drop_rate': config.drop_rate,
-            'out_dim': config.out_dim
+            'out_dim': config.out_dim,
+            'checkpoint_every': config.checkpoint_every
             }
     
     if config.model == 'ARv2':
         # Add extra args for expressive model
         args['attention_heads'] = config.attention_heads
         args['attention_dropout'] = config.attention_dropout
+        args['attention_chunk_size'] = config.attention_chunk_size
+        args['attention_mode'] = config.attention_mode
+        args['moment_rank'] = config.moment_rank
 
     return model_class(**args)
 
@@ -4,6 +4,7 @@ import pandas as pd
 from typing import Any, List, Literal, Optional
 import torch
 import cpdb
+import MDAnalysis as mda
 
 from src.data.sec_struct_utils import pdb_to_sec_struct
 
@@ -324,3 +325,161 @@ def get_center(
 
     x_flat, _, _ = get_full_atom_coords(x, fill_value=fill_value)
     return x_flat.mean(dim=0)
+
+
+# Residue names of nucleotides in MD topologies (AMBER, CHARMM, GROMACS)
+MD_RESIDUE_NAMES = {
+    "ADE": "A", "GUA": "G", "CYT": "C", "URA": "U",
+    "RADE": "A", "RGUA": "G", "RCYT": "C", "RURA": "U",
+}
+
+
+def resname_to_nucleotide(resname: str) -> str:
+    """
+    Maps the residue name of a nucleotide in an MD topology to a letter
+    of ``RNA_NUCLEOTIDES``, e.g. ``A``, ``RA``, ``RA5``, ``A3`` or ``ADE``
+    to ``A``. Returns the placeholder ``_`` for non-standard residues.
+    """
+    resname = resname.strip().upper()
+    if resname in MD_RESIDUE_NAMES:
+        return MD_RESIDUE_NAMES[resname]
+    # strip terminal suffixes (A5, RA3) and RNA prefix (RA, RU)
+    resname = resname.rstrip("0123456789")
+    if len(resname) == 2 and resname[0] == "R":
+        resname = resname[1:]
+    return resname if resname in RNA_NUCLEOTIDES else "_"
+
+
+def trajectory_to_tensor(
+        topology: str,
+        trajectory: Optional[Any] = None,
+        selection: str = "nucleic",
+        start: Optional[int] = None,
+        stop: Optional[int] = None,
+        stride: int = 1,
+        fill_value: float = FILL_VALUE,
+    ):
+    """
+    Reads an MD trajectory of an RNA with MDAnalysis and returns:
+    - sequence: str - RNA sequence
+    - coords: torch.FloatTensor of shape ``(num_frames, length, 3, 3)`` -
+        3D coordinates of the ``[P, C4', N1 or N9]`` backbone atoms per
+        frame (centered at origin), as returned by ``get_backbone_coords``
+
+    Backbone atoms are looked up once in the topology, and their positions
+    are read for all frames in one pass over the trajectory, without
+    writing intermediate files.
+
+    Args:
+        topology (str): Path to topology file (PDB, GRO, PSF, PRMTOP, ...).
+        trajectory (str or List[str], optional): Path(s) to trajectory
+            file(s) (DCD, XTC, TRR, NetCDF, ...). If not provided, frames
+            are read from the topology file (e.g. a multi-model PDB).
+        selection (str, optional): MDAnalysis selection of the RNA residues.
+            Defaults to ``"nucleic"``.
+        start (int, optional): First frame to read. Defaults to the first frame.
+        stop (int, optional): Frame to stop reading at (exclusive). Defaults
+            to the last frame.
+        stride (int, optional): Read every ``stride``-th frame. Defaults to 1.
+        fill_value (float, optional): Value to fill missing atoms with.
+            Defaults to ``1e-5``.
+    
+    Returns:
+        sequence (str): RNA sequence
+        coords (torch.FloatTensor): 3D coordinates of backbone atoms
+    """
+    if trajectory is None:
+        universe = mda.Universe(topology)
+    elif isinstance(trajectory, (list, tuple)):
+        universe = mda.Universe(topology, *trajectory)
+    else:
+        universe = mda.Universe(topology, trajectory)
+    residues = universe.select_atoms(selection).residues
+
+    # get sequence
+    sequence = "".join(resname_to_nucleotide(res.resname) for res in residues)
+    assert len(sequence) > 1, "Selection must contain more than one nucleotide"
+
+    # get indices of [P, C4', N1 or N9] atoms per residue (-1 if missing)
+    atom_indices = np.full((len(residues), 3), -1, dtype=np.int64)
+    for i, (res, base) in enumerate(zip(residues, sequence)):
+        if base == "_":
+            continue
+        glycosidic_n = "N9" if base in PURINES else "N1"
+        names = list(res.atoms.names)
+        for j, atom_names in enumerate([("P",), ("C4'", "C4*"), (glycosidic_n,)]):
+            for name in atom_names:
+                if name in names:
+                    atom_indices[i, j] = res.atoms[names.index(name)].index
+                    break
+    mask = atom_indices >= 0
+    assert mask.any(), "No backbone atoms found in selection"
+
+    # read positions of backbone atoms for all frames: num_frames x num_atoms x 3
+    positions = universe.trajectory.timeseries(
+        universe.atoms[atom_indices[mask]], start=start, stop=stop, step=stride, order="fac"
+    )
+    positions = torch.from_numpy(np.ascontiguousarray(positions)).float()
+    positions = positions - positions.mean(dim=1, keepdim=True)
+
+    coords = torch.full((positions.shape[0], len(sequence), 3, 3), fill_value)
+    coords[:, torch.from_numpy(mask)] = positions
+    return sequence, coords
+
+
+def cluster_frames(
+        coords: torch.FloatTensor,
+        n_clusters: int,
+        n_iter: int = 20,
+        fill_value: float = FILL_VALUE,
+    ):
+    """
+    Selects representative frames of an MD trajectory by k-means clustering
+    of the C4' coordinates of frames superimposed on the first frame.
+    Cluster centers are initialised by farthest point sampling, and the
+    frame closest to each cluster center is returned.
+
+    Args:
+        coords (torch.FloatTensor): Backbone coordinates of shape
+            ``(num_frames, length, num_bb_atoms, 3)``.
+        n_clusters (int): Number of clusters (i.e. frames to select).
+        n_iter (int, optional): Number of k-means iterations. Defaults to 20.
+        fill_value (float, optional): Value used to denote missing atoms.
+            Defaults to ``1e-5``.
+    
+    Returns:
+        frame_indices (torch.LongTensor): Sorted indices of selected frames,
+            at most ``n_clusters`` of them.
+    """
+    n_frames = coords.shape[0]
+    if n_clusters >= n_frames:
+        return torch.arange(n_frames)
+
+    # C4' coordinates of nucleotides present in all frames
+    x = coords[:, :, 1].double()
+    x = x[:, (x != fill_value).all(dim=-1).all(dim=0)]
+    x = x - x.mean(dim=1, keepdim=True)
+
+    # superimpose all frames on the first frame (Kabsch algorithm)
+    U, _, Vt = torch.linalg.svd(x.transpose(1, 2) @ x[0])
+    d = torch.sign(torch.linalg.det(U @ Vt))
+    U[:, :, -1] = U[:, :, -1] * d[:, None]
+    x = (x @ (U @ Vt)).flatten(1)
+
+    # farthest point initialisation of cluster centers
+    centers = [0]
+    min_dist = torch.cdist(x, x[:1]).squeeze(1)
+    for _ in range(n_clusters - 1):
+        centers.append(int(min_dist.argmax()))
+        min_dist = torch.minimum(min_dist, torch.cdist(x, x[centers[-1:]]).squeeze(1))
+    centroids = x[centers]
+
+    for _ in range(n_iter):
+        assignment = torch.cdist(x, centroids).argmin(dim=1)
+        counts = torch.bincount(assignment, minlength=n_clusters)
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, x)
+        # keep centers of empty clusters
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+
+    return torch.unique(torch.cdist(centroids, x).argmin(dim=1))
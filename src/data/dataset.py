@@ -21,7 +21,8 @@ class RNADesignDataset(data.Dataset):
     - seq        sequence converted to int tensor, shape [num_nodes]
     - node_s     node scalar features, shape [num_nodes, num_conf, num_bb_atoms x 5] 
     - node_v     node vector features, shape [num_nodes, num_conf, 2 + (num_bb_atoms - 1), 3]
-    - edge_s     edge scalar features, shape [num_edges, num_conf, num_bb_atoms x num_rbf + num_posenc + num_bb_atoms]
+    - edge_s     edge scalar features, shape [num_edges, num_conf, num_bb_atoms x num_rbf + num_bb_atoms]
+    - edge_posenc edge positional encodings, shape [num_edges, num_posenc]
     - edge_v     edge vector features, shape [num_edges, num_conf, num_bb_atoms, 3]
     - edge_index edge indices, shape [2, num_edges]
     - mask       node mask, `False` for nodes with missing data
@@ -35,6 +36,8 @@ class RNADesignDataset(data.Dataset):
         num_posenc: number of positional encodings per edge
         max_num_conformers: maximum number of conformers sampled per sequence
         noise_scale: standard deviation of gaussian noise added to coordinates
+        cache_dir: directory of a persistent cache of featurized graphs
+            (not used for the train split), see `FeaturizedGraphCache`
     """
     def __init__(
             self,
@@ -53,7 +56,8 @@ class RNADesignDataset(data.Dataset):
                 RNA_ATOMS.index("P"), RNA_ATOMS.index("C4'"), RNA_ATOMS.index("N9")
             ],
             distance_eps = DISTANCE_EPS,
-            device = 'cpu'
+            device = 'cpu',
+            cache_dir = None
         ):
         super().__init__()
 
@@ -62,7 +66,8 @@ class RNADesignDataset(data.Dataset):
         self.featurizer = RNAGraphFeaturizer(
             split=split, radius=radius, top_k=top_k, num_rbf=num_rbf,
             num_posenc=num_posenc, max_num_conformers=max_num_conformers,
-            noise_scale=noise_scale, distance_eps=distance_eps, device=device
+            noise_scale=noise_scale, distance_eps=distance_eps, device=device,
+            cache_dir=cache_dir
         )
 
         # Pre-process raw data to prepare self.data_list
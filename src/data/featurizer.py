@@ -1,10 +1,15 @@
+import os
 import math
+import json
+import pickle
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from typing import Optional, Tuple
 import torch
 import torch.nn.functional as F
 import torch_geometric
-from torch_geometric.utils import coalesce, to_undirected
 import torch_cluster
 
 from src.data.data_utils import *
@@ -21,9 +26,15 @@ class RNAGraphFeaturizer(object):
     - seq        sequence converted to int tensor, shape [num_nodes]
     - node_s     node scalar features, shape [num_nodes, num_conf, num_bb_atoms x 5] 
     - node_v     node vector features, shape [num_nodes, num_conf, 2 + (num_bb_atoms - 1), 3]
-    - edge_s     edge scalar features, shape [num_edges, num_conf, num_bb_atoms x num_rbf + num_posenc + num_bb_atoms]
+    - edge_s     edge scalar features, shape [num_edges, num_conf, num_bb_atoms x num_rbf + num_bb_atoms]
+    - edge_posenc edge positional encodings (conformer-invariant, inserted in edge
+                 scalar features by the models, see `edge_input_features`), shape
+                 [num_edges, num_posenc]
     - edge_v     edge vector features, shape [num_edges, num_conf, num_bb_atoms, 3]
     - edge_index edge indices, shape [2, num_edges]
+    - edge_confs edge provenance, `True` for the conformers whose kNN graph
+                 contains the edge, shape [num_edges, num_conf] (only if
+                 `return_edge_confs`)
     - mask       node mask, `False` for nodes with missing data
 
     Args:
@@ -34,6 +45,12 @@ class RNAGraphFeaturizer(object):
         num_posenc: number of positional encodings per edge
         max_num_conformers: maximum number of conformers sampled per sequence
         noise_scale: standard deviation of gaussian noise added to coordinates
+        cache_dir: directory of a persistent cache of featurized graphs, see
+            `FeaturizedGraphCache` (only used for splits other than train,
+            whose graphs are deterministic given the sampled conformers;
+            conformers are then sampled with a seed derived from the input)
+        return_edge_confs: whether to store the edge provenance `edge_confs`
+            in featurized graphs (not used by the models)
     """
     def __init__(
             self,
@@ -45,7 +62,9 @@ class RNAGraphFeaturizer(object):
             max_num_conformers = 3,
             noise_scale = 0.1,
             distance_eps = DISTANCE_EPS,
-            device = 'cpu'
+            device = 'cpu',
+            cache_dir = None,
+            return_edge_confs = False
         ):
         super().__init__()
 
@@ -58,6 +77,7 @@ class RNAGraphFeaturizer(object):
         self.noise_scale = noise_scale
         self.distance_eps = distance_eps
         self.device = device
+        self.return_edge_confs = return_edge_confs
 
         # nucleotide mapping: {'A': 0, 'G': 1, 'C': 2, 'U': 3, '_': 4}
         self.letter_to_num = dict(zip(
@@ -67,19 +87,54 @@ class RNAGraphFeaturizer(object):
         self.num_to_letter = {v:k for k, v in self.letter_to_num.items()}
         self.letter_to_num["_"] = len(self.letter_to_num)  # unknown nucleotide
 
+        # Precomputed RBF centers and positional encoding frequencies
+        self.rbf_centers = rbf_centers(num_rbf=num_rbf, device=device)
+        self.posenc_frequencies = posenc_frequencies(num_posenc, device=device)
+
+        # Featurized graphs are only cached when no noise is added
+        self.cache = None
+        if cache_dir is not None and split != 'train':
+            self.cache = FeaturizedGraphCache(cache_dir, {
+                'radius': radius, 'top_k': top_k, 'num_rbf': num_rbf, 
+                'num_posenc': num_posenc, 'max_num_conformers': max_num_conformers,
+                'distance_eps': distance_eps, 'return_edge_confs': return_edge_confs,
+            })
+
     def __call__(self, rna):
+        if self.cache is None:
+            # Set of coordinates: num_conf x num_res x num_bb_atoms x 3
+            coords_list, mask_coords, mask_confs = get_k_random_entries_and_masks(
+                rna['coords_list'], k = self.max_num_conformers
+            )
+            return self._featurize(rna['sequence'], coords_list, mask_coords, mask_confs)
+
+        # Look up the graph of the raw RNA; on a miss, conformers are
+        # sampled with a generator seeded from the key, so that the cached
+        # graph is the same whichever process or epoch featurizes it first
+        key = self.cache.key(rna)
+        data = self.cache.get(key)
+        if data is None:
+            coords_list, mask_coords, mask_confs = get_k_random_entries_and_masks(
+                rna['coords_list'], k = self.max_num_conformers, 
+                rng = np.random.default_rng(int(key[:16], 16))
+            )
+            data = self._featurize(rna['sequence'], coords_list, mask_coords, mask_confs)
+            self.cache.put(key, data)
+        return data.to(self.device)
+
+    def _featurize(self, sequence, coords_list, mask_coords, mask_confs):
+        """
+        Featurized graph of an RNA backbone from its sequence and sampled 
+        conformers, see `get_k_random_entries_and_masks`.
+        """
         with torch.no_grad():
             # Target sequence: num_res x 1
             seq = torch.as_tensor(
-                [self.letter_to_num[residue] for residue in rna['sequence']], 
+                [self.letter_to_num[residue] for residue in sequence], 
                 device=self.device, 
                 dtype=torch.long
             )
             
-            # Set of coordinates: num_conf x num_res x num_bb_atoms x 3
-            coords_list, mask_coords, mask_confs = get_k_random_entries_and_masks(
-                rna['coords_list'], k = self.max_num_conformers
-            )
             coords_list = torch.as_tensor(
                 coords_list, 
                 device=self.device, 
@@ -112,14 +167,11 @@ class RNAGraphFeaturizer(object):
             # Mask for extra coordinates if fewer than num_conf: num_res x num_conf
             mask_confs = torch.BoolTensor(mask_confs).repeat(len(seq), 1)
 
-            # Construct merged edge index
-            edge_index = []
-            for coord in coords_list:
-                # K-nearest neighbour graph using centroids of each neucleotide
-                edge_index.append(torch_cluster.knn_graph(coord.mean(1), self.top_k))
-            edge_index = to_undirected(coalesce(
-                torch.concat(edge_index, dim=1)
-            ))
+            # Construct merged edge index: union of K-nearest neighbour graphs 
+            # using centroids of each nucleotide, over all conformers at once
+            knn_graph = multi_conformer_knn_graph(
+                coords_list.mean(2), self.top_k, return_edge_confs=self.return_edge_confs)
+            edge_index, edge_confs = knn_graph if self.return_edge_confs else (knn_graph, None)
 
             # Reshape: num_res x num_conf x ...
             coords_list = coords_list.permute(1, 0, 2, 3) # coords_list[:, :, 1].permute(1, 0, 2)
@@ -131,16 +183,17 @@ class RNAGraphFeaturizer(object):
             edge_lengths = torch.sqrt((edge_vectors ** 2).sum(dim=-1) + self.distance_eps) #.unsqueeze(-1)
 
             # Edge RBF features: num_edges x num_conf x num_rbf
-            edge_rbf = rbf_expansion(edge_lengths, num_rbf=self.num_rbf)
+            edge_rbf = rbf_expansion(edge_lengths, num_rbf=self.num_rbf, centers=self.rbf_centers)
 
-            # Edge positional encodings: num_edges x num_conf x num_posenc
+            # Edge positional encodings (same for all conformers): num_edges x num_posenc
             edge_posenc = positional_encoding(
-                (edge_index[0] - edge_index[1])[..., None], self.num_posenc
-            ).unsqueeze_(1).repeat(1, self.max_num_conformers, 1)
+                (edge_index[0] - edge_index[1])[..., None], self.num_posenc,
+                frequencies=self.posenc_frequencies
+            )
 
             node_s = internal_coords_feat
             node_v = internal_vecs_feat
-            edge_s = torch.cat([edge_rbf, edge_posenc, torch.log(edge_lengths)], dim=-1)
+            edge_s = torch.cat([edge_rbf, torch.log(edge_lengths)], dim=-1)
             edge_v = normed_vec(edge_vectors) # .unsqueeze(-2)
             node_s, node_v, edge_s, edge_v = map(
                 torch.nan_to_num,
@@ -151,12 +204,15 @@ class RNAGraphFeaturizer(object):
             seq = seq,                  # num_res x 1
             node_s = node_s,            # num_res x num_conf x (num_bb_atoms x 5)
             node_v = node_v,            # num_res x num_conf x (2 + (num_bb_atoms - 1)) x 3
-            edge_s = edge_s,            # num_edges x num_conf x (num_bb_atoms x num_rbf + num_posenc + num_bb_atoms)
+            edge_s = edge_s,            # num_edges x num_conf x (num_bb_atoms x num_rbf + num_bb_atoms)
+            edge_posenc = edge_posenc,  # num_edges x num_posenc
             edge_v = edge_v,            # num_edges x num_conf x num_bb_atoms x 3
             edge_index = edge_index,    # 2 x num_edges
             mask_confs = mask_confs,    # num_res x num_conf
             mask_coords = mask_coords,  # num_res
         )
+        if self.return_edge_confs:
+            data.edge_confs = edge_confs  # num_edges x num_conf
         return data
     
     def featurize(self, rna):
@@ -217,8 +273,250 @@ class RNAGraphFeaturizer(object):
         
         return self(rna), rna
 
+    def featurize_from_trajectory(
+            self,
+            topology,
+            trajectory=None,
+            selection="nucleic",
+            start=None,
+            stop=None,
+            stride=1,
+            n_clusters=None,
+            sec_struct=None,
+        ):
+        """
+        Featurize RNA backbone from an MD trajectory, i.e. multiple
+        conformations of the same RNA. Backbone coordinates of all frames
+        are read in one pass, without writing intermediate PDB files, and
+        frames are subsampled by `stride` and/or clustering.
+
+        Args:
+            topology (str): Path to topology file.
+            trajectory (str or list): Path(s) to trajectory file(s); frames
+                are read from the topology file if not provided.
+            selection (str): MDAnalysis selection of the RNA residues.
+            start (int): First frame to read.
+            stop (int): Frame to stop reading at (exclusive).
+            stride (int): Read every `stride`-th frame.
+            n_clusters (int): If provided, keep the representative frames of
+                `n_clusters` clusters of conformations (see `cluster_frames`).
+            sec_struct (str): Secondary structure in dotbracket notation,
+                used for all frames. Computed from the topology if not
+                provided, which must then be a PDB file.
+        """
+        sequence, coords = trajectory_to_tensor(
+            topology, trajectory, selection, start, stop, stride)
+        if n_clusters is not None:
+            coords = coords[cluster_frames(coords, n_clusters)]
+
+        if sec_struct is None:
+            assert topology.lower().endswith(".pdb"), \
+                "Secondary structure must be provided if topology is not a PDB file"
+            sec_struct = pdb_to_sec_struct(topology, sequence)
+        assert len(sec_struct) == len(sequence), "Sequence and secondary structure must be the same length"
 
-def get_k_random_entries_and_masks(coords_list, k):
+        rna = {
+            'sequence': sequence,
+            'coords_list': list(coords),
+            'sec_struct_list': [sec_struct] * len(coords),
+        }
+        return self(rna), rna
+
+    def featurize_many(self, inputs, n_workers=None, max_nodes=None, return_raw=False):
+        """
+        Featurize many RNA backbones in parallel, in a pool of worker processes.
+
+        Inputs are parsed (for PDB files) and featurized by `n_workers` 
+        processes and collated into `torch_geometric.data.Batch` objects, 
+        in the order of `inputs`. Conformer selection (and noise, for the 
+        training split) is random in each worker process.
+
+        Args:
+            inputs (list): raw RNA data dictionaries (as for `featurize`), 
+                paths to PDB files, or lists of paths to PDB files of the
+                conformations of one RNA (as for `featurize_from_pdb_filelist`)
+            n_workers (int): number of worker processes (number of CPUs if 
+                None, featurized in this process if 0)
+            max_nodes (int): if given, a generator of batches is returned
+                instead, with consecutive backbones batched up to `max_nodes`
+                nodes per batch (backbones larger than `max_nodes` are
+                batched on their own); batches are yielded as soon as they
+                are featurized
+            return_raw (bool): whether to also return the list of raw RNA 
+                data dictionaries of each batch
+        
+        Returns:
+            batch (torch_geometric.data.Batch): featurized graphs of all inputs,
+                or a generator of batches if `max_nodes` is given (as tuples
+                `(batch, raw_data_list)` if `return_raw` is True)
+        """
+        batches = self._featurize_batches(list(inputs), n_workers, max_nodes)
+        if max_nodes is None:
+            batch, raw_data_list = next(batches)
+            batches.close()  # shuts down the worker pool
+            return (batch, raw_data_list) if return_raw else batch
+        return batches if return_raw else (batch for batch, _ in batches)
+
+    def _featurize_batches(self, inputs, n_workers, max_nodes):
+        """
+        Generator of `(batch, raw_data_list)` for `featurize_many`.
+        """
+        n_workers = os.cpu_count() if n_workers is None else n_workers
+        n_workers = min(n_workers, len(inputs))
+        if n_workers == 0:
+            results = (_featurize_input(self, x) for x in inputs)
+            yield from node_budget_batches(results, max_nodes)
+            return
+        # Workers are spawned (rather than forked) as the parent process may
+        # hold threads of torch's thread pools
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=context,
+            initializer=_init_featurize_worker, initargs=(self,)
+        ) as executor:
+            # map returns results in the order of inputs
+            yield from node_budget_batches(executor.map(_featurize_worker, inputs), max_nodes)
+
+
+class FeaturizedGraphCache(object):
+    """
+    Persistent on-disk cache of featurized graphs, shared across epochs,
+    evaluation runs and processes (e.g. DataLoader workers).
+
+    Entries are content-addressed: the key of a graph hashes the sample ids,
+    sequence and coordinates of all conformers of the raw RNA (conformers are
+    then sampled deterministically from the key, see `RNAGraphFeaturizer`),
+    and entries are stored in a subdirectory per hash of the featurizer
+    hyperparameters, so that changing hyperparameters (or the cache version)
+    never hits stale entries. Each entry is a file of tensors written
+    atomically (concurrent writers of the same entry are harmless) and
+    loaded memory-mapped (with torch >= 2.1), so that reading it only pages
+    in its tensors.
+
+    Entries are never evicted: the cache holds one graph per distinct raw
+    RNA featurized with given hyperparameters, i.e. it grows up to the size
+    of the featurized val/test sets, plus stale subdirectories of previous
+    hyperparameters or versions, which can be deleted safely.
+
+    Args:
+        cache_dir (str): root directory of the cache
+        hparams (dict): featurizer hyperparameters (JSON serializable)
+    """
+    # Bump when the featurization changes for the same hyperparameters
+    VERSION = 3
+
+    def __init__(self, cache_dir, hparams):
+        self.hparams = dict(hparams, version=self.VERSION)
+        hparams_json = json.dumps(self.hparams, sort_keys=True)
+        digest = hashlib.sha256(hparams_json.encode()).hexdigest()[:16]
+        self.cache_dir = os.path.join(cache_dir, digest)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Hyperparameters of the entries, for reference
+        hparams_path = os.path.join(self.cache_dir, 'hparams.json')
+        if not os.path.exists(hparams_path):
+            with open(hparams_path, 'w') as f:
+                f.write(hparams_json)
+
+    def key(self, rna):
+        """
+        Content hash of a raw RNA, including the coordinates of all of its
+        conformers.
+
+        Args:
+            rna (dict): raw RNA data
+        """
+        h = hashlib.sha256()
+        h.update(str(rna.get('id_list', '')).encode())
+        h.update(rna['sequence'].encode())
+        coords_list = np.ascontiguousarray(
+            np.array([np.asarray(coords) for coords in rna['coords_list']]), dtype=np.float32)
+        h.update(str(coords_list.shape).encode())
+        h.update(coords_list.tobytes())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def get(self, key):
+        """
+        Cached graph (`torch_geometric.data.Data` with memory-mapped tensors), 
+        or None if not cached. Unreadable entries (e.g. truncated files left
+        by a full disk or copied caches) are treated as misses, and are 
+        overwritten when the graph is put again.
+        """
+        path = self.path(key)
+        try:
+            try:
+                entry = torch.load(path, mmap=True)
+            except TypeError:
+                # torch < 2.1 does not support memory-mapped loading
+                entry = torch.load(path)
+        except FileNotFoundError:
+            return None
+        except (RuntimeError, EOFError, pickle.UnpicklingError):
+            return None
+        return torch_geometric.data.Data(**entry)
+
+    def put(self, key, data):
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save({k: v.cpu() for k, v in data.to_dict().items()}, tmp_path)
+        os.replace(tmp_path, path)
+
+
+# Featurizer of each worker process of `RNAGraphFeaturizer.featurize_many`
+_worker_featurizer = None
+
+
+def _init_featurize_worker(featurizer):
+    global _worker_featurizer
+    _worker_featurizer = featurizer
+    # One thread per worker process, as there is one process per CPU
+    torch.set_num_threads(1)
+
+
+def _featurize_worker(x):
+    return _featurize_input(_worker_featurizer, x)
+
+
+def _featurize_input(featurizer, x):
+    """
+    Featurized graph and raw RNA data of one input of `featurize_many`.
+    """
+    if isinstance(x, dict):
+        return featurizer(x), x
+    if isinstance(x, (list, tuple)):
+        return featurizer.featurize_from_pdb_filelist(x)
+    return featurizer.featurize_from_pdb_file(x)
+
+
+def node_budget_batches(results, max_nodes=None):
+    """
+    Collates featurized graphs into batches of consecutive graphs with at
+    most `max_nodes` nodes in total (all graphs in one batch if None).
+
+    Args:
+        results (iterable): tuples `(featurized_data, raw_data)`
+        max_nodes (int): maximum number of nodes per batch; graphs larger
+            than `max_nodes` are batched on their own
+    
+    Yields:
+        tuples `(batch, raw_data_list)` of `torch_geometric.data.Batch` and
+        the list of raw RNA data of its graphs
+    """
+    data_list, raw_list, num_nodes = [], [], 0
+    for data, raw in results:
+        if max_nodes is not None and data_list and num_nodes + data.num_nodes > max_nodes:
+            yield torch_geometric.data.Batch.from_data_list(data_list), raw_list
+            data_list, raw_list, num_nodes = [], [], 0
+        data_list.append(data)
+        raw_list.append(raw)
+        num_nodes += data.num_nodes
+    if data_list or max_nodes is None:
+        yield torch_geometric.data.Batch.from_data_list(data_list), raw_list
+
+
+def get_k_random_entries_and_masks(coords_list, k, rng=None):
     """
     Returns k random entries from a list of 3D coordinates, along with
     the corresponding masks (1 = valid, 0 = not valid).
@@ -226,6 +524,8 @@ def get_k_random_entries_and_masks(coords_list, k):
     Args:
         coords_list (list): List of np.array entries of 3D coordinates
         k (int): number of random entries to be selected from coords_list
+        rng (np.random.Generator): random number generator (defaults to
+            the global numpy random state)
     
     Returns:
         confs_list (np.array): Coordinates array of shape (k, num_residues, num_atoms, 3)
@@ -234,6 +534,7 @@ def get_k_random_entries_and_masks(coords_list, k):
     """
     n = len(coords_list)
     coords_list = np.array(coords_list)
+    rng = np.random if rng is None else rng
     # if k > n:
     #     # If k is greater than the length of the list,
     #     # return all the entries in the list and pad zeros up to k
@@ -244,14 +545,14 @@ def get_k_random_entries_and_masks(coords_list, k):
     if k > n:
         # If k is greater than the length of the list,
         # return all the entries in the list and pad random entries up to k
-        rand_idx = np.random.choice(n, size=k-n, replace=True)
+        rand_idx = rng.choice(n, size=k-n, replace=True)
         confs_list = np.concatenate((coords_list, coords_list[rand_idx]), axis=0)
         mask_coords = (coords_list == FILL_VALUE).sum(axis=(0,2,3)) == 0
         mask_confs = np.array([1]*k)
     else:
         # If k is less than or equal to the length of the list, 
         # randomly select k entries
-        rand_idx = np.random.choice(n, size=k, replace=False)
+        rand_idx = rng.choice(n, size=k, replace=False)
         confs_list =  coords_list[rand_idx]
         mask_coords = (confs_list == FILL_VALUE).sum(axis=(0,2,3)) == 0
         mask_confs = np.array([1]*k)
@@ -259,6 +560,47 @@ def get_k_random_entries_and_masks(coords_list, k):
     return confs_list, mask_coords, mask_confs
 
 
+def multi_conformer_knn_graph(centroids, top_k, return_edge_confs=False):
+    """
+    Union of the undirected K-nearest neighbour graphs of all conformers.
+
+    One batched kNN search is run over the nodes of all conformers (each
+    conformer is a graph of the batch), and edges are merged by sorting 
+    (src, dst) keys, so that the cost in Python does not grow with the
+    number of conformers. Equivalent to `to_undirected(coalesce(...))` of
+    the concatenated per-conformer kNN graphs, with edges in the same order.
+
+    Args:
+        centroids (Tensor): Node coordinates with shape `(num_conf, num_res, 3)`.
+        top_k (int): Number of neighbours per node and conformer.
+        return_edge_confs (bool): Whether to also return the edge provenance.
+
+    Returns:
+        edge_index (Tensor): Edge indices with shape `(2, num_edges)`, sorted
+            by source and destination node.
+        edge_confs (Tensor): Edge provenance with shape `(num_edges, num_conf)`,
+            `True` for the conformers whose kNN graph contains the edge (in
+            either direction); only if `return_edge_confs` is True.
+    """
+    num_conf, num_res, _ = centroids.shape
+    batch = torch.arange(num_conf, device=centroids.device).repeat_interleave(num_res)
+    edges = torch_cluster.knn_graph(centroids.reshape(num_conf * num_res, 3), top_k, batch=batch)
+
+    # Conformer and nodes of each edge, in both directions
+    conf = torch.cat([edges[0] // num_res] * 2)
+    src, dst = edges % num_res
+    src, dst = torch.cat([src, dst]), torch.cat([dst, src])
+
+    # Sort-based union of edges over conformers
+    keys, inverse = torch.unique(src * num_res + dst, sorted=True, return_inverse=True)
+    edge_index = torch.stack([keys // num_res, keys % num_res])
+    if not return_edge_confs:
+        return edge_index
+    edge_confs = torch.zeros(keys.shape[0], num_conf, dtype=torch.bool, device=centroids.device)
+    edge_confs[inverse, conf] = True
+    return edge_index, edge_confs
+
+
 def internal_coords(
     X: torch.Tensor,
     C: Optional[torch.Tensor] = None,
@@ -397,7 +739,8 @@ def normed_vec(V: torch.Tensor, distance_eps: float = DISTANCE_EPS) -> torch.Ten
     Returns:
         U (Tensor): Batch of normalized vectors with shape `(..., num_dims)`.
     """
-    # Unit vector from i to j
+    # Unit vector from i to j (in fp32, also under mixed precision)
+    V = V.float()
     mag_sq = (V ** 2).sum(dim=-1, keepdim=True)
     mag = torch.sqrt(mag_sq + distance_eps)
     U = V / mag
@@ -518,28 +861,56 @@ def dihedrals(
     return D
 
 
+def rbf_centers(
+        value_min: float = 0.0,
+        value_max: float = 30.0,
+        num_rbf: int = 32,
+        device = 'cpu',
+    ):
+    """
+    Centers of the radial basis functions of `rbf_expansion`.
+    """
+    return torch.linspace(value_min, value_max, num_rbf, device=device)
+
+
 def rbf_expansion(
         h: torch.Tensor,
         value_min: float = 0.0,
         value_max: float = 30.0,
         num_rbf: int = 32,
+        centers: Optional[torch.Tensor] = None,
     ):
-    rbf_centers = torch.linspace(value_min, value_max, num_rbf)
-    std = (rbf_centers[1] - rbf_centers[0]).item()
+    # Exponentials in fp32, also under mixed precision
+    h = h.float()
+    # Centers are recomputed if not precomputed with `rbf_centers`
+    if centers is None:
+        centers = rbf_centers(value_min, value_max, num_rbf, device=h.device)
+    # Spacing of the centers (without reading it back from the device)
+    std = (value_max - value_min) / (num_rbf - 1)
     shape = list(h.shape)
     shape_ones = [1 for _ in range(len(shape))] + [-1]
-    rbf_centers = rbf_centers.view(shape_ones)
-    h = torch.exp(-(((h.unsqueeze(-1) - rbf_centers) / std) ** 2))
+    centers = centers.view(shape_ones)
+    h = torch.exp(-(((h.unsqueeze(-1) - centers) / std) ** 2))
     h = h.view(shape[:-1] + [-1])
     return h
 
 
-def positional_encoding(inputs, num_posenc=32, period_range=(1.0, 1000.0)):
-    
+def posenc_frequencies(num_posenc=32, period_range=(1.0, 1000.0), device='cpu'):
+    """
+    Angular frequencies of the sinusoids of `positional_encoding`.
+    """
     num_frequencies = num_posenc // 2
     log_bounds = np.log10(period_range)
-    p = torch.logspace(log_bounds[0], log_bounds[1], num_frequencies, base=10.0)
-    w = 2 * math.pi / p
+    p = torch.logspace(log_bounds[0], log_bounds[1], num_frequencies, base=10.0, device=device)
+    return 2 * math.pi / p
+
+
+def positional_encoding(inputs, num_posenc=32, period_range=(1.0, 1000.0), frequencies=None):
+    
+    # Frequencies are recomputed if not precomputed with `posenc_frequencies`
+    w = frequencies
+    if w is None:
+        w = posenc_frequencies(num_posenc, period_range, device=inputs.device)
     
     batch_dims = list(inputs.shape)[:-1]
     # (..., 1, num_out) * (..., num_in, 1)
@@ -10,6 +10,7 @@ import wandb
 
 import torch
 import torch.nn.functional as F
+import torch_geometric
 from torchmetrics.functional.classification import binary_matthews_corrcoef
 
 from Bio import SeqIO
@@ -20,6 +21,7 @@ from MDAnalysis.analysis.align import rotation_matrix
 from MDAnalysis.analysis.rms import rmsd as get_rmsd
 
 from src.data.data_utils import pdb_to_tensor, get_c4p_coords
+from src.precision import autocast
 from src.data.sec_struct_utils import (
     predict_sec_struct,
     dotbracket_to_paired,
@@ -51,7 +53,9 @@ def evaluate(
         beam_width=2,
         beam_branch=6,
         max_temperature=0.5,
-        temperature_factor=0.01
+        temperature_factor=0.01,
+        precision='fp32',
+        batch_size=1
     ):
     """
     Run evaluation suite for trained RNA inverse folding model on a dataset.
@@ -85,6 +89,11 @@ def evaluate(
         sampling_value: value for sampling strategy
         beam_width: number of beams to maintain during search
         beam_branch: number of samples to get from sampling strategy
+        precision: 'fp32', or 'bf16'/'fp16' to sample in mixed precision
+        batch_size: number of data points whose designs are sampled in one batched
+            pass of the model, see `sample_batches` (designs are not identical
+            across batch sizes, as random numbers are drawn for all data points
+            of a batch jointly)
     
     Returns: Dictionary with the following keys:
         df: DataFrame with metrics and metadata per residue per sample for analysis and plotting
@@ -163,33 +172,33 @@ def evaluate(
             rhofold = ipex.optimize(rhofold)
     
     with torch.no_grad():
-        for idx, raw_data in tqdm(
-            enumerate(dataset.data_list),
-            total=len(dataset.data_list)
-        ):
-            # featurise raw data
-            data = dataset.featurizer(raw_data).to(device)
-
-            # sample n_samples from model for single data point: n_samples x seq_len
-            samples, logits = model.sample(
-                data,
+        # n_samples designs per data point: n_samples x seq_len, sampled 
+        # for batch_size data points at a time
+        for idx, raw_data, data, samples, logits in tqdm(
+            sample_batches(
+                model,
+                dataset,
                 n_samples,
                 temperature,
-                return_logits=True,
+                device,
+                batch_size=batch_size,
+                precision=precision,
                 beam_width=beam_width,
                 beam_branch=beam_branch,
                 sampling_strategy=sampling_strategy,
                 sampling_value=sampling_value,
                 max_temperature=max_temperature,
                 temperature_factor=temperature_factor
-            )
+            ),
+            total=len(dataset.data_list)
+        ):
             samples_list.append(samples.cpu().numpy())
             
             # perplexity per sample: n_samples x 1
             n_nodes = logits.shape[1]
             perplexity = torch.exp(F.cross_entropy(
-                logits.view(n_samples * n_nodes, model.out_dim), 
-                samples.view(n_samples * n_nodes).long(), 
+                logits.reshape(n_samples * n_nodes, model.out_dim), 
+                samples.reshape(n_samples * n_nodes).long(), 
                 reduction="none"
             ).view(n_samples, n_nodes).mean(dim=1)).cpu().numpy()
             perplexity_list.append(perplexity.mean())
@@ -380,6 +389,49 @@ def evaluate(
     return out
 
 
+@torch.no_grad()
+def sample_batches(model, dataset, n_samples, temperature, device, batch_size=1, precision='fp32', **kwargs):
+    """
+    Samples designs for each data point of a dataset, featurizing and 
+    collating `batch_size` data points at a time into a 
+    `torch_geometric.data.Batch` decoded in one call of `model.sample`.
+
+    Note that `model.sample` returns lists of samples and logits with one
+    entry per graph for any `Batch`, even of a single graph (tensors are
+    only returned for a single `Data`); designs are yielded per data point.
+
+    Args:
+        model: autoregressive RNA inverse folding model
+        dataset: dataset with `data_list` of raw data and a `featurizer`
+        n_samples: number of samples per data point
+        temperature: sampling temperature
+        device: device to run sampling on
+        batch_size: number of data points per batch
+        precision: 'fp32', or 'bf16'/'fp16' to sample in mixed precision
+        **kwargs: further sampling arguments of `model.sample`
+
+    Yields:
+        idx (int): index of the data point
+        raw_data (dict): raw data of the data point
+        data (torch_geometric.data.Data): featurized data point
+        samples (torch.Tensor): designs of shape (n_samples, seq_len)
+        logits (torch.Tensor): logits of shape (n_samples, seq_len, 4)
+    """
+    data_list = dataset.data_list
+    for start in range(0, len(data_list), batch_size):
+        raw_batch = data_list[start:start + batch_size]
+        featurized_batch = [dataset.featurizer(raw_data).to(device) for raw_data in raw_batch]
+        with autocast(device, precision):
+            samples, logits = model.sample(
+                torch_geometric.data.Batch.from_data_list(featurized_batch),
+                n_samples,
+                temperature,
+                return_logits=True,
+                **kwargs
+            )
+        yield from zip(range(start, start + len(raw_batch)), raw_batch, featurized_batch, samples, logits)
+
+
 def self_consistency_score_eternafold(
         samples, 
         true_sec_struct_list, 
@@ -0,0 +1,418 @@
+################################################################
+# Export-ready encoder and single-step decoder of gRNAde
+# (AutoregressiveMultiGNNv2) with flat tensor signatures,
+# for serving under TorchScript or ONNX runtimes.
+################################################################
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from src.layers import tuple_cat
+from src.models import edge_input_features
+
+
+class EncoderExport(nn.Module):
+    """
+    Encoder of a trained `AutoregressiveMultiGNNv2` (input embeddings `W_v`
+    and `W_e`, encoder layers and multi-conformation pooling) for one RNA
+    backbone, with flat tensor inputs and outputs.
+
+    Shares the modules (and weights) of `model`, but replaces the operations
+    that cannot be traced or exported: fused and chunked message passing
+    becomes a plain gather/scatter over all edges, and attention within each
+    conformation is computed densely for all conformations at once, with
+    padded conformations masked, instead of over blocks of graphs.
+
+    The number of nodes and edges is dynamic in exported graphs, while the
+    number of conformations is fixed at export time (pooling is skipped for
+    a single conformation).
+
+    Args:
+        model (AutoregressiveMultiGNNv2): trained model in eval mode, with
+            'dense' attention (chunked attention is exported densely)
+    """
+    INPUT_NAMES = ['node_s', 'node_v', 'edge_s', 'edge_v', 'edge_posenc', 'edge_index', 'mask_confs']
+    OUTPUT_NAMES = ['h_V_s', 'h_V_v', 'h_E_s', 'h_E_v']
+    DYNAMIC_AXES = {
+        'node_s': {0: 'n_nodes'}, 'node_v': {0: 'n_nodes'},
+        'edge_s': {0: 'n_edges'}, 'edge_v': {0: 'n_edges'}, 'edge_posenc': {0: 'n_edges'},
+        'edge_index': {1: 'n_edges'}, 'mask_confs': {0: 'n_nodes'},
+        'h_V_s': {0: 'n_nodes'}, 'h_V_v': {0: 'n_nodes'},
+        'h_E_s': {0: 'n_edges'}, 'h_E_v': {0: 'n_edges'},
+    }
+
+    def __init__(self, model):
+        super().__init__()
+        check_exportable(model)
+        self.model = model
+
+    def forward(self, node_s, node_v, edge_s, edge_v, edge_posenc, edge_index, mask_confs):
+        """
+        Args:
+            node_s, node_v: node features [n_nodes, n_conf, d_s_in], [n_nodes, n_conf, d_v_in, 3]
+            edge_s, edge_v: edge features [n_edges, n_conf, d_se_in - num_posenc], [n_edges, n_conf, d_ve_in, 3]
+            edge_posenc: edge positional encodings [n_edges, num_posenc]
+            edge_index: edge indices [2, n_edges]
+            mask_confs: mask of valid conformations [n_nodes, n_conf]
+
+        Returns:
+            Pooled node features h_V_s [n_nodes, d_s], h_V_v [n_nodes, d_v, 3]
+            and edge features h_E_s [n_edges, d_se], h_E_v [n_edges, d_ve, 3],
+            as returned by `model.encode`
+        """
+        h_V = self.model.W_v((node_s, node_v))
+        h_E = self.model.W_e(edge_input_features(edge_s, edge_v, edge_posenc))
+
+        keep = mask_confs.t().bool()  # [n_conf, n_nodes]
+        for layer in self.model.encoder_layers:
+            h_V = encoder_layer(layer, h_V, edge_index, h_E, keep)
+
+        (h_V_s, h_V_v), (h_E_s, h_E_v) = self.model.pool_multi_conf(
+            h_V, h_E, mask_confs, edge_index, moment_chunk_size=None)
+        return h_V_s, h_V_v, h_E_s, h_E_v
+
+    @staticmethod
+    def example_inputs(data):
+        """
+        Inputs of `forward` for a featurized RNA backbone (`torch_geometric.data.Data`).
+        """
+        return (data.node_s, data.node_v, data.edge_s, data.edge_v, data.edge_posenc, data.edge_index, data.mask_confs)
+
+
+class DecoderStepExport(nn.Module):
+    """
+    One autoregressive decoding step of a trained `AutoregressiveMultiGNNv2`,
+    i.e. the decoder layers and output layer `W_out` for the current position
+    of `n_copies` sequences, with flat tensor inputs and outputs.
+
+    The step is a pure function of its inputs: node features of decoded
+    positions and attention keys/values of previous positions are gathered
+    from the caller's caches, and the new node features, keys and values are
+    returned for the caller to write back, so that the sampling loop (token
+    choice, beam search, caching) stays outside of the exported graph, as in
+    `teacher_forced_decode`. Equivalent to `AttentiveGVPLayer.decode_step`
+    with a key/value cache.
+
+    The number of copies, incoming edges and previous positions is dynamic
+    in exported graphs.
+
+    Args:
+        model (AutoregressiveMultiGNNv2): trained model in eval mode, with
+            'dense' attention (chunked attention is exported densely)
+    """
+    INPUT_NAMES = [
+        'node_s', 'node_v', 'src_s', 'src_v', 'edge_s', 'edge_v',
+        'src_tokens', 'src_decoded', 'edge_dst', 'keys', 'values',
+    ]
+    OUTPUT_NAMES = ['logits', 'out_s', 'out_v', 'new_keys', 'new_values']
+    DYNAMIC_AXES = {
+        'node_s': {0: 'n_copies'}, 'node_v': {0: 'n_copies'},
+        'src_s': {1: 'n_edges'}, 'src_v': {1: 'n_edges'},
+        'edge_s': {0: 'n_edges'}, 'edge_v': {0: 'n_edges'},
+        'src_tokens': {0: 'n_edges'}, 'src_decoded': {0: 'n_edges'}, 'edge_dst': {0: 'n_edges'},
+        'keys': {1: 'n_copies', 3: 'length'}, 'values': {1: 'n_copies', 3: 'length'},
+        'logits': {0: 'n_copies'}, 'out_s': {1: 'n_copies'}, 'out_v': {1: 'n_copies'},
+        'new_keys': {1: 'n_copies'}, 'new_values': {1: 'n_copies'},
+    }
+
+    def __init__(self, model):
+        super().__init__()
+        check_exportable(model)
+        self.model = model
+
+    def forward(self, node_s, node_v, src_s, src_v, edge_s, edge_v,
+                src_tokens, src_decoded, edge_dst, keys, values):
+        """
+        Args:
+            node_s, node_v: pooled encoder features of the current position of each copy
+                [n_copies, d_s], [n_copies, d_v, 3]
+            src_s, src_v: input features of each decoder layer at the source node of
+                each incoming edge of the current positions (pooled encoder features
+                for the first layer) [n_layers, n_edges, d_s], [n_layers, n_edges, d_v, 3]
+            edge_s, edge_v: pooled encoder features of the incoming edges
+                [n_edges, d_se], [n_edges, d_ve, 3]
+            src_tokens: decoded token at the source node of each edge [n_edges]
+                (ignored for sources which are not decoded yet)
+            src_decoded: whether the source node of each edge is decoded [n_edges]
+                (i.e. src < dst, messages from other nodes use encoder features only)
+            edge_dst: copy of the destination node of each edge [n_edges]
+            keys, values: attention keys/values of previous positions per decoder layer
+                [n_layers, n_copies, n_heads, length, head_dim] and
+                [n_layers, n_copies, n_heads, length, d_s]
+
+        Returns:
+            logits of the current position [n_copies, out_dim], output features of
+            each decoder layer out_s [n_layers, n_copies, d_s] and out_v
+            [n_layers, n_copies, d_v, 3] (inputs of the next layer at the current
+            position), and keys/values of the current position per decoder layer
+            new_keys [n_layers, n_copies, n_heads, head_dim] and new_values
+            [n_layers, n_copies, n_heads, d_s]
+        """
+        enc = (node_s, node_v)
+        enc_src = (src_s[0], src_v[0])
+        decoded = src_decoded.bool()
+
+        # Zero out embeddings of tokens not decoded yet
+        h_S = self.model.W_s(src_tokens) * decoded.unsqueeze(-1).to(edge_s.dtype)
+        edge_attr = (torch.cat([edge_s, h_S], dim=-1), edge_v)
+
+        x = enc
+        outs, new_keys, new_values = [], [], []
+        for j, layer in enumerate(self.model.decoder_layers):
+            x, k, v = decoder_layer_step(
+                layer, x, (src_s[j], src_v[j]), enc, enc_src,
+                edge_attr, decoded, edge_dst, keys[j], values[j]
+            )
+            outs.append(x)
+            new_keys.append(k)
+            new_values.append(v)
+
+        logits = self.model.W_out(x)
+        out_s = torch.stack([s for s, _ in outs])
+        out_v = torch.stack([v for _, v in outs])
+        return logits, out_s, out_v, torch.stack(new_keys), torch.stack(new_values)
+
+    @staticmethod
+    def example_inputs(model, h_V, h_E, edge_index, seq, i):
+        """
+        Inputs of `forward` for position `i` of one copy of a backbone with
+        pooled encoder features `h_V`, `h_E`, using encoder features in place
+        of the node and attention caches (e.g. for tracing).
+        """
+        n_layers = len(model.decoder_layers)
+        attention = model.decoder_layers[0].attention_branch
+        node_cache = (h_V[0].unsqueeze(0).expand(n_layers, -1, -1), h_V[1].unsqueeze(0).expand(n_layers, -1, -1, -1))
+        keys = h_V[0].new_zeros(n_layers, 1, attention.n_heads, i, attention.head_dim)
+        values = h_V[0].new_zeros(n_layers, 1, attention.n_heads, i, attention.node_h_dim)
+        return decoder_step_inputs(h_V, h_E, edge_index, seq, i, node_cache, keys, values)
+
+
+def check_exportable(model):
+    """
+    Raises a `ValueError` if `model` has no export-ready variant.
+    """
+    if not hasattr(model, 'moment_pooling'):
+        raise ValueError(f"Export is only supported for AutoregressiveMultiGNNv2, got {type(model).__name__}")
+    if any(layer.attention.mode != 'dense' for layer in model.encoder_layers) or \
+            any(layer.attention_branch.mode != 'dense' for layer in model.decoder_layers):
+        raise ValueError("Export is only supported for 'dense' attention")
+
+
+def message_passing(message_func, x, edge_index, edge_attr, aggr="mean"):
+    '''
+    Unfused equivalent of `gvp_message_passing` over all edges at once,
+    with scatters that can be exported (for equal input and output
+    node dimensions, as in all GVP convolutions of the models).
+    '''
+    s, v = x
+    src, dst = edge_index
+    m_s, m_v = message_func(tuple_cat((s[src], v[src]), edge_attr, (s[dst], v[dst])))
+
+    out_s = torch.zeros_like(s).scatter_add(0, _expand_index(dst, m_s), m_s)
+    out_v = torch.zeros_like(v).scatter_add(0, _expand_index(dst, m_v), m_v)
+    if aggr == "mean":
+        count = torch.zeros_like(s[..., 0]).scatter_add(0, _expand_index(dst, m_s[..., 0]), torch.ones_like(m_s[..., 0]))
+        count = count.clamp(min=1).unsqueeze(-1)
+        out_s, out_v = out_s / count, out_v / count.unsqueeze(-1)
+    return out_s, out_v
+
+
+def encoder_layer(layer, x, edge_index, edge_attr, keep):
+    """
+    Export-ready equivalent of `MultiAttentiveGVPLayer.forward` (in eval mode)
+    for one graph, with dense attention within each conformation.
+
+    Args:
+        layer (MultiAttentiveGVPLayer): encoder layer
+        x (tuple): node features [n_nodes, n_conf, d_s], [n_nodes, n_conf, d_v, 3]
+        edge_index (torch.Tensor): edge indices [2, n_edges]
+        edge_attr (tuple): edge features [n_edges, n_conf, d_se], [n_edges, n_conf, d_ve, 3]
+        keep (torch.Tensor): mask of valid conformations [n_conf, n_nodes]
+    """
+    s, v = x
+    out_s, out_v = s, v
+    if layer.norm_first:
+        s, v = layer.norm((s, v))
+
+    conv_s, conv_v = message_passing(layer.conv.message_func, (s, v), edge_index, edge_attr, aggr=layer.conv.aggr)
+
+    # Attention within each conformation, over its valid nodes
+    attention = layer.attention
+    n_conf, d_s = s.shape[1], s.shape[2]
+    Q, K, V = attention.project((s.transpose(0, 1).flatten(0, 1), v.transpose(0, 1).flatten(0, 1)))
+    # [n_conf * n_nodes, n_heads, dim] -> [n_conf, n_heads, n_nodes, dim]
+    Q, K, V = (t.view(n_conf, -1, t.shape[1], t.shape[2]).transpose(1, 2) for t in (Q, K, V))
+    scores = torch.matmul(Q, K.transpose(-2, -1)).float() * attention.scale
+    scores = scores.masked_fill(~keep[:, None, None, :], -1e9)
+    attn_weights = F.softmax(scores, dim=-1, dtype=torch.float32)
+    h_prime = torch.matmul(attn_weights, V).transpose(1, 2)  # [n_conf, n_nodes, n_heads, d_s]
+    attn_s = attention.output(h_prime.flatten(0, 1)).view(n_conf, -1, d_s)
+    # Padded conformations have no attention output
+    attn_s = (attn_s * keep.unsqueeze(-1).to(attn_s.dtype)).transpose(0, 1)
+
+    out_s = out_s + 0.5 * conv_s + 0.5 * attn_s
+    out_v = out_v + conv_v
+    if not layer.norm_first:
+        out_s, out_v = layer.norm((out_s, out_v))
+    return out_s, out_v
+
+
+def decoder_layer_step(layer, x, x_src, enc, enc_src, edge_attr, decoded, edge_dst, keys, values):
+    """
+    Export-ready equivalent of `AttentiveGVPLayer.decode_step` (in eval mode)
+    for the current position of each copy.
+
+    Args:
+        layer (AttentiveGVPLayer): decoder layer
+        x (tuple): layer inputs at the current positions [n_copies, d_s], [n_copies, d_v, 3]
+        x_src (tuple): layer inputs at the source nodes of incoming edges
+        enc (tuple): encoder features at the current positions
+        enc_src (tuple): encoder features at the source nodes of incoming edges
+        edge_attr (tuple): features of incoming edges, with token embeddings
+        decoded (torch.Tensor): whether the source node of each edge is decoded [n_edges]
+        edge_dst (torch.Tensor): copy of the destination node of each edge [n_edges]
+        keys, values (torch.Tensor): keys/values of previous positions
+            [n_copies, n_heads, length, dim]
+
+    Returns:
+        tuple: layer outputs at the current positions, and their keys and values
+    """
+    conv_layer = layer.gvp_branch
+    h, h_src = x, x_src
+    if layer.norm_first:
+        h, h_src = layer.norm(h), layer.norm(h_src)
+
+    # Branch A: messages from decoded nodes use the current layer's (normalized)
+    # inputs, and messages from other nodes the encoder features, at both ends
+    mask_s, mask_v = decoded.view(-1, 1), decoded.view(-1, 1, 1)
+    src = (torch.where(mask_s, h_src[0], enc_src[0]), torch.where(mask_v, h_src[1], enc_src[1]))
+    dst = (torch.where(mask_s, h[0][edge_dst], enc[0][edge_dst]),
+           torch.where(mask_v, h[1][edge_dst], enc[1][edge_dst]))
+    m_s, m_v = conv_layer.conv.message_func(tuple_cat(src, edge_attr, dst))
+    dh_s = torch.zeros_like(h[0]).scatter_add(0, _expand_index(edge_dst, m_s), m_s)
+    dh_v = torch.zeros_like(h[1]).scatter_add(0, _expand_index(edge_dst, m_v), m_v)
+    count = torch.zeros_like(h[0][:, 0]).scatter_add(0, edge_dst, torch.ones_like(m_s[:, 0]))
+    count = count.clamp(min=1).unsqueeze(-1)
+    dh = (dh_s / count, dh_v / count.unsqueeze(-1))
+
+    gvp = h
+    if conv_layer.norm_first:
+        gvp = (gvp[0] + dh[0], gvp[1] + dh[1])
+        ff_s, ff_v = conv_layer.ff_func(conv_layer.norm[1](gvp))
+        gvp = (gvp[0] + ff_s, gvp[1] + ff_v)
+    else:
+        gvp = conv_layer.norm[0]((gvp[0] + dh[0], gvp[1] + dh[1])) if conv_layer.residual else dh
+        ff_s, ff_v = conv_layer.ff_func(gvp)
+        gvp = conv_layer.norm[1]((gvp[0] + ff_s, gvp[1] + ff_v)) if conv_layer.residual else (ff_s, ff_v)
+
+    # Branch B: attention over previous positions and the current one
+    attention = layer.attention_branch
+    Q, K, V = attention.project(h)
+    K_all = torch.cat([keys, K.unsqueeze(2)], dim=2)
+    V_all = torch.cat([values, V.unsqueeze(2)], dim=2)
+    scores = torch.einsum('chd,chld->chl', Q, K_all) * attention.scale
+    attn_weights = F.softmax(scores, dim=-1, dtype=torch.float32)
+    attn_s = attention.output(torch.einsum('chl,chld->chd', attn_weights, V_all))
+
+    out_s = x[0] + 0.5 * gvp[0] + 0.5 * attn_s
+    out_v = x[1] + gvp[1]
+    if not layer.norm_first:
+        out_s, out_v = layer.norm((out_s, out_v))
+    ff_s, ff_v = layer.ff_func((out_s, out_v))
+    out = layer.final_norm((out_s + ff_s, out_v + ff_v))
+    return out, K, V
+
+
+def decoder_step_inputs(h_V, h_E, edge_index, seq, i, node_cache, keys, values):
+    """
+    Inputs of `DecoderStepExport.forward` for position `i` of one copy of a
+    backbone, gathered from its caches.
+
+    Args:
+        h_V, h_E (tuple): pooled encoder features of nodes and edges
+        edge_index (torch.Tensor): edge indices [2, n_edges]
+        seq (torch.Tensor): decoded tokens (at positions before `i`) [n_nodes]
+        i (int): position to decode
+        node_cache (tuple): inputs of each decoder layer at all nodes
+            [n_layers, n_nodes, d_s], [n_layers, n_nodes, d_v, 3]
+        keys, values (torch.Tensor): attention keys/values of positions before `i`
+            [n_layers, 1, n_heads, i, dim]
+    """
+    edge_ids = (edge_index[1] == i).nonzero().flatten()
+    src = edge_index[0, edge_ids]
+    return (
+        h_V[0][i:i + 1], h_V[1][i:i + 1],
+        node_cache[0][:, src], node_cache[1][:, src],
+        h_E[0][edge_ids], h_E[1][edge_ids],
+        seq[src], src < i, torch.zeros_like(src),
+        keys, values,
+    )
+
+
+@torch.no_grad()
+def teacher_forced_decode(step, model, h_V, h_E, edge_index, seq):
+    """
+    Logits of all positions of `seq`, decoded one position at a time with
+    a (possibly exported) `DecoderStepExport` of `model`, caching node 
+    features and attention keys/values of decoded positions. This is the
+    reference decoding loop for serving, and should match `model.decode`
+    (which computes all positions at once).
+
+    Args:
+        step (callable): `DecoderStepExport` or its TorchScript/ONNX export
+        model (AutoregressiveMultiGNNv2): model of `step`
+        h_V, h_E (tuple): pooled encoder features of nodes and edges
+        edge_index (torch.Tensor): edge indices [2, n_edges]
+        seq (torch.Tensor): tokens of shape [n_nodes]
+
+    Returns:
+        logits (torch.Tensor): logits of shape [n_nodes, out_dim]
+    """
+    n_nodes, n_layers = h_V[0].shape[0], len(model.decoder_layers)
+    attention = model.decoder_layers[0].attention_branch
+    node_cache = (h_V[0].unsqueeze(0).repeat(n_layers, 1, 1), h_V[1].unsqueeze(0).repeat(n_layers, 1, 1, 1))
+    keys = h_V[0].new_zeros(n_layers, 1, attention.n_heads, n_nodes, attention.head_dim)
+    values = h_V[0].new_zeros(n_layers, 1, attention.n_heads, n_nodes, attention.node_h_dim)
+    logits = []
+    for i in range(n_nodes):
+        lgts, out_s, out_v, new_keys, new_values = step(*decoder_step_inputs(
+            h_V, h_E, edge_index, seq, i, node_cache, keys[:, :, :, :i], values[:, :, :, :i]))
+        # Outputs of each layer are the inputs of the next one
+        node_cache[0][1:, i], node_cache[1][1:, i] = out_s[:-1, 0], out_v[:-1, 0]
+        keys[:, :, :, i], values[:, :, :, i] = new_keys, new_values
+        logits.append(lgts)
+    return torch.cat(logits)
+
+
+def _expand_index(index, src):
+    """
+    Expands an index over the first dimension to the shape of `src`, for `scatter_add`.
+    """
+    return index.view((-1,) + (1,) * (src.dim() - 1)).expand_as(src)
+
+
+def export_torchscript(module, example_inputs, path):
+    """
+    Traces an export-ready module (`EncoderExport` or `DecoderStepExport`)
+    to TorchScript and saves it to `path`.
+
+    Returns:
+        torch.jit.ScriptModule: traced module
+    """
+    traced = torch.jit.trace(module.eval(), example_inputs, check_trace=False)
+    traced.save(path)
+    return traced
+
+
+def export_onnx(module, example_inputs, path, opset_version=17):
+    """
+    Exports an export-ready module (`EncoderExport` or `DecoderStepExport`)
+    to ONNX at `path`, with dynamic numbers of nodes, edges, copies and
+    decoded positions (see `DYNAMIC_AXES` of each module).
+    """
+    torch.onnx.export(
+        module.eval(), example_inputs, path,
+        input_names=module.INPUT_NAMES, output_names=module.OUTPUT_NAMES,
+        dynamic_axes=module.DYNAMIC_AXES, opset_version=opset_version
+    )
@@ -9,8 +9,8 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 import torch_geometric
-from torch_geometric.nn import MessagePassing
 from torch_scatter import scatter_add
+from torch_geometric.utils import softmax as scatter_softmax
 
 
 #########################################################################
@@ -29,14 +29,25 @@ class GraphAttentionLayer(nn.Module):
         dropout (float): Dropout probability for attention weights
         concat (bool): Whether to concatenate outputs from different heads
                        or average them
+        chunk_size (int, optional): If given, attention is computed over tiles
+                       of `chunk_size` queries and keys with an online softmax, 
+                       so that no [n_nodes, n_nodes] score matrix is materialized
+        mode (str): 'dense' to attend over all pairs of nodes (of the same graph),
+                    or 'edge' to only attend over the incoming edges of each node 
+                    (and itself), with a softmax over incoming edges per node; 
+                    the cost of 'edge' attention scales with the number of edges
     """
-    def __init__(self, node_h_dim, vector_h_dim=0, n_heads=4, dropout=0.1, concat=False):
+    def __init__(self, node_h_dim, vector_h_dim=0, n_heads=4, dropout=0.1, concat=False, chunk_size=None, mode='dense'):
         super().__init__()
         
+        if mode not in ('dense', 'edge'):
+            raise ValueError(f"Unknown attention mode: {mode}")
         self.node_h_dim = node_h_dim
         self.vector_h_dim = vector_h_dim
         self.n_heads = n_heads
         self.concat = concat
+        self.chunk_size = chunk_size
+        self.mode = mode
         
         # Combined dimension for attention calculation (scalar + vector norms)
         self.combined_dim = node_h_dim + (vector_h_dim if vector_h_dim > 0 else 0)
@@ -64,7 +75,7 @@ class GraphAttentionLayer(nn.Module):
         # Scale factor for dot product attention
         self.scale = self.head_dim ** -0.5
         
-    def forward(self, x, mask=None):
+    def forward(self, x, mask=None, blocks=None, causal=False, edge_index=None):
         """
         Forward pass of the attention layer with vector norm incorporation.
         
@@ -74,6 +85,13 @@ class GraphAttentionLayer(nn.Module):
                         node_v has shape [n_nodes, d_v, 3] or None
             mask (torch.Tensor, optional): Attention mask of shape [n_nodes, n_nodes] or [n_heads, n_nodes, n_nodes].
                                          Values to mask should be set to a large negative number (e.g., -1e9).
+            blocks (list, optional): blocks of graphs from `graph_blocks`; if given, 
+                                     nodes only attend to nodes of the same graph and
+                                     attention is computed per block of graphs 
+                                     (replaces `mask`)
+            causal (bool): whether nodes only attend to previous nodes (of their graph)
+            edge_index (torch.Tensor, optional): edge indices [2, n_edges] to attend 
+                                                 over in 'edge' mode (required)
         
         Returns:
             tuple: Updated (node_s, node_v) tuple after attention
@@ -84,40 +102,43 @@ class GraphAttentionLayer(nn.Module):
         # Shape info
         n_nodes = s.shape[0]  # Number of nodes
         
-        # Create combined features with vector norms
-        if v is not None and self.vector_h_dim > 0:
-            # Calculate vector norms [n_nodes, d_v]
-            v_norms = torch.norm(v, dim=2)
-            
-            # Concatenate scalar features with vector norms [n_nodes, d_s + d_v]
-            combined_features = torch.cat([s, v_norms], dim=1)
-        else:
-            combined_features = s
-        
-        # Linear projections for query, key using combined features
-        # [n_nodes, combined_dim] -> [n_nodes, n_heads * head_dim]
-        Q = self.W_Q(combined_features)
-        K = self.W_K(combined_features)
-        
-        # For values, we still use only scalar features
-        # [n_nodes, d_s] -> [n_nodes, n_heads * node_h_dim]
-        V = self.W_V(s)
-        
-        # Reshape for multi-head attention
-        # [n_nodes, n_heads * head_dim] -> [n_nodes, n_heads, head_dim]
-        Q = Q.view(n_nodes, self.n_heads, self.head_dim)
-        K = K.view(n_nodes, self.n_heads, self.head_dim)
-        V = V.view(n_nodes, self.n_heads, self.node_h_dim)
+        # [n_nodes, n_heads, head_dim], [n_nodes, n_heads, head_dim], [n_nodes, n_heads, node_h_dim]
+        Q, K, V = self.project(x)
+
+        if self.mode == 'edge':
+            # Attention over incoming edges and self loops: [n_nodes, n_heads, node_h_dim]
+            src, dst = edge_index
+            keep = src < dst if causal else src != dst
+            nodes = torch.arange(n_nodes, device=s.device)
+            src, dst = torch.cat([src[keep], nodes]), torch.cat([dst[keep], nodes])
+            h_prime = self.edge_attention(Q, K[src], V[src], dst)
+            s_out = self.output(h_prime)  # [n_nodes, node_h_dim]
+            return (s_out, v)
+
+        if blocks is not None:
+            # Attention within each graph: [n_nodes, n_heads, node_h_dim]
+            h_prime = self.block_attention(Q, K, V, blocks, causal)
+            s_out = self.output(h_prime)  # [n_nodes, node_h_dim]
+            return (s_out, v)
         
         # Transpose for batch matrix multiply
         # [n_nodes, n_heads, dim] -> [n_heads, n_nodes, dim]
         Q = Q.permute(1, 0, 2)
         K = K.permute(1, 0, 2)
         V = V.permute(1, 0, 2)
+
+        if self.chunk_size is not None:
+            # Tiled attention: [n_heads, n_nodes, node_h_dim] -> [n_nodes, n_heads, node_h_dim]
+            h_prime = self.chunked_attention(Q, K, V, mask=mask, causal=causal)
+            s_out = self.output(h_prime.permute(1, 0, 2))  # [n_nodes, node_h_dim]
+            return (s_out, v)
         
         # Scaled dot-product attention
         # [n_heads, n_nodes, head_dim] @ [n_heads, head_dim, n_nodes] -> [n_heads, n_nodes, n_nodes]
         scores = torch.bmm(Q, K.transpose(-2, -1)) * self.scale
+
+        if causal:
+            scores = scores + create_causal_mask(n_nodes, Q.device)
         
         # Apply attention mask if provided
         if mask is not None:
@@ -126,8 +147,8 @@ class GraphAttentionLayer(nn.Module):
                 mask = mask.unsqueeze(0).expand(self.n_heads, -1, -1)
             scores = scores + mask
         
-        # Softmax to get attention weights
-        attn_weights = F.softmax(scores, dim=-1)
+        # Softmax to get attention weights (in fp32 under mixed precision)
+        attn_weights = F.softmax(scores, dim=-1, dtype=torch.float32)
         attn_weights = self.dropout(attn_weights)
         
         # Apply attention weights to values
@@ -139,16 +160,338 @@ class GraphAttentionLayer(nn.Module):
         h_prime = h_prime.permute(1, 0, 2)
         
         # Final output projection
+        s_out = self.output(h_prime)  # [n_nodes, node_h_dim]
+        
+        return (s_out, v)  # Return updated scalars and original vectors
+
+    def block_attention(self, Q, K, V, blocks, causal=False):
+        """
+        Scaled dot-product attention restricted to nodes of the same graph.
+
+        Graphs of each block are padded to the size of the largest graph of
+        the block, so that memory scales with the sum of squared graph sizes 
+        rather than the squared number of nodes in the batch.
+
+        Args:
+            Q, K, V (torch.Tensor): projections from `project` of shapes 
+                [n_nodes, n_heads, head_dim], [n_nodes, n_heads, head_dim]
+                and [n_nodes, n_heads, node_h_dim]
+            blocks (list): blocks of graphs from `graph_blocks`
+            causal (bool): whether nodes only attend to previous nodes of their graph
+
+        Returns:
+            torch.Tensor: attended values of shape [n_nodes, n_heads, node_h_dim]
+        """
+        h_prime = V.new_zeros(V.shape)
+        for index, valid in blocks:
+            max_len = index.shape[1]
+            # [n_graphs, max_len, n_heads, dim] -> [n_graphs, n_heads, max_len, dim]
+            Q_b, K_b, V_b = (t[index].transpose(1, 2) for t in (Q, K, V))
+
+            if self.chunk_size is not None:
+                h_b = self.chunked_attention(Q_b, K_b, V_b, key_valid=valid, causal=causal)
+            else:
+                # [n_graphs, n_heads, max_len, max_len]
+                scores = torch.matmul(Q_b, K_b.transpose(-2, -1)).float() * self.scale
+                # Mask padding nodes (and later nodes, if causal)
+                mask = ~valid[:, None, None, :]
+                if causal:
+                    mask = mask | torch.ones(max_len, max_len, dtype=torch.bool, device=Q.device).triu(diagonal=1)
+                scores = scores.masked_fill(mask, -1e9)
+
+                attn_weights = F.softmax(scores, dim=-1, dtype=torch.float32)
+                attn_weights = self.dropout(attn_weights)
+                h_b = torch.matmul(attn_weights, V_b)
+
+            # [n_graphs, n_heads, max_len, node_h_dim] -> [n_graphs, max_len, n_heads, node_h_dim]
+            h_b = h_b.transpose(1, 2)
+            h_prime = h_prime.index_put((index[valid],), h_b[valid].to(h_prime.dtype))
+        return h_prime
+
+    def edge_attention(self, Q, K, V, dst):
+        """
+        Scaled dot-product attention over edges, with a softmax over the
+        incoming edges of each node.
+
+        Args:
+            Q (torch.Tensor): queries per node [n_nodes, n_heads, head_dim]
+            K, V (torch.Tensor): keys and values of the source node of each edge
+                [n_edges, n_heads, head_dim] and [n_edges, n_heads, node_h_dim]
+            dst (torch.Tensor): destination node of each edge [n_edges]; every
+                node should have at least one incoming edge
+
+        Returns:
+            torch.Tensor: attended values of shape [n_nodes, n_heads, node_h_dim]
+        """
+        # [n_edges, n_heads]
+        scores = (Q[dst] * K).sum(dim=-1) * self.scale
+        attn_weights = scatter_softmax(scores.float(), dst, num_nodes=Q.shape[0])
+        attn_weights = self.dropout(attn_weights)
+        # [n_edges, n_heads, node_h_dim] -> [n_nodes, n_heads, node_h_dim]
+        return scatter_add(attn_weights.unsqueeze(-1) * V.float(), dst, dim=0, dim_size=Q.shape[0])
+
+    def edge_decode_step(self, x, edge_index, node_mask):
+        """
+        Causal 'edge' attention for one decoding step: the new position of 
+        each sequence attends to itself and to its incoming edges from 
+        previously decoded positions, whose features are final in `x`.
+
+        Args:
+            x (tuple): (node_s, node_v) tuple of node features of all nodes
+            edge_index (torch.Tensor): incoming edges of the nodes in `node_mask` [2, n_edges]
+            node_mask (torch.Tensor): sorted indices of the nodes being decoded
+
+        Returns:
+            tuple: Updated (node_s, node_v) tuple for the nodes in `node_mask`
+                  node_v is passed through unchanged
+        """
+        src, dst = edge_index
+        keep = src < dst
+        src, dst = src[keep], dst[keep]
+        # Local index of the destination nodes among the nodes being decoded
+        dst = torch.searchsorted(node_mask, dst)
+        local = torch.arange(node_mask.shape[0], device=node_mask.device)
+
+        x_new = tuple_index(x, node_mask)
+        Q, K_new, V_new = self.project(x_new)
+        _, K, V = self.project(tuple_index(x, src))
+        K, V = torch.cat([K, K_new]), torch.cat([V, V_new])
+        h_prime = self.edge_attention(Q, K, V, torch.cat([dst, local]))
+
+        s_out = self.output(h_prime)  # [n_decoded, node_h_dim]
+        return (s_out, x_new[1])
+
+    def chunked_attention(self, Q, K, V, key_valid=None, mask=None, causal=False):
+        """
+        Scaled dot-product attention over tiles of `self.chunk_size` queries
+        and keys, with an online softmax that rescales the running output of
+        each query tile as new key tiles are visited (as in FlashAttention).
+
+        Only [..., chunk_size, chunk_size] scores are materialized at a time,
+        and key tiles after the query tile are skipped if causal. Results
+        match the dense attention up to floating point error. 
+
+        Args:
+            Q, K, V (torch.Tensor): queries, keys and values of shapes 
+                [..., n_heads, length, head_dim], [..., n_heads, length, head_dim]
+                and [..., n_heads, length, node_h_dim]
+            key_valid (torch.Tensor, optional): bool mask of keys to attend to
+                of shape [..., length]
+            mask (torch.Tensor, optional): additive attention mask of shape 
+                [length, length] or [n_heads, length, length]
+            causal (bool): whether queries only attend to previous keys
+
+        Returns:
+            torch.Tensor: attended values of shape [..., n_heads, length, node_h_dim]
+        """
+        length = Q.shape[-2]
+        chunk_size = self.chunk_size
+        positions = torch.arange(length, device=Q.device)
+        if key_valid is not None:
+            key_valid = key_valid.unsqueeze(-2).unsqueeze(-2)  # [..., 1, 1, length]
+
+        out = []
+        for q_start in range(0, length, chunk_size):
+            q_end = min(q_start + chunk_size, length)
+            Q_t = Q[..., q_start:q_end, :] * self.scale
+            # Running maximum score, softmax normalizer and output per query,
+            # kept in fp32 under mixed precision
+            row_max = Q_t.new_full(Q_t.shape[:-1] + (1,), -float('inf'), dtype=torch.float32)
+            row_sum = Q_t.new_zeros(Q_t.shape[:-1] + (1,), dtype=torch.float32)
+            acc = V.new_zeros(V.shape[:-2] + (q_end - q_start, V.shape[-1]), dtype=torch.float32)
+
+            k_stop = q_end if causal else length
+            for k_start in range(0, k_stop, chunk_size):
+                k_end = min(k_start + chunk_size, k_stop)
+                # [..., n_heads, q_chunk, k_chunk]
+                scores = torch.matmul(Q_t, K[..., k_start:k_end, :].transpose(-2, -1)).float()
+                if mask is not None:
+                    scores = scores + mask[..., q_start:q_end, k_start:k_end]
+                if causal:
+                    later = positions[k_start:k_end].unsqueeze(0) > positions[q_start:q_end].unsqueeze(1)
+                    scores = scores.masked_fill(later, -1e9)
+                if key_valid is not None:
+                    scores = scores.masked_fill(~key_valid[..., k_start:k_end], -1e9)
+
+                new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+                weights = torch.exp(scores - new_max)
+                correction = torch.exp(row_max - new_max)
+                row_sum = row_sum * correction + weights.sum(dim=-1, keepdim=True)
+                acc = acc * correction + torch.matmul(self.dropout(weights), V[..., k_start:k_end, :])
+                row_max = new_max
+
+            out.append(acc / row_sum)
+        return torch.cat(out, dim=-2).to(V.dtype)
+
+    def project(self, x):
+        """
+        Query, key and value projections of node features.
+
+        Args:
+            x (tuple): (node_s, node_v) tuple of node features
+                        node_s has shape [n_nodes, d_s]
+                        node_v has shape [n_nodes, d_v, 3] or None
+
+        Returns:
+            tuple: (Q, K, V) of shapes [n_nodes, n_heads, head_dim], 
+                   [n_nodes, n_heads, head_dim] and [n_nodes, n_heads, node_h_dim]
+        """
+        s, v = x
+        n_nodes = s.shape[0]
+
+        # Create combined features with vector norms
+        if v is not None and self.vector_h_dim > 0:
+            # Calculate vector norms [n_nodes, d_v]
+            v_norms = torch.norm(v, dim=2)
+            
+            # Concatenate scalar features with vector norms [n_nodes, d_s + d_v]
+            combined_features = torch.cat([s, v_norms], dim=1)
+        else:
+            combined_features = s
+        
+        # Linear projections for query, key using combined features
+        # [n_nodes, combined_dim] -> [n_nodes, n_heads * head_dim]
+        Q = self.W_Q(combined_features)
+        K = self.W_K(combined_features)
+        
+        # For values, we still use only scalar features
+        # [n_nodes, d_s] -> [n_nodes, n_heads * node_h_dim]
+        V = self.W_V(s)
+        
+        # Reshape for multi-head attention
+        # [n_nodes, n_heads * head_dim] -> [n_nodes, n_heads, head_dim]
+        Q = Q.view(n_nodes, self.n_heads, self.head_dim)
+        K = K.view(n_nodes, self.n_heads, self.head_dim)
+        V = V.view(n_nodes, self.n_heads, self.node_h_dim)
+        return Q, K, V
+
+    def output(self, h_prime):
+        """
+        Combines attention heads and applies the output projection.
+
+        Args:
+            h_prime (torch.Tensor): attended values of shape [n_nodes, n_heads, node_h_dim]
+
+        Returns:
+            torch.Tensor: updated scalar features of shape [n_nodes, node_h_dim]
+        """
         if self.concat:
             # Concatenate heads: [n_nodes, n_heads, node_h_dim] -> [n_nodes, n_heads * node_h_dim]
-            h_prime = h_prime.reshape(n_nodes, -1)
-            s_out = self.W_O(h_prime)  # [n_nodes, node_h_dim]
+            h_prime = h_prime.reshape(h_prime.shape[0], -1)
         else:
             # Average across heads: [n_nodes, n_heads, node_h_dim] -> [n_nodes, node_h_dim]
             h_prime = h_prime.mean(dim=1)
-            s_out = self.W_O(h_prime)  # [n_nodes, node_h_dim]
+        return self.W_O(h_prime)
+
+    def init_cache(self, n_copies, max_len, device):
+        """
+        Creates an empty key/value cache for incremental causal decoding,
+        see `decode_step`.
+
+        Args:
+            n_copies (int): number of sequences decoded in parallel
+            max_len (int): maximum number of positions to decode
+            device (torch.device): device to create the cache on
         
-        return (s_out, v)  # Return updated scalars and original vectors
+        Returns:
+            KVCache: empty cache
+        """
+        return KVCache(
+            n_copies, max_len, self.n_heads, 
+            self.head_dim, self.node_h_dim, device
+        )
+
+    def decode_step(self, x, kv_cache, shared=None):
+        """
+        Incremental causal attention for one decoding step.
+
+        Equivalent to `forward` with a causal mask over the positions of
+        each decoded sequence, but only the query rows of the new position
+        are computed: keys and values of previous positions are read from 
+        `kv_cache`, which is extended with the new position in-place.
+        
+        Args:
+            x (tuple): (node_s, node_v) tuple of node features for the new
+                        position of each sequence being decoded
+                        node_s has shape [n_copies, d_s]
+                        node_v has shape [n_copies, d_v, 3] or None
+            kv_cache (KVCache): cache for this layer from `init_cache`
+            shared (tuple, optional): (rep_copies, copy_group) if `x` only 
+                        holds one row per group of sequences with identical 
+                        prefixes, where `rep_copies` [n_groups] is the sequence 
+                        representing each group and `copy_group` [n_copies] is 
+                        the group of each sequence; the cache is still extended
+                        for all sequences
+        
+        Returns:
+            tuple: Updated (node_s, node_v) tuple after attention
+                  node_v is passed through unchanged
+        """
+        s, v = x
+
+        Q, K, V = self.project(x)
+        # [n_copies, n_heads, length, dim]
+        if shared is not None:
+            rep_copies, copy_group = shared
+            K, V = kv_cache.append(K[copy_group], V[copy_group])
+            K, V = K[rep_copies], V[rep_copies]
+        else:
+            K, V = kv_cache.append(K, V)
+
+        # [n_copies, n_heads, head_dim] x [n_copies, n_heads, length, head_dim] -> [n_copies, n_heads, length]
+        scores = torch.einsum('chd,chld->chl', Q, K) * self.scale
+        attn_weights = F.softmax(scores, dim=-1, dtype=torch.float32)
+        attn_weights = self.dropout(attn_weights)
+
+        # [n_copies, n_heads, length] x [n_copies, n_heads, length, node_h_dim] -> [n_copies, n_heads, node_h_dim]
+        h_prime = torch.einsum('chl,chld->chd', attn_weights, V)
+        
+        s_out = self.output(h_prime)  # [n_copies, node_h_dim]
+        
+        return (s_out, v)
+
+
+class KVCache(object):
+    """
+    Key/value cache of a `GraphAttentionLayer` for incremental causal decoding.
+    
+    Buffers are preallocated for `max_len` positions and filled one position
+    per decoding step, so that previously decoded positions are never projected
+    or attended from again.
+
+    Args:
+        n_copies (int): number of sequences decoded in parallel
+        max_len (int): maximum number of positions to decode
+        n_heads (int): number of attention heads
+        head_dim (int): dimension of keys per head
+        value_dim (int): dimension of values per head
+        device (torch.device): device to create the buffers on
+    """
+    def __init__(self, n_copies, max_len, n_heads, head_dim, value_dim, device):
+        self.k = torch.zeros(n_copies, n_heads, max_len, head_dim, device=device)
+        self.v = torch.zeros(n_copies, n_heads, max_len, value_dim, device=device)
+        self.length = 0
+
+    def append(self, k, v):
+        """
+        Appends keys and values for a new position.
+
+        When sequences of different lengths are decoded together, only the 
+        first `n_active` sequences (those not yet fully decoded) are extended.
+
+        Args:
+            k (torch.Tensor): keys of shape [n_active, n_heads, head_dim]
+            v (torch.Tensor): values of shape [n_active, n_heads, value_dim]
+        
+        Returns:
+            tuple: keys and values of all positions decoded so far, of shape
+                   [n_active, n_heads, length, head_dim] and [n_active, n_heads, length, value_dim]
+        """
+        n_active = k.size(0)
+        self.k[:n_active, :, self.length] = k
+        self.v[:n_active, :, self.length] = v
+        self.length += 1
+        return self.k[:n_active, :, :self.length], self.v[:n_active, :, :self.length]
 
 class MultiAttentiveGVPLayer(nn.Module):
     """
@@ -167,6 +510,9 @@ class MultiAttentiveGVPLayer(nn.Module):
         norm_first (bool): Whether to apply normalization before or after
         n_heads (int): Number of attention heads
         attention_dropout (float): Dropout rate for attention weights
+        attention_chunk_size (int, optional): Tile size for chunked attention, 
+            see `GraphAttentionLayer` (dense attention if None)
+        attention_mode (str): 'dense' or 'edge' attention, see `GraphAttentionLayer`
     """
     def __init__(
         self, 
@@ -177,7 +523,9 @@ class MultiAttentiveGVPLayer(nn.Module):
         vector_gate=True,
         norm_first=False, 
         n_heads=4,
-        attention_dropout=0.1
+        attention_dropout=0.1,
+        attention_chunk_size=None,
+        attention_mode='dense'
     ):
         super().__init__()
         
@@ -199,7 +547,9 @@ class MultiAttentiveGVPLayer(nn.Module):
             vector_h_dim = node_dims[1],  # Vector feature dimension
             n_heads = n_heads,
             dropout = attention_dropout,
-            concat = False  # Use averaging instead of concatenation to avoid dimension issues
+            concat = False,  # Use averaging instead of concatenation to avoid dimension issues
+            chunk_size = attention_chunk_size,
+            mode = attention_mode
         )
         
         # Normalization layers - Use custom LayerNorm that handles vector features correctly
@@ -208,8 +558,8 @@ class MultiAttentiveGVPLayer(nn.Module):
             
         # Dropout for regularization
         self.dropout = Dropout(drop_rate)  # Use the custom Dropout class
-        
-    def forward(self, x, edge_index, edge_attr):
+
+    def forward(self, x, edge_index, edge_attr, batch=None, mask_confs=None, conf_graph=None):
         """
         Forward pass of the hybrid layer.
         
@@ -221,6 +571,16 @@ class MultiAttentiveGVPLayer(nn.Module):
             edge_attr (tuple): (edge_s, edge_v) tuple of edge features
                               edge_s has shape [n_edges, n_conf, d_se]
                               edge_v has shape [n_edges, n_conf, d_ve, 3]
+            batch (torch.Tensor, optional): graph index of each node [n_nodes];
+                              if given, nodes only attend to nodes of the same graph
+            mask_confs (torch.Tensor, optional): boolean mask of valid conformers
+                              [n_nodes, n_conf]; attention is skipped for padded
+                              conformers (their attention output is zero)
+            conf_graph (tuple, optional): attention graph of all conformations 
+                              from `conformer_attention_graph`, computed once per 
+                              batch by the caller so that it is shared by all 
+                              encoder layers (computed from `batch` and 
+                              `mask_confs` if not given)
         
         Returns:
             tuple: Updated (node_s, node_v) tuple after convolution and attention
@@ -239,23 +599,28 @@ class MultiAttentiveGVPLayer(nn.Module):
         conv_s, conv_v = self.conv((s, v), edge_index, edge_attr)
         
         # Step 2: Apply graph attention within each conformation
-        # We need to process each conformation separately
+        # Each conformation of each graph is attended to as a separate graph,
+        # so that all conformations are processed in one batched attention
         n_nodes, n_conf, d_s = s.shape
+        if conf_graph is None:
+            conf_graph = conformer_attention_graph(
+                n_nodes, n_conf, edge_index, batch, mask_confs, self.attention.mode, s.device)
+        keep, conf_attention = conf_graph
+        
+        # Skip padded conformations
+        s_confs = s.transpose(0, 1)[keep]  # [n_kept, d_s]
+        v_confs = v.transpose(0, 1)[keep] if v is not None else None  # [n_kept, d_v, 3]
+        
+        # Apply attention to all conformations - passing both scalar and vector features
+        if self.attention.mode == 'edge':
+            attn_s_confs, _ = self.attention((s_confs, v_confs), edge_index=conf_attention)
+        else:
+            attn_s_confs, _ = self.attention((s_confs, v_confs), blocks=conf_attention)
         
-        # Initialize tensors to store attention outputs for each conformation
-        attn_s = torch.zeros_like(s)  # [n_nodes, n_conf, d_s]
-        
-        # Process each conformation separately
-        for conf_idx in range(n_conf):
-            # Extract features for this conformation
-            s_conf = s[:, conf_idx]  # [n_nodes, d_s]
-            v_conf = v[:, conf_idx] if v is not None else None  # [n_nodes, d_v, 3]
-            
-            # Apply attention to this conformation - now passing both scalar and vector features
-            attn_s_conf, _ = self.attention((s_conf, v_conf))  # [n_nodes, d_s]
-            
-            # Store the result
-            attn_s[:, conf_idx] = attn_s_conf
+        # Scatter back to [n_nodes, n_conf, d_s]
+        attn_s = s.new_zeros(n_conf, n_nodes, d_s)
+        attn_s[keep] = attn_s_confs
+        attn_s = attn_s.transpose(0, 1)
         
         # Combine convolution and attention outputs with equal weights
         combined_s = 0.5 * conv_s + 0.5 * attn_s  # [n_nodes, n_conf, d_s]
@@ -297,6 +662,9 @@ class AttentiveGVPLayer(nn.Module):
         norm_first (bool): whether to apply normalization before or after operations
         n_heads (int): number of attention heads
         attention_dropout (float): dropout rate for attention weights
+        attention_chunk_size (int, optional): tile size for chunked attention, 
+            see `GraphAttentionLayer` (dense attention if None)
+        attention_mode (str): 'dense' or 'edge' attention, see `GraphAttentionLayer`
     """
     def __init__(
         self,
@@ -310,7 +678,9 @@ class AttentiveGVPLayer(nn.Module):
         residual=True,
         norm_first=False,
         n_heads=4,
-        attention_dropout=0.1
+        attention_dropout=0.1,
+        attention_chunk_size=None,
+        attention_mode='dense'
     ):
         super().__init__()
         
@@ -334,7 +704,9 @@ class AttentiveGVPLayer(nn.Module):
             vector_h_dim=node_dims[1],  # Vector feature dimension
             n_heads=n_heads,
             dropout=attention_dropout,
-            concat=False  # Use averaging instead of concatenation
+            concat=False,  # Use averaging instead of concatenation
+            chunk_size=attention_chunk_size,
+            mode=attention_mode
         )
         
         # Normalization layers
@@ -360,24 +732,7 @@ class AttentiveGVPLayer(nn.Module):
         # Final normalization
         self.final_norm = LayerNorm(node_dims)
         
-    def create_causal_mask(self, n_nodes, device):
-        """
-        Create a causal mask for autoregressive attention.
-        
-        Args:
-            n_nodes (int): number of nodes
-            device (torch.device): device to create mask on
-            
-        Returns:
-            torch.Tensor: causal mask of shape [n_nodes, n_nodes]
-        """
-        # Create lower triangular mask (including diagonal)
-        mask = torch.triu(torch.ones(n_nodes, n_nodes, device=device), diagonal=1)
-        # Convert to additive mask (1 -> -inf, 0 -> 0)
-        mask = mask * -1e9
-        return mask
-        
-    def forward(self, x, edge_index, edge_attr, autoregressive_x=None, node_mask=None):
+    def forward(self, x, edge_index, edge_attr, autoregressive_x=None, node_mask=None, batch=None, blocks=None):
         """
         Forward pass of the hybrid layer.
         
@@ -387,14 +742,17 @@ class AttentiveGVPLayer(nn.Module):
             edge_attr (tuple): (edge_s, edge_v) tuple of edge features
             autoregressive_x (tuple, optional): node features for autoregressive message passing
             node_mask (torch.Tensor, optional): boolean mask for nodes to update
+            batch (torch.Tensor, optional): graph index of each node [n_nodes];
+                              if given, nodes only attend to nodes of the same graph
+            blocks (list, optional): blocks of graphs from `graph_blocks(batch)`,
+                              computed once per batch by the caller so that they
+                              are shared by all decoder layers (computed from
+                              `batch` if not given)
             
         Returns:
             tuple: Updated (node_s, node_v) tuple after both branches
         """
         s, v = x
-        n_nodes = s.shape[0]
-        device = s.device
-        
         # Initialize outputs to be the same as inputs (for residual connection)
         out_s, out_v = s, v
         
@@ -410,9 +768,12 @@ class AttentiveGVPLayer(nn.Module):
         )
         
         # Branch B: Self-attention with causal masking
-        # Create causal mask for autoregressive attention
-        causal_mask = self.create_causal_mask(n_nodes, device)
-        attn_s, attn_v = self.attention_branch((s, v), mask=causal_mask)
+        # Causal attention (within each graph, if a batch is given)
+        if self.attention_branch.mode != 'dense':
+            blocks = None
+        elif blocks is None and batch is not None:
+            blocks = graph_blocks(batch)
+        attn_s, attn_v = self.attention_branch((s, v), blocks=blocks, causal=True, edge_index=edge_index)
         
         # Combine outputs from both branches with equal weights
         combined_s = 0.5 * gvp_s + 0.5 * attn_s
@@ -436,6 +797,77 @@ class AttentiveGVPLayer(nn.Module):
         
         return (out_s, out_v)
 
+    def decode_step(self, x, edge_index, edge_attr, autoregressive_x, node_mask, kv_cache, shared=None):
+        """
+        Incremental forward pass for one autoregressive decoding step.
+
+        Only the nodes in `node_mask` (the position being decoded in each
+        sequence) are updated. The attention branch reads keys/values of
+        previously decoded positions from `kv_cache` instead of recomputing
+        causal attention over all nodes.
+
+        Args:
+            x (tuple): (node_s, node_v) tuple of node features
+            edge_index (torch.Tensor): edge indices [2, n_edges]
+            edge_attr (tuple): (edge_s, edge_v) tuple of edge features
+            autoregressive_x (tuple): node features for autoregressive message passing
+            node_mask (torch.Tensor): boolean mask or indices of nodes to update,
+                                      one node per sequence being decoded
+            kv_cache (KVCache): attention cache from `attention_branch.init_cache`
+                                (unused in 'edge' attention mode)
+            shared (tuple, optional): if `node_mask` only holds one node per 
+                                      group of sequences with identical prefixes,
+                                      see `GraphAttentionLayer.decode_step`
+
+        Returns:
+            tuple: Updated (node_s, node_v) tuple for the nodes in `node_mask`
+        """
+        s, v = x
+
+        # Initialize outputs to be the same as inputs (for residual connection)
+        out_s, out_v = tuple_index((s, v), node_mask)
+
+        # Apply layer normalization before operations if norm_first is True
+        if self.norm_first:
+            s, v = self.norm((s, v))
+
+        # Branch A: GVP-based message passing
+        gvp_s, gvp_v = tuple_index(self.gvp_branch(
+            (s, v), edge_index, edge_attr,
+            autoregressive_x=autoregressive_x,
+            node_mask=node_mask
+        ), node_mask)
+
+        # Branch B: Self-attention over the cached prefix of each sequence
+        # (or over incoming edges from decoded positions, in 'edge' mode)
+        if self.attention_branch.mode == 'edge':
+            attn_s, _ = self.attention_branch.edge_decode_step((s, v), edge_index, node_mask)
+        else:
+            attn_s, _ = self.attention_branch.decode_step(
+                tuple_index((s, v), node_mask), kv_cache, shared=shared)
+
+        # Combine outputs from both branches with equal weights
+        combined_s = 0.5 * gvp_s + 0.5 * attn_s
+        combined_v = gvp_v  # Use GVP branch's vector features
+
+        # Apply dropout
+        combined_s, combined_v = self.dropout((combined_s, combined_v))
+
+        # Residual connection
+        out_s = out_s + combined_s
+        if out_v is not None and combined_v is not None:
+            out_v = out_v + combined_v
+
+        # Apply layer normalization after operations if norm_first is False
+        if not self.norm_first:
+            out_s, out_v = self.norm((out_s, out_v))
+
+        # Optional feedforward network
+        ff_s, ff_v = self.ff_func((out_s, out_v))
+        out_s, out_v = self.final_norm((out_s + ff_s, out_v + ff_v))
+
+        return (out_s, out_v)
+
 #########################################################################
 
 class GVPConvLayer(nn.Module):
@@ -506,7 +938,7 @@ class GVPConvLayer(nn.Module):
                 for forming messages where src >= dst. The current node 
                 embeddings `x` will still be the base of the update and the 
                 pointwise feedforward.
-        :param node_mask: array of type `bool` to index into the first
+        :param node_mask: array of type `bool` (or indices) to index into the first
                 dim of node embeddings (s, V). If not `None`, only
                 these nodes will be updated.
         '''
@@ -553,7 +985,7 @@ class GVPConvLayer(nn.Module):
             x = x_
         return x
 
-class GVPConv(MessagePassing):
+class GVPConv(nn.Module):
     '''
     Graph convolution / message passing with Geometric Vector Perceptrons.
     Takes in a graph with node and edge embeddings,
@@ -561,6 +993,10 @@ class GVPConv(MessagePassing):
     
     This does NOT do residual updates and pointwise feedforward layers
     ---see `GVPConvLayer`.
+
+    Messages are computed by `gvp_message_passing`: they are summed in fp32,
+    also under mixed precision, and returned in the dtype of the input node
+    embeddings.
     
     :param in_dims: input node embedding dimensions (n_scalar, n_vector)
     :param out_dims: output node embedding dimensions (n_scalar, n_vector)
@@ -572,14 +1008,19 @@ class GVPConv(MessagePassing):
     :param activations: tuple of functions (scalar_act, vector_act) to use in GVPs
     :param vector_gate: whether to use vector gating.
                         (vector_act will be used as sigma^+ in vector gating if `True`)
+    :param edge_chunk_size: maximum number of edges to compute messages for
+                            at once, see `gvp_message_passing` (all if `None`)
     '''
     def __init__(self, in_dims, out_dims, edge_dims,
                  n_layers=3, module_list=None, aggr="mean", 
-                 activations=(F.silu, torch.sigmoid), vector_gate=True):
-        super(GVPConv, self).__init__(aggr=aggr)
+                 activations=(F.silu, torch.sigmoid), vector_gate=True,
+                 edge_chunk_size=16384):
+        super(GVPConv, self).__init__()
+        self.aggr = aggr
         self.si, self.vi = in_dims
         self.so, self.vo = out_dims
         self.se, self.ve = edge_dims
+        self.edge_chunk_size = edge_chunk_size
         
         GVP_ = functools.partial(GVP, 
                 activations=activations, vector_gate=vector_gate)
@@ -606,18 +1047,14 @@ class GVPConv(MessagePassing):
         :param edge_index: array of shape [2, n_edges]
         :param edge_attr: tuple (s, V) of `torch.Tensor`
         '''
-        x_s, x_v = x
-        message = self.propagate(edge_index, 
-                    s=x_s, v=x_v.contiguous().view(x_v.shape[0], x_v.shape[1] * 3),
-                    edge_attr=edge_attr)
-        return _split(message, self.vo) 
-
-    def message(self, s_i, v_i, s_j, v_j, edge_attr):
-        v_j = v_j.view(v_j.shape[0], v_j.shape[1]//3, 3)
-        v_i = v_i.view(v_i.shape[0], v_i.shape[1]//3, 3)
-        message = tuple_cat((s_j, v_j), edge_attr, (s_i, v_i))
-        message = self.message_func(message)
-        return _merge(*message)
+        return gvp_message_passing(self.message_func, x, edge_index, edge_attr,
+                                   aggr=self.aggr, chunk_size=self.edge_chunk_size)
+
+    def split_linear_blocks(self):
+        '''
+        Splits the first message GVP into per-block modules, see `split_message_blocks`.
+        '''
+        split_message_blocks(self)
     
 #########################################################################
 
@@ -676,17 +1113,21 @@ class MultiGVPConvLayer(nn.Module):
             x = self.norm[1](tuple_sum(x, self.dropout[1](dh))) if self.residual else dh
         return x
 
-class MultiGVPConv(MessagePassing):
+class MultiGVPConv(nn.Module):
     '''
-    GVPConv for handling multiple conformations
+    GVPConv for handling multiple conformations (conformations are a batch
+    dimension of node and edge embeddings); see `GVPConv` for arguments.
     '''
     def __init__(self, in_dims, out_dims, edge_dims,
                  n_layers=3, module_list=None, aggr="mean", 
-                 activations=(F.silu, torch.sigmoid), vector_gate=True):
-        super(MultiGVPConv, self).__init__(aggr=aggr)
+                 activations=(F.silu, torch.sigmoid), vector_gate=True,
+                 edge_chunk_size=16384):
+        super(MultiGVPConv, self).__init__()
+        self.aggr = aggr
         self.si, self.vi = in_dims
         self.so, self.vo = out_dims
         self.se, self.ve = edge_dims
+        self.edge_chunk_size = edge_chunk_size
         
         GVP_ = functools.partial(GVP, 
                 activations=activations, vector_gate=vector_gate)
@@ -713,29 +1154,145 @@ class MultiGVPConv(MessagePassing):
         :param edge_index: array of shape [2, n_edges]
         :param edge_attr: tuple (s, V) of `torch.Tensor`
         '''
-        x_s, x_v = x
-        n_conf = x_s.shape[1]
-        
-        # x_s: [n_nodes, n_conf, d] -> [n_nodes, n_conf * d]
-        x_s = x_s.contiguous().view(x_s.shape[0], x_s.shape[1] * x_s.shape[2])        
-        # x_v: [n_nodes, n_conf, d, 3] -> [n_nodes, n_conf * d * 3]
-        x_v = x_v.contiguous().view(x_v.shape[0], x_v.shape[1] * x_v.shape[2] * 3)
-        
-        message = self.propagate(edge_index, s=x_s, v=x_v, edge_attr=edge_attr)
-        
-        return _split_multi(message, self.so, self.vo, n_conf)
+        # Conformations are a batch dimension of all node and edge features
+        return gvp_message_passing(self.message_func, x, edge_index, edge_attr,
+                                   aggr=self.aggr, chunk_size=self.edge_chunk_size)
 
-    def message(self, s_i, v_i, s_j, v_j, edge_attr):
-        # [n_nodes, n_conf * d] -> [n_nodes, n_conf, d]
-        s_i = s_i.view(s_i.shape[0], s_i.shape[1]//self.si, self.si)
-        s_j = s_j.view(s_j.shape[0], s_j.shape[1]//self.si, self.si)
-        # [n_nodes, n_conf * d * 3] -> [n_nodes, n_conf, d, 3]
-        v_i = v_i.view(v_i.shape[0], v_i.shape[1]//(self.vi * 3), self.vi, 3)
-        v_j = v_j.view(v_j.shape[0], v_j.shape[1]//(self.vi * 3), self.vi, 3)
+    def split_linear_blocks(self):
+        '''
+        Splits the first message GVP into per-block modules, see `split_message_blocks`.
+        '''
+        split_message_blocks(self)
+
+
+def gvp_message_passing(message_func, x, edge_index, edge_attr, aggr="mean", chunk_size=None):
+    '''
+    Aggregates the messages `message_func((s_j, V_j) || edge_attr || (s_i, V_i))` 
+    of all edges j -> i at their destination node i, as in `GVPConv`.
+
+    The first GVP of `message_func` is applied without materializing the
+    concatenated inputs of all edges: its linear maps are split into one 
+    block per input, so that the source and destination blocks are applied
+    once per node and gathered per edge (or applied per edge, if there are
+    fewer edges than nodes, as when decoding one position at a time). 
+    Messages are computed for at most `chunk_size` edges at a time and 
+    summed into the destination nodes, which bounds the memory of per-edge 
+    intermediates. Messages are summed in fp32 (also under mixed precision),
+    and aggregated messages are cast back to the dtype of the node embeddings.
+
+    :param message_func: `nn.Sequential` of GVPs, the first with vector inputs
+    :param x: tuple (s, V) of node embeddings of shapes [n_nodes, ..., n_scalar]
+              and [n_nodes, ..., n_vector, 3] (e.g. with a conformation dimension)
+    :param edge_index: array of shape [2, n_edges]
+    :param edge_attr: tuple (s, V) of edge embeddings of shapes [n_edges, ..., n_scalar]
+                      and [n_edges, ..., n_vector, 3]
+    :param aggr: "add" or "mean" aggregation of incoming messages
+    :param chunk_size: maximum number of edges per chunk (all edges if `None`)
+    :return: tuple (s, V) of aggregated messages per node
+    '''
+    first, last = message_func[0], message_func[-1]
+    s, v = x
+    e_s, e_v = edge_attr
+    si, vi, se, ve = s.shape[-1], v.shape[-2], e_s.shape[-1], e_v.shape[-2]
+    src, dst = edge_index
+    n_nodes, n_edges = s.shape[0], src.shape[0]
+
+    # Blocks of the first GVP's linear maps for inputs (s_j, V_j), edge_attr and (s_i, V_i)
+    # (separate modules if split by `split_linear_blocks`, e.g. for quantization)
+    if hasattr(first, 'ws_blocks'):
+        ws_src, ws_edge, ws_dst, ws_norm = first.ws_blocks
+        wh_src, wh_edge, wh_dst = first.wh_blocks
+    else:
+        ws_src, ws_edge, ws_dst, ws_norm = linear_blocks(first.ws, [si, se, si, first.h_dim], bias_block=1)
+        wh_src, wh_edge, wh_dst = linear_blocks(first.wh, [vi, ve, vi])
 
-        message = tuple_cat((s_j, v_j), edge_attr, (s_i, v_i))
-        message = self.message_func(message)
-        return _merge_multi(*message)
+    # Per-node projections of source and destination nodes
+    v_t = v.transpose(-1, -2)  # [n_nodes, ..., 3, n_vector]
+    project_nodes = n_edges >= n_nodes
+    if project_nodes:
+        s_src, s_dst = ws_src(s), ws_dst(s)
+        h_src, h_dst = wh_src(v_t), wh_dst(v_t)
+
+    # Messages are summed in fp32 (also under mixed precision)
+    out_s = s.new_zeros((n_nodes,) + s.shape[1:-1] + (last.so,), dtype=torch.float32)
+    out_v = v.new_zeros((n_nodes,) + v.shape[1:-2] + (last.vo, 3), dtype=torch.float32)
+    chunk_size = chunk_size or max(n_edges, 1)
+    for start in range(0, n_edges, chunk_size):
+        j, i = src[start:start + chunk_size], dst[start:start + chunk_size]
+        e_s_chunk = e_s[start:start + chunk_size]
+        e_v_chunk = e_v[start:start + chunk_size].transpose(-1, -2)
+
+        # First GVP on the (implicitly) concatenated inputs
+        if project_nodes:
+            s_j, s_i, h_j, h_i = s_src[j], s_dst[i], h_src[j], h_dst[i]
+        else:
+            s_j, s_i = ws_src(s[j]), ws_dst(s[i])
+            h_j, h_i = wh_src(v_t[j]), wh_dst(v_t[i])
+        vh = h_j + wh_edge(e_v_chunk) + h_i
+        vn = _norm_no_nan(vh, axis=-2)
+        m_s = s_j + ws_edge(e_s_chunk) + s_i + ws_norm(vn)
+        m_s, m_v = message_func[1:](first.output(m_s, vh))
+
+        out_s = out_s.index_add(0, i, m_s.float())
+        out_v = out_v.index_add(0, i, m_v.float())
+
+    if aggr == "mean":
+        count = torch.bincount(dst, minlength=n_nodes).clamp(min=1).to(out_s.dtype)
+        count = count.view((n_nodes,) + (1,) * (out_s.dim() - 1))
+        out_s, out_v = out_s / count, out_v / count.unsqueeze(-1)
+    # Aggregated messages in the dtype of the node embeddings
+    return out_s.to(s.dtype), out_v.to(v.dtype)
+
+
+def linear_blocks(linear, sizes, bias_block=0):
+    '''
+    Splits a linear map along its input dimension into one linear map per
+    block of inputs, so that `linear` applied to the concatenated blocks is
+    the sum of the block maps applied to each block. The blocks slice the
+    weights of `linear`, and the bias is added by block `bias_block`.
+
+    :param linear: `nn.Linear`
+    :param sizes: list of sizes of the blocks of inputs (the remaining
+                  inputs of `linear`, if any, are left out)
+    :param bias_block: index of the block that adds the bias
+    :return: list of functions, one per block
+    '''
+    blocks, start = [], 0
+    for k, size in enumerate(sizes):
+        weight = linear.weight[:, start:start + size]
+        bias = linear.bias if k == bias_block else None
+        blocks.append(functools.partial(F.linear, weight=weight, bias=bias))
+        start += size
+    return blocks
+
+def split_linear(linear, sizes, bias_block=0):
+    '''
+    Same as `linear_blocks`, but copies the blocks into separate `nn.Linear` 
+    modules, e.g. so that they can be quantized like other linear layers.
+
+    :return: `nn.ModuleList` of `nn.Linear`, one per block
+    '''
+    blocks, start = nn.ModuleList(), 0
+    for k, size in enumerate(sizes):
+        has_bias = linear.bias is not None and k == bias_block
+        block = nn.Linear(size, linear.out_features, bias=has_bias).to(linear.weight.device)
+        with torch.no_grad():
+            block.weight.copy_(linear.weight[:, start:start + size])
+            if has_bias:
+                block.bias.copy_(linear.bias)
+        blocks.append(block)
+        start += size
+    return blocks
+
+def split_message_blocks(conv):
+    '''
+    Splits the linear maps of the first message GVP of `conv` (a `GVPConv`
+    or `MultiGVPConv`) into `ws_blocks` and `wh_blocks` modules, which
+    `gvp_message_passing` then calls instead of slicing their weights.
+    '''
+    first = conv.message_func[0]
+    first.ws_blocks = split_linear(first.ws, [conv.si, conv.se, conv.si, first.h_dim], bias_block=1)
+    first.wh_blocks = split_linear(first.wh, [conv.vi, conv.ve, conv.vi])
 
 #########################################################################
 
@@ -783,18 +1340,7 @@ class GVP(nn.Module):
             vh = self.wh(v)    
             vn = _norm_no_nan(vh, axis=-2)
             s = self.ws(torch.cat([s, vn], -1))
-            if self.vo: 
-                v = self.wv(vh) 
-                v = torch.transpose(v, -1, -2)
-                if self.vector_gate: 
-                    if self.vector_act:
-                        gate = self.wsv(self.vector_act(s))
-                    else:
-                        gate = self.wsv(s)
-                    v = v * torch.sigmoid(gate).unsqueeze(-1)
-                elif self.vector_act:
-                    v = v * self.vector_act(
-                        _norm_no_nan(v, axis=-1, keepdims=True))
+            return self.output(s, vh)
         else:
             s = self.ws(x)
             if self.vo:
@@ -804,6 +1350,32 @@ class GVP(nn.Module):
             s = self.scalar_act(s)
         
         return (s, v) if self.vo else s
+
+    def output(self, s, vh):
+        '''
+        Output of the GVP (with vector inputs) from its linear maps.
+
+        :param s: scalar channels after `ws`, before activation
+        :param vh: hidden vector channels after `wh`, of shape [..., 3, h_dim]
+        :return: tuple (s, V) of `torch.Tensor`,
+                 or (if vectors_out is 0), a single `torch.Tensor`
+        '''
+        if self.vo: 
+            v = self.wv(vh) 
+            v = torch.transpose(v, -1, -2)
+            if self.vector_gate: 
+                if self.vector_act:
+                    gate = self.wsv(self.vector_act(s))
+                else:
+                    gate = self.wsv(s)
+                v = v * torch.sigmoid(gate).unsqueeze(-1)
+            elif self.vector_act:
+                v = v * self.vector_act(
+                    _norm_no_nan(v, axis=-1, keepdims=True))
+        if self.scalar_act:
+            s = self.scalar_act(s)
+        
+        return (s, v) if self.vo else s
     
 #########################################################################
 
@@ -868,11 +1440,100 @@ class LayerNorm(nn.Module):
                   (will be assumed to be scalar channels)
         '''
         if not self.v:
-            return self.scalar_norm(x)
+            return self.scalar_norm(x.float()).to(x.dtype)
         s, v = x
-        vn = _norm_no_nan(v, axis=-1, keepdims=True, sqrt=False)
+        # Normalize in fp32 under mixed precision
+        vn = _norm_no_nan(v.float(), axis=-1, keepdims=True, sqrt=False)
         vn = torch.sqrt(torch.mean(vn, dim=-2, keepdim=True))
-        return self.scalar_norm(s), v / vn
+        return self.scalar_norm(s.float()).to(s.dtype), (v.float() / vn).to(v.dtype)
+
+def create_causal_mask(n_nodes, device):
+    '''
+    Create a causal mask for autoregressive attention.
+
+    :param n_nodes: number of nodes
+    :param device: device to create mask on
+    :return: additive mask of shape [n_nodes, n_nodes]
+             (0 for previous nodes and the node itself, -1e9 for later nodes)
+    '''
+    # Create lower triangular mask (including diagonal)
+    mask = torch.triu(torch.ones(n_nodes, n_nodes, device=device), diagonal=1)
+    # Convert to additive mask (1 -> -inf, 0 -> 0)
+    mask = mask * -1e9
+    return mask
+
+def conformer_attention_graph(n_nodes, n_conf, edge_index, batch=None, mask_confs=None, mode='dense', device=None):
+    '''
+    Attention graph of all conformations of a batch, for attention within
+    each conformation in `MultiAttentiveGVPLayer`: each conformation of each
+    graph is attended to as a separate graph, over its valid nodes.
+
+    :param n_nodes: number of nodes
+    :param n_conf: number of conformations
+    :param edge_index: edge indices of shape [2, n_edges]
+    :param batch: graph index of each node of shape [n_nodes] (one graph if None)
+    :param mask_confs: boolean mask of valid conformations of shape [n_nodes, n_conf]
+    :param mode: 'dense' or 'edge' attention, see `GraphAttentionLayer`
+    :return: tuple (keep, attention), where `keep` of shape [n_conf, n_nodes] masks
+             the valid nodes of each conformation, and `attention` holds the blocks 
+             of graphs from `graph_blocks` ('dense') or the edge indices between 
+             valid nodes of each conformation ('edge'), indexing the valid nodes 
+             in conformation-major order
+    '''
+    # Skip padded conformations
+    if mask_confs is not None:
+        keep = mask_confs.t().bool()  # [n_conf, n_nodes]
+    else:
+        keep = torch.ones(n_conf, n_nodes, dtype=torch.bool, device=device)
+
+    if mode == 'edge':
+        # Edges of each conformation, between kept nodes
+        kept_index = torch.full((n_conf * n_nodes,), -1, dtype=torch.long, device=device)
+        kept_index[keep.flatten()] = torch.arange(int(keep.sum()), device=device)
+        conf_offset = n_nodes * torch.arange(n_conf, device=device).view(1, -1, 1)
+        conf_edge_index = kept_index[(edge_index.unsqueeze(1) + conf_offset).flatten(1)]
+        return keep, conf_edge_index[:, (conf_edge_index >= 0).all(dim=0)]
+
+    if batch is None:
+        batch = torch.zeros(n_nodes, dtype=torch.long, device=device)
+    num_graphs = int(batch.max()) + 1
+    # Graph of each node in each conformation, conformation-major: [n_conf, n_nodes]
+    conf_batch = batch.unsqueeze(0) + num_graphs * torch.arange(n_conf, device=device).unsqueeze(1)
+    return keep, graph_blocks(conf_batch[keep])
+
+def graph_blocks(batch):
+    '''
+    Groups the graphs of a batch into blocks of graphs of similar size
+    for per-graph attention, see `GraphAttentionLayer.block_attention`.
+
+    Graphs are sorted by size and each block holds graphs with more than 
+    half the nodes of its largest graph, so that padding graphs to the 
+    size of the largest graph of their block at most quadruples the sum 
+    of squared graph sizes.
+
+    :param batch: graph index of each node of shape [n_nodes], with
+                  the nodes of each graph contiguous (as in PyG batches)
+    :return: list of (index, valid) tuples per block, where `index` of shape
+             [n_graphs, max_len] holds the nodes of each graph of the block
+             (padded with node 0) and `valid` masks the padding
+    '''
+    lengths = torch.bincount(batch)
+    ptr = torch.cumsum(lengths, dim=0) - lengths
+    order = torch.argsort(lengths, descending=True)
+    sorted_lengths = lengths[order].tolist()
+
+    blocks, start = [], 0
+    while start < len(sorted_lengths) and sorted_lengths[start] > 0:
+        max_len, end = sorted_lengths[start], start
+        while end < len(sorted_lengths) and 2 * sorted_lengths[end] > max_len:
+            end += 1
+        graphs = order[start:end]
+        pos = torch.arange(max_len, device=batch.device)
+        valid = pos.unsqueeze(0) < lengths[graphs].unsqueeze(1)
+        index = (ptr[graphs].unsqueeze(1) + pos).masked_fill(~valid, 0)
+        blocks.append((index, valid))
+        start = end
+    return blocks
 
 def tuple_sum(*args):
     '''
@@ -917,11 +1578,14 @@ def randn(n, dims, device="cpu"):
 def _norm_no_nan(x, axis=-1, keepdims=False, eps=1e-8, sqrt=True):
     '''
     L2 norm of tensor clamped above a minimum value `eps`.
+    Computed in fp32 and cast back to the dtype of `x`, as squared
+    norms easily over- or underflow in reduced precision.
     
     :param sqrt: if `False`, returns the square of the L2 norm
     '''
-    out = torch.clamp(torch.sum(torch.square(x), axis, keepdims), min=eps)
-    return torch.sqrt(out) if sqrt else out
+    out = torch.clamp(torch.sum(torch.square(x.float()), axis, keepdims), min=eps)
+    out = torch.sqrt(out) if sqrt else out
+    return out.to(x.dtype)
 
 def _split(x, nv):
     '''
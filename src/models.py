@@ -9,11 +9,14 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 from torch.distributions import Categorical
+from torch.utils.checkpoint import checkpoint
 import torch_geometric
 
 from src.layers import *
-from src.sampling import choose_nts
-from src.constants import LETTER_TO_NUM
+from src.sampling import (
+    choose_nts, BeamSearch, ForbiddenSequenceAutomaton, PrefixGroups,
+    is_per_sample, per_sample_params, active_params, update_temperature
+)
 
 class AutoregressiveMultiGNNv2(torch.nn.Module):
     '''
@@ -36,8 +39,18 @@ class AutoregressiveMultiGNNv2(torch.nn.Module):
         drop_rate (float): rate to use in all dropout layers
         out_dim (int): output dimension (4 bases)
         max_moment_order (int): Maximum order of tensor moments to compute
+        moment_rank (int): If given, second-order moments are computed over a learnt
+            projection of node features to `moment_rank` dimensions (moment_rank^2 
+            features instead of d^2), see `low_rank_moment_pooling`
         attention_heads (int): Number of attention heads in the hybrid GVP-attention layer
         attention_dropout (float): Dropout rate for attention weights
+        attention_chunk_size (int): Tile size for memory-efficient chunked attention
+            over long RNAs (dense attention if None)
+        attention_mode (str): 'dense' to attend over all pairs of nodes, or 'edge'
+            to only attend over edges of the kNN graph (linear in the number of nodes)
+        checkpoint_every (int): If given, activations of the encoder and decoder
+            layers are recomputed in the backward pass during training, keeping
+            only the inputs of every `checkpoint_every` layers, see `run_layers`
     '''
     def __init__(
         self,
@@ -51,6 +64,10 @@ class AutoregressiveMultiGNNv2(torch.nn.Module):
         attention_heads = 4,  
         attention_dropout = 0.1,  
         max_moment_order = 2,  
+        attention_chunk_size = None,
+        attention_mode = 'dense',
+        moment_rank = None,
+        checkpoint_every = None,
     ):
         super().__init__()
         self.node_in_dim = node_in_dim
@@ -60,6 +77,9 @@ class AutoregressiveMultiGNNv2(torch.nn.Module):
         self.num_layers = num_layers
         self.out_dim = out_dim
         self.max_moment_order = max_moment_order
+        self.moment_rank = moment_rank
+        self.checkpoint_every = checkpoint_every
+        self.attention_mode = attention_mode
         activations = (F.silu, None)
         
         # Node input embedding
@@ -82,12 +102,18 @@ class AutoregressiveMultiGNNv2(torch.nn.Module):
                                       activations=activations, vector_gate=True,
                                       drop_rate=drop_rate, norm_first=True,
                                       n_heads=attention_heads, 
-                                      attention_dropout=attention_dropout)  
+                                      attention_dropout=attention_dropout,
+                                      attention_chunk_size=attention_chunk_size,
+                                      attention_mode=attention_mode)  
             for _ in range(num_layers))
 
         # MLP for tensor moment pooling (psi): calculate input dimension: d + d^2 + ... + d^p (where d is node_h_dim[0])
         d = self.node_h_dim[0]
         moment_dim = sum(d**order for order in range(1, self.max_moment_order + 1))
+        if self.moment_rank is not None:
+            # Second-order moments of features projected to moment_rank dimensions
+            self.moment_proj = nn.Linear(d, self.moment_rank, bias=False)
+            moment_dim = moment_dim - d**2 + self.moment_rank**2
         self.psi = nn.Sequential(
             nn.Linear(moment_dim, 2 * d),
             nn.SiLU(),
@@ -103,7 +129,9 @@ class AutoregressiveMultiGNNv2(torch.nn.Module):
                                  activations=activations, vector_gate=True, 
                                  drop_rate=drop_rate, norm_first=True,
                                  n_heads=attention_heads,
-                                 attention_dropout=attention_dropout) 
+                                 attention_dropout=attention_dropout,
+                                 attention_chunk_size=attention_chunk_size,
+                                 attention_mode=attention_mode) 
             for _ in range(num_layers))
         
         # Output
@@ -112,30 +140,61 @@ class AutoregressiveMultiGNNv2(torch.nn.Module):
     def forward(self, batch):
 
         h_V = (batch.node_s, batch.node_v)
-        h_E = (batch.edge_s, batch.edge_v)
+        h_E = edge_input_features(batch.edge_s, batch.edge_v, getattr(batch, 'edge_posenc', None))
         edge_index = batch.edge_index
         seq = batch.seq
 
+        # Restrict attention to nodes of the same graph
+        is_batch = isinstance(batch, torch_geometric.data.Batch)
+        node_batch = batch.batch if is_batch and batch.num_graphs > 1 else None
+
         h_V = self.W_v(h_V)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
         h_E = self.W_e(h_E)  # (n_edges, n_conf, d_se), (n_edges, n_conf, d_ve, 3)
 
-        for layer in self.encoder_layers:
-            h_V = layer(h_V, edge_index, h_E)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
+        # Attention graph of all conformations, shared by all encoder layers
+        conf_graph = conformer_attention_graph(*h_V[0].shape[:2], edge_index, node_batch, batch.mask_confs,
+                                               self.attention_mode, edge_index.device)
+
+        # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
+        h_V = run_layers(self.encoder_layers, h_V, edge_index, h_E, conf_graph=conf_graph,
+                         checkpoint_every=self.checkpoint_every if self.training else None)
 
         # Pool multi-conformation features: 
         # nodes: (n_nodes, d_s), (n_nodes, d_v, 3)
         # edges: (n_edges, d_se), (n_edges, d_ve, 3)
         h_V, h_E = self.pool_multi_conf(h_V, h_E, batch.mask_confs, edge_index)
 
+        logits = self.decode(h_V, h_E, edge_index, seq, batch=node_batch)
+        
+        return logits
+
+    def decode(self, h_V, h_E, edge_index, seq, batch=None):
+        '''
+        Teacher-forced decoder pass: logits at each position given the
+        pooled encoder features and the tokens of `seq` at previous positions.
+
+        Args:
+            h_V (tuple): pooled node features (n_nodes, d_s), (n_nodes, d_v, 3)
+            h_E (tuple): pooled edge features (n_edges, d_se), (n_edges, d_ve, 3)
+            edge_index (torch.Tensor): edge indices [2, n_edges]
+            seq (torch.Tensor): int tensor of tokens of shape [n_nodes]
+            batch (torch.Tensor, optional): graph index of each node [n_nodes];
+                if given, causal attention is restricted to nodes of the same graph
+        Returns:
+            logits (torch.Tensor): logits of shape [n_nodes, 4]
+        '''
         encoder_embeddings = h_V
         
         h_S = self.W_s(seq)
         h_S = h_S[edge_index[0]]
         h_S[edge_index[0] >= edge_index[1]] = 0
         h_E = (torch.cat([h_E[0], h_S], dim=-1), h_E[1])
+
+        # Blocks of graphs for causal attention, shared by all decoder layers
+        blocks = graph_blocks(batch) if batch is not None and self.attention_mode == 'dense' else None
         
-        for layer in self.decoder_layers:
-            h_V = layer(h_V, edge_index, h_E, autoregressive_x = encoder_embeddings)
+        h_V = run_layers(self.decoder_layers, h_V, edge_index, h_E, autoregressive_x = encoder_embeddings, batch = batch,
+                         blocks = blocks, checkpoint_every=self.checkpoint_every if self.training else None)
         
         logits = self.W_out(h_V)
         
@@ -143,40 +202,40 @@ class AutoregressiveMultiGNNv2(torch.nn.Module):
 
 
     @torch.no_grad()
-    def convert_sequences_to_tensors(self, sequences, device):
-        '''
-        Convert a list of sequences to a list of tensors
+    def encode(self, batch):
         '''
-        avoid_tensors = []
-        for seq_str in sequences:
-            seq_tensor = torch.tensor([LETTER_TO_NUM[residue] for residue in seq_str], device=device)
-            avoid_tensors.append(seq_tensor)
-        return avoid_tensors
+        Encodes RNA backbones into the pooled node and edge features
+        used by the decoder in `self.sample`.
 
-
-    @torch.no_grad()
-    def prevent_forbidden_sequences(self, lgts, idx, seq, avoid_tensors, beam_width, n_samples, num_nodes, device):
-        '''
-        Prevent forbidden sequences from being generated
+        Args:
+            batch (torch_geometric.data.Data or torch_geometric.data.Batch): 
+                one RNA backbone, or a batch of RNA backbones
+        Returns:
+            h_V (tuple): pooled node features (n_nodes, d_s), (n_nodes, d_v, 3)
+            h_E (tuple): pooled edge features (n_edges, d_se), (n_edges, d_ve, 3)
         '''
-        for avoid_seq in avoid_tensors:
-            # only if about to complete an avoid_seq pattern
-            if idx >= len(avoid_seq) - 1:
-                sequence_reshaped = seq.view(beam_width*n_samples, num_nodes)
-                start_idx = idx - (len(avoid_seq) - 1)
-                if start_idx < 0:
-                    seq_window = torch.zeros((beam_width*n_samples, len(avoid_seq)-1), dtype=torch.long, device=device)
-                else:
-                    seq_window = sequence_reshaped[:, start_idx:idx]
-                avoid_window = avoid_seq[:-1]
-                            
-                if len(avoid_window) == seq_window.size(1):
-                    matches = torch.all(seq_window == avoid_window.unsqueeze(0), dim=1)
-                    if torch.any(matches):
-                        mask = matches
-                        lgts[mask, avoid_seq[-1]] = float('-inf')
-        return lgts
+        h_V = (batch.node_s, batch.node_v)
+        h_E = edge_input_features(batch.edge_s, batch.edge_v, getattr(batch, 'edge_posenc', None))
+        edge_index = batch.edge_index
+
+        # Restrict attention to nodes of the same graph
+        is_batch = isinstance(batch, torch_geometric.data.Batch)
+        node_batch = batch.batch if is_batch and batch.num_graphs > 1 else None
+        
+        h_V = self.W_v(h_V)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
+        h_E = self.W_e(h_E)  # (n_edges, n_conf, d_se), (n_edges, n_conf, d_ve, 3)
 
+        # Attention graph of all conformations, shared by all encoder layers
+        conf_graph = conformer_attention_graph(*h_V[0].shape[:2], edge_index, node_batch, batch.mask_confs,
+                                               self.attention_mode, edge_index.device)
+        
+        for layer in self.encoder_layers:
+            h_V = layer(h_V, edge_index, h_E, conf_graph=conf_graph)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
+        
+        # Pool multi-conformation features
+        # nodes: (n_nodes, d_s), (n_nodes, d_v, 3)
+        # edges: (n_edges, d_se), (n_edges, d_ve, 3)
+        return self.pool_multi_conf(h_V, h_E, batch.mask_confs, edge_index)
 
     @torch.no_grad()
     def sample(
@@ -192,185 +251,282 @@ class AutoregressiveMultiGNNv2(torch.nn.Module):
             sampling_value: Optional[float] = 0.0,
             max_temperature: Optional[float] = 0.5,
             temperature_factor: Optional[float] = 0,
-            avoid_sequences: Optional[list] = None
+            avoid_sequences: Optional[list] = None,
+            use_kv_cache: Optional[bool] = True,
+            encoder_outputs: Optional[tuple] = None,
+            share_prefixes: Optional[bool] = False
         ):
         '''
         Samples sequences autoregressively from the distribution
         learned by the model.
 
+        Several backbones of different lengths can be designed in one pass
+        by passing a `torch_geometric.data.Batch`: all graphs are decoded in
+        lockstep, position by position, and graphs stop being decoded once
+        all of their positions are designed.
+
         Args:
-            batch (torch_geometric.data.Data): mini-batch containing one
-                RNA backbone to design sequences for
-            n_samples (int): number of samples
-            temperature (float): temperature to use in softmax over 
+            batch (torch_geometric.data.Data or torch_geometric.data.Batch): 
+                one RNA backbone, or a batch of RNA backbones, to design 
+                sequences for
+            n_samples (int or list): number of samples (per graph, if a list)
+            temperature (float or list): temperature to use in softmax over 
                 the categorical distribution
             logit_bias (torch.Tensor): bias to add to logits during sampling
                 to manually fix or control nucleotides in designed sequences,
-                of shape [n_nodes, 4]
+                of shape [n_nodes, 4] (over all nodes of the batch)
             return_logits (bool): whether to return logits or 
-            sampling_strategy (str): one of "categorical", "greedy", "top_k", "top_p", "min_p", etc.
-            sampling_value (float): value for sampling strategy
+            sampling_strategy (str or list): one of "categorical", "top_k", "top_p", "min_p"
+            sampling_value (float or list): value for sampling strategy
+                Sampling parameters can also be given per sample, as lists or 
+                tensors of shape [n_samples_total] (samples of each graph in 
+                batch order), to evaluate several sampling settings in one pass
             beam_width (int): number of beams to maintain during search
             beam_branch (int): number of samples to get from sampling strategy
             avoid_sequences (list): list of sequences to avoid
+            use_kv_cache (bool): whether to decode the attention branch
+                incrementally, caching keys/values of decoded positions
+                per sequence so that each step only computes the new
+                query rows; if `False`, causal attention is recomputed
+                over all nodes of all sequences at every step
+            encoder_outputs (tuple): pooled node and edge features of `batch`
+                as returned by `self.encode`, to skip the encoder (e.g. when 
+                sampling repeatedly for the same backbones)
+            share_prefixes (bool): whether to decode only one copy per group of
+                copies with identical decoded prefixes and share its decoder 
+                states and logits within the group, which saves decoder compute
+                at low temperatures without changing the designed sequences
         Returns:
             seq (torch.Tensor): int tensor of shape [n_samples, n_nodes]
                                 based on the residue-to-int mapping of
                                 the original training data
             logits (torch.Tensor): logits of shape [n_samples, n_nodes, 4]
                                    (only if return_logits is True)
+            If `batch` is a `torch_geometric.data.Batch`, lists with one
+            such tensor per graph are returned instead, also for a `Batch`
+            of a single graph (`batch.num_graphs == 1`); tensors are only 
+            returned for a `torch_geometric.data.Data`.
         ''' 
-        h_V = (batch.node_s, batch.node_v)
-        h_E = (batch.edge_s, batch.edge_v)
         edge_index = batch.edge_index
     
         device = edge_index.device
-        num_nodes = h_V[0].shape[0]
-        
-        h_V = self.W_v(h_V)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
-        h_E = self.W_e(h_E)  # (n_edges, n_conf, d_se), (n_edges, n_conf, d_ve, 3)
+        is_batch = isinstance(batch, torch_geometric.data.Batch)
+        num_graphs = batch.num_graphs if is_batch else 1
+        node_batch = batch.batch if is_batch else torch.zeros(batch.num_nodes, dtype=torch.long, device=device)
+        if isinstance(n_samples, int):
+            n_samples = [n_samples] * num_graphs
         
-        for layer in self.encoder_layers:
-            h_V = layer(h_V, edge_index, h_E)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
-        
-        # Pool multi-conformation features
+        # Pooled encoder features
         # nodes: (n_nodes, d_s), (n_nodes, d_v, 3)
         # edges: (n_edges, d_se), (n_edges, d_ve, 3)
-        h_V, h_E = self.pool_multi_conf(h_V, h_E, batch.mask_confs, edge_index)
+        if encoder_outputs is None:
+            encoder_outputs = self.encode(batch)
+        h_V, h_E = encoder_outputs
         
-        # Repeat features for sampling n_samples times
-        # might have to change this
-        h_V = (h_V[0].repeat(beam_width*n_samples, 1),
-            h_V[1].repeat(beam_width*n_samples, 1, 1))
-        h_E = (h_E[0].repeat(beam_width*n_samples, 1),
-            h_E[1].repeat(beam_width*n_samples, 1, 1))
+        # Copies of each graph to decode, and their incoming edges per position
+        layout = DecodingGraph(edge_index, node_batch, n_samples, beam_width)
+        num_nodes = layout.num_nodes  # positions to decode (of the longest graph)
 
-        # Expand edge index for autoregressive decoding
-        edge_index = edge_index.expand(beam_width*n_samples, -1, -1)
-        offset = num_nodes * torch.arange(beam_width*n_samples, device=device).view(beam_width*n_samples, 1, 1)
+        # Repeat node features for sampling n_samples times
+        h_V = (h_V[0][layout.node_index], h_V[1][layout.node_index])
 
-        edge_index = torch.cat(tuple(edge_index + offset), dim=-1)
-        # This is akin to 'batching' (in PyG style) n_samples copies of the graph
+        # Sampling parameters per copy, if given per sample
+        if is_per_sample(sampling_strategy, sampling_value, temperature):
+            sampling_strategy, sampling_value, temperature = (layout.copy_values(p) for p in per_sample_params(
+                sum(n_samples), sampling_strategy, sampling_value, temperature, device))
         
-        scores = torch.zeros(beam_width*n_samples, dtype=torch.float, device=device)  # cumulative log-probability
-        seq = torch.zeros(beam_width*num_nodes*n_samples, dtype=torch.int, device=device)  # decoded tokens (to be filled)
-        h_S = torch.zeros(beam_width*num_nodes*n_samples, self.out_dim, device=device)
+        # Beam search state: decoded tokens, logits and scores per step
+        beam = BeamSearch(layout.n_samples, beam_width, beam_branch, num_nodes, self.out_dim, device)
+        # Embeddings of decoded tokens (to be filled)
+        h_S = torch.zeros(layout.n_dec_nodes, self.out_dim, device=device)
         # Each decoder layer keeps its own cache (here cloned from the pooled encoder features)
         h_V_cache = [(h_V[0].clone(), h_V[1].clone()) for _ in self.decoder_layers]
-        # Optionally, you can store logits for later inspection
-        logits = torch.zeros(beam_width*num_nodes*n_samples, self.out_dim, device=device)
+        # Key/value caches for the attention branch of each decoder layer
+        # ('edge' attention reads keys/values of neighbours from `h_V_cache` instead)
+        if use_kv_cache:
+            kv_caches = [layer.attention_branch.init_cache(layout.n_copies, num_nodes, device)
+                         if layer.attention_branch.mode == 'dense' else None
+                         for layer in self.decoder_layers]
+        
+        # Groups of copies with identical decoded prefixes
+        if share_prefixes:
+            prefixes = PrefixGroups(layout.copy_graph, self.out_dim)
         
-        # Convert avoid_sequences to tensor format if provided
+        # Compile avoid_sequences into an automaton tracking each copy's matches, if provided
         if avoid_sequences is not None:
-            avoid_tensors = self.convert_sequences_to_tensors(avoid_sequences, device)
+            automaton = ForbiddenSequenceAutomaton(avoid_sequences, self.out_dim, device)
+            automaton_states = automaton.init_states(layout.n_copies)
 
         # Decode one token at a time
         for i in range(num_nodes):
 
             # --- Prepare messages for decoding token at position i ---
-            # In the original sample(), h_S is used via indexing with edge_index.
-            # Here we prepare the subset h_S_ corresponding to incoming edges for node i.
-            h_S_ = h_S[edge_index[0]]
-            # Zero out contributions from nodes not yet decoded:
-            h_S_[edge_index[0] >= edge_index[1]] = 0
+            # Select only the incoming edges for node i, in all copies still being decoded:
+            edge_index_, edge_ids = layout.edges(i)
+
+            # Indices of the current node i in all copies still being decoded
+            node_mask = layout.nodes(i)
+            n_active = node_mask.size(0)
+
+            # Only decode one copy per group of copies with identical prefixes
+            shared = prefixes.groups(n_active) if share_prefixes else None
+            if share_prefixes:
+                rep_copies, copy_group = shared
+                is_rep = torch.zeros(layout.n_copies, dtype=torch.bool, device=device)
+                is_rep[rep_copies] = True
+                rep_edges = is_rep[layout.node_copy[edge_index_[1]]]
+                edge_index_, edge_ids = edge_index_[:, rep_edges], edge_ids[rep_edges]
+                decode_mask = layout.copy_ptr[rep_copies] + i
+            else:
+                decode_mask = node_mask
 
-            # Concatenate h_S_ with edge features
-            h_E_ = (torch.cat([h_E[0], h_S_], dim=-1), h_E[1])
-            # Select only the incoming edges for node i:
-            edge_mask = edge_index[1] % num_nodes == i  # True for all edges where dst is node i
-            edge_index_ = edge_index[:, edge_mask]  # subset all incoming edges to node i
-            h_E_ = tuple_index(h_E_, edge_mask)
+            # Prepare the subset h_S_ corresponding to incoming edges for node i
+            h_S_ = h_S[edge_index_[0]]
+            # Zero out contributions from nodes not yet decoded:
+            h_S_[edge_index_[0] >= edge_index_[1]] = 0
 
-            # Create a mask that is True only for the current node i (across all copies in the beam)
-            node_mask = torch.zeros(beam_width*n_samples*num_nodes, device=device, dtype=torch.bool)
-            node_mask[i::num_nodes] = True  # True for all nodes i and its repeats
-            # not entirely sure if the thing above is correct
+            # Concatenate h_S_ with edge features (shared by all copies)
+            h_E_ = (torch.cat([h_E[0][edge_ids], h_S_], dim=-1), h_E[1][edge_ids])
 
             # --- Pass through decoder layers ---
             # We simulate the same decoder forward pass as in sample(), updating the cache.
             for j, layer in enumerate(self.decoder_layers):
-                out = layer(h_V_cache[j], edge_index_, h_E_,
-                        autoregressive_x=h_V_cache[0], node_mask=node_mask)
-                out = tuple_index(out, node_mask)  # subset out to only node i and its repeats
+                if use_kv_cache:
+                    out = layer.decode_step(h_V_cache[j], edge_index_, h_E_,
+                            autoregressive_x=h_V_cache[0], node_mask=decode_mask,
+                            kv_cache=kv_caches[j], shared=shared)
+                else:
+                    out = layer(h_V_cache[j], edge_index_, h_E_,
+                            autoregressive_x=h_V_cache[0], node_mask=decode_mask)
+                    out = tuple_index(out, decode_mask)  # subset out to only node i and its repeats
+                if share_prefixes:
+                    out = tuple_index(out, copy_group)  # copies share the states of their group
                 # Update the cache for the next layer if needed
                 if j < len(self.decoder_layers)-1:
-                    h_V_cache[j+1][0][i::num_nodes] = out[0]
-                    h_V_cache[j+1][1][i::num_nodes] = out[1]
-            # Final logits for node i:
-            lgts = self.W_out(out)
+                    h_V_cache[j+1][0][node_mask] = out[0]
+                    h_V_cache[j+1][1][node_mask] = out[1]
+            # Final logits for node i (sampled from in fp32):
+            lgts = self.W_out(out).float()
 
             # Add logit bias if provided to fix or bias positions
             if logit_bias is not None:
-                lgts += logit_bias[i]
+                lgts += logit_bias[layout.node_index[node_mask]]
 
             # Add negative infinity to logits for sequences to avoid
             if avoid_sequences is not None:
-                lgts = self.prevent_forbidden_sequences(lgts, i, seq, avoid_tensors, beam_width, n_samples, num_nodes, device)
+                lgts = automaton.mask_logits(lgts, automaton_states[:n_active])
             
             # Sample from logits
             # Make temperature dependent of sequence length being decoded to increase
             # stochasticity in beams as we progress through the sequence
-            temperature_init = temperature
-            temperature = min(temperature_init + temperature * temperature_factor * i, max_temperature)
-            top_tokens, log_probs = choose_nts(lgts, strategy=sampling_strategy, beam_branch=beam_branch,
-                                    temperature=temperature, sampling_value=sampling_value)
+            temperature = update_temperature(temperature, i, temperature_factor, max_temperature)
+            strategy_, sampling_value_, temperature_ = active_params(
+                lgts.size(0), sampling_strategy, sampling_value, temperature)
+            top_tokens, log_probs = choose_nts(lgts, strategy=strategy_, beam_branch=beam_branch,
+                                    temperature=temperature_, sampling_value=sampling_value_)
 
             # log probs will return probabilities for each nucleotide type
             # top tokens will return beam_branch samples of tokens for each of the sequences in n_samples
-            # For each candidate token, create a new beam candidate.
-            new_beam_seq = seq.clone().repeat(beam_branch, 1)
-            new_beam_h_S = h_S.clone().repeat(beam_branch, 1, 1)
-            new_beam_logits = logits.clone().repeat(beam_branch, 1, 1)
-
-            top_log_probs_beam = log_probs.gather(dim=1, index=top_tokens)
-            top_log_probs_beam = top_log_probs_beam.transpose(0, 1)
-
-            new_beam_scores = scores.repeat(beam_branch, 1) + top_log_probs_beam
-            new_beam_seq[:,i::num_nodes] = top_tokens.transpose(0,1)
-            new_beam_logits[:,i::num_nodes] = lgts  # store the logits for analysis
-            new_beam_h_S[:,i::num_nodes] = self.W_s(new_beam_seq[:,i::num_nodes]) # weird [0] indexing
-            
-            sorted_scores, sorted_indices = torch.sort(new_beam_scores, dim=0, descending=True)
-            new_beam_seq[:,i::num_nodes] = torch.gather(new_beam_seq[:,i::num_nodes], dim=0, index=sorted_indices)
-
-            # reorganize h_S and logits
-            expanded_indices = sorted_indices.unsqueeze(-1).expand(-1, -1, new_beam_h_S[:, i::num_nodes].size(-1))
-            new_beam_h_S[:,i::num_nodes] =  torch.gather(new_beam_h_S[:,i::num_nodes], dim=0, index=expanded_indices)
-            new_beam_logits[:,i::num_nodes] =  torch.gather(new_beam_logits[:,i::num_nodes], dim=0, index=expanded_indices)
-
-            # update metrics for both beams
-            seq[i::num_nodes] = new_beam_seq[0,i::num_nodes]
-            logits[i::num_nodes] = new_beam_logits[0,i::num_nodes]
-            h_S[i::num_nodes] = new_beam_h_S[0,i::num_nodes]
-
-            scores = sorted_scores[0]            
+            # Keep the best candidate token for each copy
+            tokens = beam.step(i, top_tokens, log_probs, lgts)
+            h_S[node_mask] = self.W_s(tokens)
+            if avoid_sequences is not None:
+                automaton_states[:n_active] = automaton.step(automaton_states[:n_active], tokens)
+            if share_prefixes:
+                prefixes.step(tokens)
         
-        # get ordered scores
-        beamw_scores = scores.view(beam_width, -1)
-        beamw_sorted_scores, beamw_sorted_indices = torch.sort(beamw_scores, dim=0, descending=True)
-
-        # reshape tensors
-        final_seq = seq.view(beam_width, n_samples, num_nodes)
-        final_logits = logits.view(beam_width, n_samples, num_nodes, self.out_dim)
-
-        # reorganize according to indices
-        expanded_indices = beamw_sorted_indices.unsqueeze(-1).expand(-1, n_samples, num_nodes)
-        final_seq = torch.gather(final_seq, dim=0, index=expanded_indices)
-        expanded_indices = beamw_sorted_indices.unsqueeze(-1).unsqueeze(-1).expand(-1, n_samples, num_nodes, self.out_dim)
-        final_logits = torch.gather(final_logits, dim=0, index=expanded_indices)
-
-        # use sorted indices to get final tensors
-        final_scores = beamw_sorted_scores[0]
-        final_seq = final_seq[0]
-        final_logits = final_logits[0]
+        # Highest scoring beam per sample
+        final_seq, final_logits = beam.finalize()
+        final_seq, final_logits = layout.unbatch(final_seq), layout.unbatch(final_logits)
+        if not is_batch:
+            final_seq, final_logits = final_seq[0], final_logits[0]
 
         if return_logits:
-            return final_seq.view(n_samples, num_nodes), final_logits.view(n_samples, num_nodes, self.out_dim)
+            return final_seq, final_logits
         else:    
-            return final_seq.view(n_samples, num_nodes)
+            return final_seq
         
         
-    def pool_multi_conf(self, h_V, h_E, mask_confs, edge_index):
+    def moment_pooling(self, X, n_conf_true, chunk_size=256):
+        """
+        First layer of `self.psi` applied to the concatenated tensor moments
+        of node scalar features over conformations, without materializing 
+        the concatenated moments.
+
+        The first-layer weights are split into one block per moment, so that
+        each moment is mapped to the hidden dimension separately. The d^2 
+        second-order moments are computed for `chunk_size` nodes at a time,
+        as Gram matrices over conformations (or over a projection to
+        `moment_rank` dimensions for all nodes at once, if set).
+        
+        Args:
+            X: masked node scalar features [n_nodes, n_conf, d]
+            n_conf_true: number of valid conformations per node [n_nodes, 1]
+            chunk_size: number of nodes per chunk for full second-order moments
+                (all nodes at once if None, which has no data-dependent control
+                flow, see `src.export`)
+        
+        Returns:
+            Hidden features of `self.psi` (before its activation) [n_nodes, 2d]
+        """
+        n_nodes, _, d = X.shape
+        # One block of the first layer of psi per moment (separate modules 
+        # if split by `split_linear_blocks`, e.g. for quantization)
+        if hasattr(self, 'psi_blocks'):
+            blocks = list(self.psi_blocks)
+        else:
+            blocks = linear_blocks(self.psi[0], self.moment_block_sizes())
+
+        # First-order moment (mean)
+        out = blocks[0](X.sum(dim=1) / n_conf_true)
+
+        for order, block in zip(range(2, self.max_moment_order + 1), blocks[1:]):
+            if order == 2 and self.moment_rank is None and chunk_size is None:
+                # Second-order moment: mean of X_i ⊗ X_i over conformations, for all nodes at once
+                moment = block(torch.bmm(X.transpose(1, 2), X).flatten(start_dim=1))
+            elif order == 2 and self.moment_rank is None:
+                # Second-order moment: mean of X_i ⊗ X_i over conformations
+                moment = torch.cat([
+                    block(torch.bmm(X_chunk.transpose(1, 2), X_chunk).flatten(start_dim=1))
+                    for X_chunk in X.split(chunk_size)
+                ]) if n_nodes > 0 else out.new_zeros(0, out.shape[-1])
+            elif order == 2:
+                # Second-order moment of projected features (padded conformations stay zero)
+                Z = self.moment_proj(X)  # [n_nodes, n_conf, moment_rank]
+                moment = block(torch.bmm(Z.transpose(1, 2), Z).flatten(start_dim=1))
+            else:
+                # For higher orders, implementation would be more complex
+                # Here we approximate with element-wise powers for efficiency
+                moment = block((X ** order).sum(dim=1))
+            # Normalize by number of valid conformations
+            out = out + moment / n_conf_true
+        
+        return out
+
+    def moment_block_sizes(self):
+        """
+        Sizes of the blocks of inputs of the first layer of `self.psi` read
+        by `moment_pooling`, one per moment (the element-wise approximation 
+        of higher-order moments only reads `d` inputs per order, and the 
+        remaining inputs are never read).
+        """
+        d = self.node_h_dim[0]
+        sizes = [d]
+        for order in range(2, self.max_moment_order + 1):
+            if order == 2:
+                sizes.append(d**2 if self.moment_rank is None else self.moment_rank**2)
+            else:
+                sizes.append(d)
+        return sizes
+
+    def split_linear_blocks(self):
+        """
+        Splits the first layer of `self.psi` into one `nn.Linear` module per
+        moment, which `moment_pooling` then calls instead of slicing its weights.
+        """
+        self.psi_blocks = split_linear(self.psi[0], self.moment_block_sizes())
+
+    def pool_multi_conf(self, h_V, h_E, mask_confs, edge_index, moment_chunk_size=256):
         """
         Pool multi-conformation features using tensor moment pooling for node scalar features.
         This implements a universal set aggregator as described by Maron et al.
@@ -380,6 +536,8 @@ class AutoregressiveMultiGNNv2(torch.nn.Module):
             h_E: Tuple of (scalar_features, vector_features) for edges
             mask_confs: Boolean mask indicating valid conformations [n_nodes, n_conf]
             edge_index: Edge index tensor of shape [2, n_edges]
+            moment_chunk_size: number of nodes per chunk for second-order moments,
+                see `moment_pooling`
             
         Returns:
             Pooled node and edge features
@@ -396,52 +554,9 @@ class AutoregressiveMultiGNNv2(torch.nn.Module):
         mask = mask_confs.unsqueeze(2)  # (n_nodes, n_conf, 1)
         h_V0_masked = h_V[0] * mask  # [n_nodes, n_conf, d]
         
-        # Initialize list to store moments
-        moments_list = []
-        
-        # Calculate moments up to max_moment_order
-        for order in range(1, self.max_moment_order + 1):
-            if order == 1:
-                # First-order moment (mean)
-                moment = h_V0_masked.sum(dim=1) / n_conf_true  # [n_nodes, d]
-                moments_list.append(moment)
-            else:
-                # Higher-order moments
-                moment = torch.zeros_like(h_V0_masked[:, 0])  # [n_nodes, d]
-                
-                for i in range(mask_confs.size(1)):
-                    # Only consider valid conformations
-                    conf_mask = mask_confs[:, i].bool()
-                    if not conf_mask.any():
-                        continue
-                        
-                    X_i = h_V0_masked[conf_mask, i]  # [n_valid_nodes, d]
-                    
-                    # For order=2, compute outer product X_i ⊗ X_i
-                    if order == 2:
-                        # Efficient implementation for order 2
-                        tensor_i = X_i.unsqueeze(2) * X_i.unsqueeze(1)  # [n_valid_nodes, d, d]
-                        tensor_i_flat = tensor_i.flatten(start_dim=1)  # [n_valid_nodes, d*d]
-                    else:
-                        # For higher orders, implementation would be more complex
-                        # Here we approximate with element-wise powers for efficiency
-                        tensor_i_flat = X_i ** order  # [n_valid_nodes, d]
-                    
-                    # Accumulate for this conformation
-                    if order == 2:
-                        moment[conf_mask] = moment[conf_mask] + tensor_i_flat
-                    else:
-                        moment[conf_mask] = moment[conf_mask] + tensor_i_flat
-                
-                # Normalize by number of valid conformations
-                moment = moment / n_conf_true
-                moments_list.append(moment)
-        
-        # Concatenate all moments
-        aggregated = torch.cat(moments_list, dim=1)  # [n_nodes, (d + d^2 + ... + d^p)]
-        
-        # Apply MLP to transform aggregated moments
-        h_V0_pooled = self.psi(aggregated)  # [n_nodes, d]
+        # Apply MLP to transform aggregated moments, with its first layer
+        # applied to each moment as it is computed
+        h_V0_pooled = self.psi[1:](self.moment_pooling(h_V0_masked, n_conf_true, moment_chunk_size))  # [n_nodes, d]
         
         # ==== REGULAR POOLING FOR NODE VECTOR FEATURES AND EDGE FEATURES ====
         # Mask vector features
@@ -480,6 +595,9 @@ class AutoregressiveMultiGNNv1(torch.nn.Module):
         num_layers (int): number of GVP-GNN layers in encoder/decoder
         drop_rate (float): rate to use in all dropout layers
         out_dim (int): output dimension (4 bases)
+        checkpoint_every (int): If given, activations of the encoder and decoder
+            layers are recomputed in the backward pass during training, keeping
+            only the inputs of every `checkpoint_every` layers, see `run_layers`
     '''
     def __init__(
         self,
@@ -489,7 +607,8 @@ class AutoregressiveMultiGNNv1(torch.nn.Module):
         edge_h_dim = (32, 1),
         num_layers = 3, 
         drop_rate = 0.1,
-        out_dim = 4
+        out_dim = 4,
+        checkpoint_every = None,
     ):
         super().__init__()
         self.node_in_dim = node_in_dim
@@ -498,6 +617,7 @@ class AutoregressiveMultiGNNv1(torch.nn.Module):
         self.edge_h_dim = edge_h_dim
         self.num_layers = num_layers
         self.out_dim = out_dim
+        self.checkpoint_every = checkpoint_every
         activations = (F.silu, None)
         
         # Node input embedding
@@ -536,21 +656,41 @@ class AutoregressiveMultiGNNv1(torch.nn.Module):
     def forward(self, batch):
 
         h_V = (batch.node_s, batch.node_v)
-        h_E = (batch.edge_s, batch.edge_v)
+        h_E = edge_input_features(batch.edge_s, batch.edge_v, getattr(batch, 'edge_posenc', None))
         edge_index = batch.edge_index
         seq = batch.seq
 
         h_V = self.W_v(h_V)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
         h_E = self.W_e(h_E)  # (n_edges, n_conf, d_se), (n_edges, n_conf, d_ve, 3)
 
-        for layer in self.encoder_layers:
-            h_V = layer(h_V, edge_index, h_E)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
+        # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
+        h_V = run_layers(self.encoder_layers, h_V, edge_index, h_E,
+                         checkpoint_every=self.checkpoint_every if self.training else None)
 
         # Pool multi-conformation features: 
         # nodes: (n_nodes, d_s), (n_nodes, d_v, 3)
         # edges: (n_edges, d_se), (n_edges, d_ve, 3)
         h_V, h_E = self.pool_multi_conf(h_V, h_E, batch.mask_confs, edge_index)
 
+        logits = self.decode(h_V, h_E, edge_index, seq)
+        
+        return logits
+
+    def decode(self, h_V, h_E, edge_index, seq, batch=None):
+        '''
+        Teacher-forced decoder pass: logits at each position given the
+        pooled encoder features and the tokens of `seq` at previous positions.
+
+        Args:
+            h_V (tuple): pooled node features (n_nodes, d_s), (n_nodes, d_v, 3)
+            h_E (tuple): pooled edge features (n_edges, d_se), (n_edges, d_ve, 3)
+            edge_index (torch.Tensor): edge indices [2, n_edges]
+            seq (torch.Tensor): int tensor of tokens of shape [n_nodes]
+            batch (torch.Tensor, optional): graph index of each node [n_nodes], 
+                unused as messages are only passed along edges within a graph
+        Returns:
+            logits (torch.Tensor): logits of shape [n_nodes, 4]
+        '''
         encoder_embeddings = h_V
         
         h_S = self.W_s(seq)
@@ -558,13 +698,41 @@ class AutoregressiveMultiGNNv1(torch.nn.Module):
         h_S[edge_index[0] >= edge_index[1]] = 0
         h_E = (torch.cat([h_E[0], h_S], dim=-1), h_E[1])
         
-        for layer in self.decoder_layers:
-            h_V = layer(h_V, edge_index, h_E, autoregressive_x = encoder_embeddings)
+        h_V = run_layers(self.decoder_layers, h_V, edge_index, h_E, autoregressive_x = encoder_embeddings,
+                         checkpoint_every=self.checkpoint_every if self.training else None)
         
         logits = self.W_out(h_V)
         
         return logits
     
+    @torch.no_grad()
+    def encode(self, batch):
+        '''
+        Encodes RNA backbones into the pooled node and edge features
+        used by the decoder in `self.sample`.
+
+        Args:
+            batch (torch_geometric.data.Data or torch_geometric.data.Batch): 
+                one RNA backbone, or a batch of RNA backbones
+        Returns:
+            h_V (tuple): pooled node features (n_nodes, d_s), (n_nodes, d_v, 3)
+            h_E (tuple): pooled edge features (n_edges, d_se), (n_edges, d_ve, 3)
+        '''
+        h_V = (batch.node_s, batch.node_v)
+        h_E = edge_input_features(batch.edge_s, batch.edge_v, getattr(batch, 'edge_posenc', None))
+        edge_index = batch.edge_index
+        
+        h_V = self.W_v(h_V)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
+        h_E = self.W_e(h_E)  # (n_edges, n_conf, d_se), (n_edges, n_conf, d_ve, 3)
+        
+        for layer in self.encoder_layers:
+            h_V = layer(h_V, edge_index, h_E)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
+        
+        # Pool multi-conformation features
+        # nodes: (n_nodes, d_s), (n_nodes, d_v, 3)
+        # edges: (n_edges, d_se), (n_edges, d_ve, 3)
+        return self.pool_multi_conf(h_V, h_E, batch.mask_confs, edge_index)
+
     @torch.no_grad()
     def sample(self,
             batch,
@@ -578,175 +746,169 @@ class AutoregressiveMultiGNNv1(torch.nn.Module):
             sampling_value: Optional[float] = 0.0,
             max_temperature: Optional[float] = 0.5,
             temperature_factor: Optional[float] = 0.0,
+            encoder_outputs: Optional[tuple] = None,
+            share_prefixes: Optional[bool] = False
         ):
         '''
         Samples sequences autoregressively from the distribution
         learned by the model.
 
+        Several backbones of different lengths can be designed in one pass
+        by passing a `torch_geometric.data.Batch`: all graphs are decoded in
+        lockstep, position by position, and graphs stop being decoded once
+        all of their positions are designed.
+
         Args:
-            batch (torch_geometric.data.Data): mini-batch containing one
-                RNA backbone to design sequences for
-            n_samples (int): number of samples
-            temperature (float): temperature to use in softmax over 
+            batch (torch_geometric.data.Data or torch_geometric.data.Batch): 
+                one RNA backbone, or a batch of RNA backbones, to design 
+                sequences for
+            n_samples (int or list): number of samples (per graph, if a list)
+            temperature (float or list): temperature to use in softmax over 
                 the categorical distribution
             logit_bias (torch.Tensor): bias to add to logits during sampling
                 to manually fix or control nucleotides in designed sequences,
-                of shape [n_nodes, 4]
+                of shape [n_nodes, 4] (over all nodes of the batch)
             return_logits (bool): whether to return logits or 
-            sampling_strategy (str): one of "categorical", "greedy", "top_k", "top_p", "min_p", etc.
-            top_k (int): if using top-k sampling, how many tokens to keep
-            top_p (float): if using nucleus (top-p) sampling, what cumulative probability threshold
-            min_p (float): if using min-p sampling, probability threshold w.r.t max prob
+            sampling_strategy (str or list): one of "categorical", "top_k", "top_p", "min_p"
+            sampling_value (float or list): value for sampling strategy
+                (tokens to keep for top_k, cumulative probability threshold for
+                top_p, probability threshold w.r.t. max prob for min_p)
+                Sampling parameters can also be given per sample, as lists or 
+                tensors of shape [n_samples_total] (samples of each graph in 
+                batch order), to evaluate several sampling settings in one pass
             beam_width (int): number of beams to maintain during search
             beam_branch (int): number of samples to get from sampling strategy
+            encoder_outputs (tuple): pooled node and edge features of `batch`
+                as returned by `self.encode`, to skip the encoder (e.g. when 
+                sampling repeatedly for the same backbones)
+            share_prefixes (bool): whether to decode only one copy per group of
+                copies with identical decoded prefixes and share its decoder 
+                states and logits within the group, which saves decoder compute
+                at low temperatures without changing the designed sequences
         Returns:
             seq (torch.Tensor): int tensor of shape [n_samples, n_nodes]
                                 based on the residue-to-int mapping of
                                 the original training data
             logits (torch.Tensor): logits of shape [n_samples, n_nodes, 4]
                                    (only if return_logits is True)
+            If `batch` is a `torch_geometric.data.Batch`, lists with one
+            such tensor per graph are returned instead, also for a `Batch`
+            of a single graph (`batch.num_graphs == 1`); tensors are only 
+            returned for a `torch_geometric.data.Data`.
         ''' 
-        h_V = (batch.node_s, batch.node_v)
-        h_E = (batch.edge_s, batch.edge_v)
         edge_index = batch.edge_index
     
         device = edge_index.device
-        num_nodes = h_V[0].shape[0]
-        
-        h_V = self.W_v(h_V)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
-        h_E = self.W_e(h_E)  # (n_edges, n_conf, d_se), (n_edges, n_conf, d_ve, 3)
-        
-        for layer in self.encoder_layers:
-            h_V = layer(h_V, edge_index, h_E)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
+        is_batch = isinstance(batch, torch_geometric.data.Batch)
+        num_graphs = batch.num_graphs if is_batch else 1
+        node_batch = batch.batch if is_batch else torch.zeros(batch.num_nodes, dtype=torch.long, device=device)
+        if isinstance(n_samples, int):
+            n_samples = [n_samples] * num_graphs
         
-        # Pool multi-conformation features
+        # Pooled encoder features
         # nodes: (n_nodes, d_s), (n_nodes, d_v, 3)
         # edges: (n_edges, d_se), (n_edges, d_ve, 3)
-        h_V, h_E = self.pool_multi_conf(h_V, h_E, batch.mask_confs, edge_index)
+        if encoder_outputs is None:
+            encoder_outputs = self.encode(batch)
+        h_V, h_E = encoder_outputs
         
-        # Repeat features for sampling n_samples times
-        # might have to change this
-        h_V = (h_V[0].repeat(beam_width*n_samples, 1),
-            h_V[1].repeat(beam_width*n_samples, 1, 1))
-        h_E = (h_E[0].repeat(beam_width*n_samples, 1),
-            h_E[1].repeat(beam_width*n_samples, 1, 1))
+        # Copies of each graph to decode, and their incoming edges per position
+        layout = DecodingGraph(edge_index, node_batch, n_samples, beam_width)
+        num_nodes = layout.num_nodes  # positions to decode (of the longest graph)
 
-        # Expand edge index for autoregressive decoding
-        edge_index = edge_index.expand(beam_width*n_samples, -1, -1)
-        offset = num_nodes * torch.arange(beam_width*n_samples, device=device).view(beam_width*n_samples, 1, 1)
+        # Repeat node features for sampling n_samples times
+        h_V = (h_V[0][layout.node_index], h_V[1][layout.node_index])
 
-        edge_index = torch.cat(tuple(edge_index + offset), dim=-1)
-        # This is akin to 'batching' (in PyG style) n_samples copies of the graph
+        # Sampling parameters per copy, if given per sample
+        if is_per_sample(sampling_strategy, sampling_value, temperature):
+            sampling_strategy, sampling_value, temperature = (layout.copy_values(p) for p in per_sample_params(
+                sum(n_samples), sampling_strategy, sampling_value, temperature, device))
         
-        scores = torch.zeros(beam_width*n_samples, dtype=torch.float, device=device)  # cumulative log-probability
-        seq = torch.zeros(beam_width*num_nodes*n_samples, dtype=torch.int, device=device)  # decoded tokens (to be filled)
-        h_S = torch.zeros(beam_width*num_nodes*n_samples, self.out_dim, device=device)
+        # Beam search state: decoded tokens, logits and scores per step
+        beam = BeamSearch(layout.n_samples, beam_width, beam_branch, num_nodes, self.out_dim, device)
+        # Embeddings of decoded tokens (to be filled)
+        h_S = torch.zeros(layout.n_dec_nodes, self.out_dim, device=device)
         # Each decoder layer keeps its own cache (here cloned from the pooled encoder features)
         h_V_cache = [(h_V[0].clone(), h_V[1].clone()) for _ in self.decoder_layers]
-        # Optionally, you can store logits for later inspection
-        logits = torch.zeros(beam_width*num_nodes*n_samples, self.out_dim, device=device)
+        # Groups of copies with identical decoded prefixes
+        if share_prefixes:
+            prefixes = PrefixGroups(layout.copy_graph, self.out_dim)
 
         # Decode one token at a time
         for i in range(num_nodes):
 
             # --- Prepare messages for decoding token at position i ---
-            # In the original sample(), h_S is used via indexing with edge_index.
-            # Here we prepare the subset h_S_ corresponding to incoming edges for node i.
-            h_S_ = h_S[edge_index[0]]
-            # Zero out contributions from nodes not yet decoded:
-            h_S_[edge_index[0] >= edge_index[1]] = 0
+            # Select only the incoming edges for node i, in all copies still being decoded:
+            edge_index_, edge_ids = layout.edges(i)
+
+            # Indices of the current node i in all copies still being decoded
+            node_mask = layout.nodes(i)
+
+            # Only decode one copy per group of copies with identical prefixes
+            if share_prefixes:
+                rep_copies, copy_group = prefixes.groups(node_mask.size(0))
+                is_rep = torch.zeros(layout.n_copies, dtype=torch.bool, device=device)
+                is_rep[rep_copies] = True
+                rep_edges = is_rep[layout.node_copy[edge_index_[1]]]
+                edge_index_, edge_ids = edge_index_[:, rep_edges], edge_ids[rep_edges]
+                decode_mask = layout.copy_ptr[rep_copies] + i
+            else:
+                decode_mask = node_mask
 
-            # Concatenate h_S_ with edge features
-            h_E_ = (torch.cat([h_E[0], h_S_], dim=-1), h_E[1])
-            # Select only the incoming edges for node i:
-            edge_mask = edge_index[1] % num_nodes == i  # True for all edges where dst is node i
-            edge_index_ = edge_index[:, edge_mask]  # subset all incoming edges to node i
-            h_E_ = tuple_index(h_E_, edge_mask)
+            # Prepare the subset h_S_ corresponding to incoming edges for node i
+            h_S_ = h_S[edge_index_[0]]
+            # Zero out contributions from nodes not yet decoded:
+            h_S_[edge_index_[0] >= edge_index_[1]] = 0
 
-            # Create a mask that is True only for the current node i (across all copies in the beam)
-            node_mask = torch.zeros(beam_width*n_samples*num_nodes, device=device, dtype=torch.bool)
-            node_mask[i::num_nodes] = True  # True for all nodes i and its repeats
-            # not entirely sure if the thing above is correct
+            # Concatenate h_S_ with edge features (shared by all copies)
+            h_E_ = (torch.cat([h_E[0][edge_ids], h_S_], dim=-1), h_E[1][edge_ids])
 
             # --- Pass through decoder layers ---
             # We simulate the same decoder forward pass as in sample(), updating the cache.
             for j, layer in enumerate(self.decoder_layers):
                 out = layer(h_V_cache[j], edge_index_, h_E_,
-                        autoregressive_x=h_V_cache[0], node_mask=node_mask)
-                out = tuple_index(out, node_mask)  # subset out to only node i and its repeats
+                        autoregressive_x=h_V_cache[0], node_mask=decode_mask)
+                out = tuple_index(out, decode_mask)  # subset out to only node i and its repeats
+                if share_prefixes:
+                    out = tuple_index(out, copy_group)  # copies share the states of their group
                 # Update the cache for the next layer if needed
                 if j < len(self.decoder_layers)-1:
-                    h_V_cache[j+1][0][i::num_nodes] = out[0]
-                    h_V_cache[j+1][1][i::num_nodes] = out[1]
-            # Final logits for node i:
-            lgts = self.W_out(out)
+                    h_V_cache[j+1][0][node_mask] = out[0]
+                    h_V_cache[j+1][1][node_mask] = out[1]
+            # Final logits for node i (sampled from in fp32):
+            lgts = self.W_out(out).float()
 
             # Add logit bias if provided to fix or bias positions
             if logit_bias is not None:
-                lgts += logit_bias[i]
+                lgts += logit_bias[layout.node_index[node_mask]]
 
             # Sample from logits
             # Make temperature dependent of sequence length being decoded to increase
             # stochasticity in beams as we progress through the sequence
-            temperature_init = temperature
-            temperature = min(temperature_init + temperature * temperature_factor * i, max_temperature)
-            top_tokens, log_probs = choose_nts(lgts, strategy=sampling_strategy, beam_branch=beam_branch,
-                                    temperature=temperature, sampling_value=sampling_value)
+            temperature = update_temperature(temperature, i, temperature_factor, max_temperature)
+            strategy_, sampling_value_, temperature_ = active_params(
+                lgts.size(0), sampling_strategy, sampling_value, temperature)
+            top_tokens, log_probs = choose_nts(lgts, strategy=strategy_, beam_branch=beam_branch,
+                                    temperature=temperature_, sampling_value=sampling_value_)
 
             # log probs will return probabilities for each nucleotide type
             # top tokens will return beam_branch samples of tokens for each of the sequences in n_samples
-            # For each candidate token, create a new beam candidate.
-            new_beam_seq = seq.clone().repeat(beam_branch, 1)
-            new_beam_h_S = h_S.clone().repeat(beam_branch, 1, 1)
-            new_beam_logits = logits.clone().repeat(beam_branch, 1, 1)
-
-            top_log_probs_beam = log_probs.gather(dim=1, index=top_tokens)
-            top_log_probs_beam = top_log_probs_beam.transpose(0, 1)
-
-            new_beam_scores = scores.repeat(beam_branch, 1) + top_log_probs_beam
-            new_beam_seq[:,i::num_nodes] = top_tokens.transpose(0,1)
-            new_beam_logits[:,i::num_nodes] = lgts  # store the logits for analysis
-            new_beam_h_S[:,i::num_nodes] = self.W_s(new_beam_seq[:,i::num_nodes]) # weird [0] indexing
-            
-            sorted_scores, sorted_indices = torch.sort(new_beam_scores, dim=0, descending=True)
-
-            new_beam_seq[:,i::num_nodes] = torch.gather(new_beam_seq[:,i::num_nodes], dim=0, index=sorted_indices)
-
-            # reorganize h_S and logits
-            expanded_indices = sorted_indices.unsqueeze(-1).expand(-1, -1, new_beam_h_S[:, i::num_nodes].size(-1))
-            new_beam_h_S[:,i::num_nodes] =  torch.gather(new_beam_h_S[:,i::num_nodes], dim=0, index=expanded_indices)
-            new_beam_logits[:,i::num_nodes] =  torch.gather(new_beam_logits[:,i::num_nodes], dim=0, index=expanded_indices)
-
-            # update metrics for both beams
-            seq[i::num_nodes] = new_beam_seq[0,i::num_nodes]
-            logits[i::num_nodes] = new_beam_logits[0,i::num_nodes]
-            h_S[i::num_nodes] = new_beam_h_S[0,i::num_nodes]
-
-            scores = sorted_scores[0]            
+            # Keep the best candidate token for each copy
+            tokens = beam.step(i, top_tokens, log_probs, lgts)
+            h_S[node_mask] = self.W_s(tokens)
+            if share_prefixes:
+                prefixes.step(tokens)
         
-        # get ordered scores
-        beamw_scores = scores.view(beam_width, -1)
-        beamw_sorted_scores, beamw_sorted_indices = torch.sort(beamw_scores, dim=0, descending=True)
-
-        # reshape tensors
-        final_seq = seq.view(beam_width, n_samples, num_nodes)
-        final_logits = logits.view(beam_width, n_samples, num_nodes, self.out_dim)
-
-        # reorganize according to indices
-        expanded_indices = beamw_sorted_indices.unsqueeze(-1).expand(-1, n_samples, num_nodes)
-        final_seq = torch.gather(final_seq, dim=0, index=expanded_indices)
-        expanded_indices = beamw_sorted_indices.unsqueeze(-1).unsqueeze(-1).expand(-1, n_samples, num_nodes, self.out_dim)
-        final_logits = torch.gather(final_logits, dim=0, index=expanded_indices)
-
-        # use sorted indices to get final tensors
-        final_scores = beamw_sorted_scores[0]
-        final_seq = final_seq[0]
-        final_logits = final_logits[0]
+        # Highest scoring beam per sample
+        final_seq, final_logits = beam.finalize()
+        final_seq, final_logits = layout.unbatch(final_seq), layout.unbatch(final_logits)
+        if not is_batch:
+            final_seq, final_logits = final_seq[0], final_logits[0]
 
         if return_logits:
-            return final_seq.view(n_samples, num_nodes), final_logits.view(n_samples, num_nodes, self.out_dim)
+            return final_seq, final_logits
         else:    
-            return final_seq.view(n_samples, num_nodes)
+            return final_seq
 
     def pool_multi_conf(self, h_V, h_E, mask_confs, edge_index):
 
@@ -796,6 +958,9 @@ class NonAutoregressiveMultiGNNv1(torch.nn.Module):
         num_layers (int): number of GVP-GNN layers in encoder/decoder
         drop_rate (float): rate to use in all dropout layers
         out_dim (int): output dimension (4 bases)
+        checkpoint_every (int): If given, activations of the encoder layers
+            are recomputed in the backward pass during training, keeping
+            only the inputs of every `checkpoint_every` layers, see `run_layers`
     '''
     def __init__(
         self,
@@ -806,6 +971,7 @@ class NonAutoregressiveMultiGNNv1(torch.nn.Module):
         num_layers = 3, 
         drop_rate = 0.1,
         out_dim = 4,
+        checkpoint_every = None,
     ):
         super().__init__()
         self.node_in_dim = node_in_dim
@@ -814,6 +980,7 @@ class NonAutoregressiveMultiGNNv1(torch.nn.Module):
         self.edge_h_dim = edge_h_dim
         self.num_layers = num_layers
         self.out_dim = out_dim
+        self.checkpoint_every = checkpoint_every
         activations = (F.silu, None)
         
         # Node input embedding
@@ -849,14 +1016,15 @@ class NonAutoregressiveMultiGNNv1(torch.nn.Module):
     def forward(self, batch):
 
         h_V = (batch.node_s, batch.node_v)
-        h_E = (batch.edge_s, batch.edge_v)
+        h_E = edge_input_features(batch.edge_s, batch.edge_v, getattr(batch, 'edge_posenc', None))
         edge_index = batch.edge_index
         
         h_V = self.W_v(h_V)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
         h_E = self.W_e(h_E)  # (n_edges, n_conf, d_se), (n_edges, n_conf, d_ve, 3)
 
-        for layer in self.encoder_layers:
-            h_V = layer(h_V, edge_index, h_E)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
+        # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
+        h_V = run_layers(self.encoder_layers, h_V, edge_index, h_E,
+                         checkpoint_every=self.checkpoint_every if self.training else None)
 
         # Pool multi-conformation features: 
         # nodes: (n_nodes, d_s), (n_nodes, d_v, 3)
@@ -873,7 +1041,7 @@ class NonAutoregressiveMultiGNNv1(torch.nn.Module):
         with torch.no_grad():
 
             h_V = (batch.node_s, batch.node_v)
-            h_E = (batch.edge_s, batch.edge_v)
+            h_E = edge_input_features(batch.edge_s, batch.edge_v, getattr(batch, 'edge_posenc', None))
             edge_index = batch.edge_index
         
             h_V = self.W_v(h_V)  # (n_nodes, n_conf, d_s), (n_nodes, n_conf, d_v, 3)
@@ -886,7 +1054,7 @@ class NonAutoregressiveMultiGNNv1(torch.nn.Module):
             # h_V, h_E = self.pool_multi_conf(h_V, h_E, batch.mask_confs, edge_index)
             h_V = (h_V[0].mean(dim=1), h_V[1].mean(dim=1))
             
-            logits = self.W_out(h_V)  # (n_nodes, out_dim)
+            logits = self.W_out(h_V).float()  # (n_nodes, out_dim)
             probs = F.softmax(logits / temperature, dim=-1)
             seq = torch.multinomial(probs, n_samples, replacement=True)  # (n_nodes, n_samples)
 
@@ -920,3 +1088,234 @@ class NonAutoregressiveMultiGNNv1(torch.nn.Module):
                h_E1.sum(dim=1) / n_conf_true[edge_index[0]].unsqueeze(2))  # (n_edges, d_ve, 3)
 
         return h_V, h_E
+
+
+class DecodingGraph(object):
+    '''
+    Layout of the copies of a batch of RNA graphs that are decoded in
+    parallel during autoregressive sampling.
+
+    Each graph `g` is copied `beam_width * n_samples[g]` times, akin to 
+    'batching' (in PyG style) copies of the graph. Graphs are laid out by 
+    decreasing length (ties keep batch order), so that the copies still being 
+    decoded at position `i` are the first `n_active[i]` copies. Copies of a 
+    graph are ordered beam-major, as expected by `BeamSearch`. Edges of all 
+    copies are bucketed by the position of their destination node, so that 
+    each decoding step only gathers the incoming edges of that position.
+
+    :param edge_index: edge indices of the batch of shape [2, n_edges]
+    :param node_batch: graph index of each node of shape [n_nodes]
+    :param n_samples: list with the number of samples per graph
+    :param beam_width: number of beams per sample
+    '''
+    def __init__(self, edge_index, node_batch, n_samples, beam_width):
+        device = edge_index.device
+        num_graphs = len(n_samples)
+        lengths = torch.bincount(node_batch, minlength=num_graphs).tolist()
+        node_ptr = [0] + torch.cumsum(torch.tensor(lengths), dim=0).tolist()
+        # Edges grouped by graph
+        edge_perm, edge_ptr = incoming_edges(node_batch[edge_index[1]], num_graphs)
+
+        # First sample of each graph, in batch order
+        self.sample_ptr = [0] + torch.cumsum(torch.tensor(n_samples), dim=0).tolist()
+        self.beam_width = beam_width
+
+        # Decode the longest graphs first
+        self.order = sorted(range(num_graphs), key=lambda g: -lengths[g])
+        self.lengths = [lengths[g] for g in self.order]
+        self.n_samples = [n_samples[g] for g in self.order]
+        self.num_nodes = self.lengths[0]
+
+        node_index, copy_ptr, copy_graph, node_copy = [], [], [], []
+        dec_edge_index, dec_edge_ids, dec_pos = [], [], []
+        n_dec_nodes, n_dec_copies = 0, 0
+        for g, length, n in zip(self.order, self.lengths, self.n_samples):
+            n_copies = beam_width * n
+            nodes = torch.arange(node_ptr[g], node_ptr[g+1], device=device)
+            starts = n_dec_nodes + length * torch.arange(n_copies, device=device)
+            edges = edge_perm[edge_ptr[g]:edge_ptr[g+1]]
+            local_edge_index = edge_index[:, edges] - node_ptr[g]
+
+            node_index.append(nodes.repeat(n_copies))
+            copy_ptr.append(starts)
+            copy_graph.append(torch.full((n_copies,), g, dtype=torch.long, device=device))
+            node_copy.append(n_dec_copies + torch.arange(n_copies, device=device).repeat_interleave(length))
+            dec_edge_index.append((local_edge_index.unsqueeze(1) + starts.view(1, -1, 1)).flatten(1))
+            dec_edge_ids.append(edges.repeat(n_copies))
+            dec_pos.append(local_edge_index[1].repeat(n_copies))
+            n_dec_nodes += length * n_copies
+            n_dec_copies += n_copies
+
+        self.n_copies = beam_width * sum(self.n_samples)
+        self.n_dec_nodes = n_dec_nodes
+        # Node of the batch that each decoded node is a copy of
+        self.node_index = torch.cat(node_index)
+        # First decoded node of each copy, graph of each copy and copy of each decoded node
+        self.copy_ptr = torch.cat(copy_ptr)
+        self.copy_graph = torch.cat(copy_graph)
+        self.node_copy = torch.cat(node_copy)
+        # Edges between decoded nodes, and the edge of the batch they are a copy of
+        self.edge_index = torch.cat(dec_edge_index, dim=1)
+        self.edge_ids = torch.cat(dec_edge_ids)
+        self.edge_perm, self.edge_ptr = incoming_edges(torch.cat(dec_pos), self.num_nodes)
+
+        # Number of copies still being decoded at each position
+        self.n_active = []
+        n_active, g = self.n_copies, num_graphs - 1
+        for i in range(self.num_nodes):
+            while self.lengths[g] <= i:
+                n_active -= beam_width * self.n_samples[g]
+                g -= 1
+            self.n_active.append(n_active)
+
+    def nodes(self, i):
+        '''
+        Returns the decoded nodes at position `i` of all active copies.
+        '''
+        return self.copy_ptr[:self.n_active[i]] + i
+
+    def edges(self, i):
+        '''
+        Returns the incoming edges of position `i` in all active copies
+        as a tuple (edge_index, edge_ids), where `edge_ids` indexes the
+        edges of the batch.
+        '''
+        ids = self.edge_perm[self.edge_ptr[i]:self.edge_ptr[i+1]]
+        return self.edge_index[:, ids], self.edge_ids[ids]
+
+    def copy_values(self, x):
+        '''
+        Expands per-sample values of shape [n_samples_total] (in the original
+        batch order) to per-copy values of shape [n_copies] (in decoding 
+        order), such that all beams of a sample share its value.
+        '''
+        return torch.cat([x[self.sample_ptr[g]:self.sample_ptr[g+1]].repeat(self.beam_width)
+                          for g in self.order])
+
+    def unbatch(self, x):
+        '''
+        Splits per-sample outputs of shape [n_samples_total, num_nodes, ...] 
+        (in decoding order) into a list with one tensor per graph of shape
+        [n_samples[g], n_nodes[g], ...], in the original batch order.
+        '''
+        out = [None] * len(self.order)
+        offset = 0
+        for g, length, n in zip(self.order, self.lengths, self.n_samples):
+            out[g] = x[offset:offset+n, :length]
+            offset += n
+        return out
+
+
+def run_layers(layers, x, *args, checkpoint_every=None, **kwargs):
+    '''
+    Applies `layers` in sequence to node features `x`, passing the same
+    other arguments to each layer.
+
+    With activation checkpointing, layers are run in segments of 
+    `checkpoint_every` layers, of which only the inputs are kept for the 
+    backward pass, and their intermediate activations are recomputed. 
+    Memory for activations then scales with `checkpoint_every` layers 
+    rather than all layers, at the cost of one more forward pass.
+
+    :param layers: `nn.ModuleList` of layers taking `x` as first argument
+    :param x: tuple (s, V) of node features
+    :param checkpoint_every: number of layers per checkpointed segment
+                             (1 to checkpoint each layer), or `None` to
+                             keep all activations
+    :return: tuple (s, V) of node features after the last layer
+    '''
+    def run_segment(x, segment):
+        for layer in segment:
+            x = layer(x, *args, **kwargs)
+        return x
+
+    if not checkpoint_every or not torch.is_grad_enabled():
+        return run_segment(x, layers)
+    for start in range(0, len(layers), checkpoint_every):
+        x = checkpoint(run_segment, x, layers[start:start + checkpoint_every], use_reentrant=False)
+    return x
+
+
+def edge_input_features(edge_s, edge_v, edge_posenc=None):
+    '''
+    Edge input features of the models from featurized graphs.
+
+    The featurizer stores the positional encodings of edges once per edge,
+    as they are the same for all conformers; they are broadcast over 
+    conformers here and inserted before the log edge lengths (the last 
+    `num_bb_atoms` scalar features), which is the layout of edge scalar
+    features expected by `W_e`.
+
+    :param edge_s: edge scalar features [n_edges, n_conf, d_se - num_posenc]
+                   (or [n_edges, n_conf, d_se] if `edge_posenc` is `None`)
+    :param edge_v: edge vector features [n_edges, n_conf, num_bb_atoms, 3]
+    :param edge_posenc: edge positional encodings [n_edges, num_posenc], 
+                        optional for graphs featurized with encodings per conformer
+    :return: tuple (s, V) of edge input features
+    '''
+    if edge_posenc is None:
+        return edge_s, edge_v
+    num_lengths = edge_v.shape[-2]
+    edge_posenc = edge_posenc.to(edge_s.dtype).unsqueeze(1).expand(-1, edge_s.shape[1], -1)
+    edge_s = torch.cat([edge_s[..., :-num_lengths], edge_posenc, edge_s[..., -num_lengths:]], dim=-1)
+    return edge_s, edge_v
+
+
+def incoming_edges(dst, num_nodes):
+    '''
+    Buckets edges by destination node in CSR format, such that the 
+    incoming edges of node `i` are `perm[ptr[i]:ptr[i+1]]`. Edges with
+    the same destination keep their original relative order.
+
+    :param dst: destination node of each edge of shape [n_edges]
+    :param num_nodes: number of nodes
+    :return: tuple (perm, ptr) where `perm` is a tensor of edge ids sorted
+             by destination node and `ptr` is a list of `num_nodes + 1` offsets
+    '''
+    perm = torch.sort(dst, stable=True)[1]
+    counts = torch.bincount(dst, minlength=num_nodes)
+    ptr = [0] + torch.cumsum(counts, dim=0).tolist()
+    return perm, ptr
+
+
+def low_rank_moment_pooling(state_dict, moment_rank, node_h_dim=128):
+    '''
+    Converts the tensor moment pooling weights of an `AutoregressiveMultiGNNv2`
+    checkpoint with full second-order moments into weights for a model 
+    with `moment_rank=moment_rank`.
+
+    The first layer of `psi` maps the second-order moment through one 
+    quadratic form per hidden unit, x^T A_o x (only the symmetric part of
+    A_o contributes). Projecting features onto the top `moment_rank` 
+    eigenvectors P of sum_o A_o^2 and using P A_o P^T as quadratic forms
+    over projected features is exact when all A_o have their row space 
+    within `moment_rank` dimensions (always the case if `moment_rank` = d),
+    and otherwise keeps the dominant subspace of the quadratic forms.
+
+    :param state_dict: state dict of a model with `moment_rank=None`
+    :param moment_rank: rank of the projection for second-order moments
+    :param node_h_dim: scalar node dimension d of the model
+    :return: tuple (state_dict, residual), where `state_dict` can be loaded 
+             into a model with `moment_rank=moment_rank` and `residual` is 
+             the relative Frobenius error of the converted quadratic forms
+             (0 up to floating point error if the conversion is exact)
+    '''
+    d = node_h_dim
+    state_dict = dict(state_dict)
+    weight = state_dict['psi.0.weight']
+    W_1, W_2, W_rest = weight[:, :d], weight[:, d:d + d**2], weight[:, d + d**2:]
+
+    # Symmetric quadratic forms per hidden unit: [2d, d, d]
+    A = W_2.double().view(-1, d, d)
+    A = 0.5 * (A + A.transpose(1, 2))
+    # Joint dominant subspace of all quadratic forms
+    _, eigvecs = torch.linalg.eigh(torch.einsum('oij,ojk->ik', A, A))
+    P = eigvecs[:, -moment_rank:].t()  # [moment_rank, d]
+    A_low = P @ A @ P.t()  # [2d, moment_rank, moment_rank]
+
+    A_rec = P.t() @ A_low @ P
+    residual = (torch.linalg.norm(A - A_rec) / torch.linalg.norm(A).clamp(min=1e-12)).item()
+
+    state_dict['moment_proj.weight'] = P.to(weight.dtype)
+    state_dict['psi.0.weight'] = torch.cat([W_1, A_low.flatten(start_dim=1).to(weight.dtype), W_rest], dim=1)
+    return state_dict, residual
@@ -0,0 +1,105 @@
+import copy
+import contextlib
+
+import torch
+
+
+PRECISIONS = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+def autocast(device, precision='fp32'):
+    """
+    Context manager running the enclosed forward passes in mixed precision.
+
+    Matrix multiplications run in the reduced precision, while numerically
+    sensitive operations (vector norms, softmax, RBF exponentials) are kept
+    in fp32 by the layers and featurizer themselves.
+
+    Args:
+        device (torch.device or str): device the model runs on
+        precision (str): 'fp32' (no autocast), 'bf16' or 'fp16'; fp16 is
+            meant for GPUs, bf16 works on both CPUs and recent GPUs
+
+    Returns:
+        context manager (a no-op for fp32)
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Invalid precision: {precision}, expected one of {list(PRECISIONS)}")
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    device_type = torch.device(device).type
+    return torch.autocast(device_type=device_type, dtype=PRECISIONS[precision])
+
+
+def grad_scaler(device, precision='fp32'):
+    """
+    Gradient scaler for training in mixed precision, which is only enabled
+    for fp16 on GPU (bf16 has the dynamic range of fp32 and needs no loss
+    scaling).
+    """
+    device_type = torch.device(device).type
+    enabled = precision == 'fp16' and device_type == 'cuda'
+    if not hasattr(torch.amp, 'GradScaler'):
+        # torch < 2.3, where `torch.cuda.amp.GradScaler` is not deprecated yet
+        return torch.cuda.amp.GradScaler(enabled=enabled)
+    return torch.amp.GradScaler('cuda', enabled=enabled)
+
+
+# Linear layers whose weights are read block-wise by fused kernels, see 
+# `gvp_message_passing` and `moment_pooling`; for quantization, their blocks
+# are split into separate modules by the `split_linear_blocks` method of the
+# modules owning them, and the original layers are no longer read
+SPLIT_LINEAR_LAYERS = ('message_func.0.ws', 'message_func.0.wh', 'psi.0')
+
+
+def is_split_linear_layer(name):
+    return any(name == layer or name.endswith('.' + layer) for layer in SPLIT_LINEAR_LAYERS)
+
+
+def quantize_linear_layers(model, dtype=torch.qint8):
+    """
+    Dynamic quantization of the `nn.Linear` layers of a model for CPU 
+    inference: weights are stored in INT8 and activations are quantized
+    on the fly, per batch.
+
+    Linear layers in `SPLIT_LINEAR_LAYERS` are first split into one module
+    per block of inputs (by the `split_linear_blocks` method of modules
+    that define it), so that the blocks read by fused kernels are quantized
+    as well; the original layers are kept in fp32 but no longer read.
+
+    Args:
+        model (nn.Module): model in fp32 (weights are left unchanged)
+        dtype (torch.dtype): quantized dtype of the weights
+
+    Returns:
+        nn.Module: quantized copy of the model in eval mode
+    """
+    model = copy.deepcopy(model).eval()
+    for module in list(model.modules()):
+        if hasattr(module, 'split_linear_blocks'):
+            module.split_linear_blocks()
+    layers = {
+        name for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and not is_split_linear_layer(name)
+    }
+    return torch.ao.quantization.quantize_dynamic(model, layers, dtype=dtype, inplace=True)
+
+
+def quantized_fraction(model):
+    """
+    Fraction of the weights of the linear layers read by a model that are
+    quantized (layers in `SPLIT_LINEAR_LAYERS` are not counted, as only
+    their blocks are read once split).
+    """
+    quantized, total = 0, 0
+    for name, module in model.named_modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            quantized += module.weight().numel()
+            total += module.weight().numel()
+        elif isinstance(module, torch.nn.Linear) and not is_split_linear_layer(name):
+            total += module.weight.numel()
+    return quantized / max(total, 1)
@@ -5,55 +5,515 @@
 # https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317
 ################################################################
 
+from collections import deque
+
 import torch
 import torch.nn.functional as F
 from torch.distributions import Categorical
 
+from src.constants import LETTER_TO_NUM
+
 ################################################################
 
+class BeamSearch(object):
+    """
+    Beam search bookkeeping for autoregressive decoding.
+
+    `beam_width * n_samples` copies are decoded in parallel per graph, ordered 
+    graph-major and beam-major within each graph (copy `b * n_samples + s` of a 
+    graph is beam `b` of its sample `s`). At each step, every copy draws 
+    `beam_branch` candidate tokens and keeps the highest scoring one. After the 
+    last step, the highest scoring beam of each sample is returned.
+
+    When several graphs of different lengths are decoded together, copies must 
+    be ordered by decreasing graph length, so that the copies still being 
+    decoded at any position are a prefix of all copies.
+
+    Beams are not reselected across copies: each copy only extends its own
+    hypothesis, so the decoder states of a copy never need to be reordered.
+    Only the chosen token, its logits and the cumulative score are stored per
+    copy and step, so the cost of a step does not grow with the decoded position,
+    and the final sequence of a copy is read off directly.
+
+    Args:
+        n_samples (int or list): number of samples to return (per graph)
+        beam_width (int): number of beams to maintain per sample
+        beam_branch (int): number of candidate tokens per beam and step
+        num_nodes (int): number of positions to decode (of the longest graph)
+        out_dim (int): number of token types
+        device (torch.device): device to store the beam state on
+    """
+    def __init__(self, n_samples, beam_width, beam_branch, num_nodes, out_dim, device):
+        if isinstance(n_samples, int):
+            n_samples = [n_samples]
+        self.n_samples = n_samples
+        self.beam_width = beam_width
+        self.beam_branch = beam_branch
+        self.num_nodes = num_nodes
+        self.out_dim = out_dim
+        
+        n_copies = beam_width * sum(n_samples)
+        self.scores = torch.zeros(n_copies, dtype=torch.float, device=device)  # cumulative score per copy
+        self.tokens = torch.zeros(n_copies, num_nodes, dtype=torch.int, device=device)  # chosen token per step
+        self.logits = torch.zeros(n_copies, num_nodes, out_dim, device=device)  # logits per step
+        self.copies = torch.arange(n_copies, device=device)
+
+        # Copies holding the beams of each sample: n_samples_total x beam_width
+        beams, offset = [], 0
+        for n in n_samples:
+            beams.append(offset + self.copies[:beam_width * n].view(beam_width, n).t())
+            offset += beam_width * n
+        self.beams = torch.cat(beams, dim=0)
+
+    def step(self, i, top_tokens, token_scores, lgts):
+        """
+        Extends the first `n_active` copies by the best of their candidate 
+        tokens at position `i`.
+
+        Args:
+            i (int): position being decoded
+            top_tokens (torch.Tensor): candidate tokens of shape [n_active, beam_branch]
+            token_scores (torch.Tensor): score of each token of shape [n_active, out_dim]
+            lgts (torch.Tensor): logits at position `i` of shape [n_active, out_dim]
+        
+        Returns:
+            tokens (torch.Tensor): chosen token per copy of shape [n_active]
+        """
+        n_active = top_tokens.size(0)
+        # Cumulative score of each candidate: n_active x beam_branch
+        candidate_scores = self.scores[:n_active].unsqueeze(1) + token_scores.gather(dim=1, index=top_tokens)
+        best_scores, best_branch = candidate_scores.max(dim=1)
+        tokens = top_tokens.gather(dim=1, index=best_branch.unsqueeze(1)).squeeze(1)
+
+        # Each copy extends its own hypothesis
+        self.scores[:n_active] = best_scores
+        self.tokens[:n_active, i] = tokens
+        self.logits[:n_active, i] = lgts
+        return tokens
+
+    def finalize(self):
+        """
+        Returns the highest scoring beam of each sample.
+
+        Returns:
+            seq (torch.Tensor): int tensor of shape [n_samples_total, num_nodes]
+            logits (torch.Tensor): logits of shape [n_samples_total, num_nodes, out_dim]
+        """
+        # Highest scoring beam per sample
+        _, best_beam = self.scores[self.beams].max(dim=1)
+        copy = self.beams.gather(dim=1, index=best_beam.unsqueeze(1)).squeeze(1)
+        return self.tokens[copy], self.logits[copy]
+
+
+class PrefixGroups(object):
+    """
+    Groups copies being decoded by identical decoded prefixes.
+
+    Decoder states and logits at a position only depend on the graph and the 
+    tokens decoded at previous positions, so copies of the same graph with 
+    identical prefixes need to be decoded only once. Each group is represented
+    by its lowest-indexed copy, and groups are split as copies diverge.
+
+    Args:
+        copy_graph (torch.Tensor): graph index of each copy of shape [n_copies]
+        out_dim (int): number of token types
+    """
+    def __init__(self, copy_graph, out_dim):
+        n_copies = copy_graph.size(0)
+        self.out_dim = out_dim
+        self.copies = torch.arange(n_copies, device=copy_graph.device)
+        # Representative copy of each copy's group: the first copy of each graph
+        first_copy = torch.full_like(self.copies, n_copies).scatter_reduce(
+            0, copy_graph, self.copies, reduce='amin')
+        self.rep = first_copy[copy_graph]
+
+    def groups(self, n_active):
+        """
+        Groups the first `n_active` copies.
+
+        Returns:
+            rep_copies (torch.Tensor): representative copy of each group of shape [n_groups]
+            copy_group (torch.Tensor): group of each copy of shape [n_active]
+        """
+        return torch.unique(self.rep[:n_active], return_inverse=True)
+
+    def step(self, tokens):
+        """
+        Splits groups by the tokens decoded by the first `n_active` copies.
+
+        Args:
+            tokens (torch.Tensor): decoded token of each copy of shape [n_active]
+        """
+        n_active = tokens.size(0)
+        _, group = torch.unique(self.rep[:n_active] * self.out_dim + tokens.long(), return_inverse=True)
+        rep = torch.full_like(group, n_active).scatter_reduce(
+            0, group, self.copies[:n_active], reduce='amin')
+        self.rep[:n_active] = rep[group]
+
+
+class ForbiddenSequenceAutomaton(object):
+    """
+    Aho-Corasick automaton over a list of sequences to avoid during decoding.
+
+    The sequences are compiled once into a trie with failure links, stored as
+    a dense transition table of shape [n_states, out_dim]. Each decoded copy 
+    keeps the state reached by the tokens decoded so far, which is advanced by
+    a single gather per step, and a precomputed table of shape 
+    [n_states, out_dim] tells which next tokens would complete a forbidden 
+    sequence. The per-step cost is thus independent of the number of 
+    sequences to avoid.
+
+    Args:
+        sequences (list): sequences to avoid, as strings of nucleotides
+        out_dim (int): number of token types
+        device (torch.device): device to store the automaton on
+    """
+    def __init__(self, sequences, out_dim, device):
+        # Build trie: goto[state][token] is the child state, or -1
+        goto = [[-1] * out_dim]
+        terminal = [False]
+        for seq in sequences:
+            if len(seq) == 0:
+                continue
+            state = 0
+            for residue in seq:
+                token = LETTER_TO_NUM[residue]
+                if goto[state][token] == -1:
+                    goto[state][token] = len(goto)
+                    goto.append([-1] * out_dim)
+                    terminal.append(False)
+                state = goto[state][token]
+            terminal[state] = True
+
+        # Breadth-first traversal to add failure links, completing the transition 
+        # table and marking states with any forbidden sequence as a suffix
+        fail = [0] * len(goto)
+        queue = deque()
+        for token in range(out_dim):
+            if goto[0][token] == -1:
+                goto[0][token] = 0
+            else:
+                queue.append(goto[0][token])
+        while queue:
+            state = queue.popleft()
+            terminal[state] = terminal[state] or terminal[fail[state]]
+            for token in range(out_dim):
+                child = goto[state][token]
+                if child == -1:
+                    goto[state][token] = goto[fail[state]][token]
+                else:
+                    fail[child] = goto[fail[state]][token]
+                    queue.append(child)
+
+        self.transitions = torch.tensor(goto, dtype=torch.long, device=device)  # n_states x out_dim
+        terminal = torch.tensor(terminal, dtype=torch.bool, device=device)
+        self.banned = terminal[self.transitions]  # n_states x out_dim
+        self.device = device
+
+    def init_states(self, n_copies):
+        """
+        Returns the initial (empty sequence) state of `n_copies` copies.
+        """
+        return torch.zeros(n_copies, dtype=torch.long, device=self.device)
+
+    def mask_logits(self, lgts, states):
+        """
+        Sets logits of tokens that would complete a forbidden sequence to -inf.
+
+        Args:
+            lgts (torch.Tensor): logits of shape [n_copies, out_dim]
+            states (torch.Tensor): automaton state of each copy of shape [n_copies]
+        """
+        return lgts.masked_fill(self.banned[states], float('-inf'))
+
+    def step(self, states, tokens):
+        """
+        Advances the automaton state of each copy by its decoded token.
+
+        Args:
+            states (torch.Tensor): automaton state of each copy of shape [n_copies]
+            tokens (torch.Tensor): decoded token of each copy of shape [n_copies]
+        """
+        return self.transitions[states, tokens.long()]
+
+
 def choose_nts(lgts, strategy='categorical', beam_branch=2, sampling_value=0.0, temperature=0.1):
     """
     lgts: tensor with shape batch_size, vocab_size
     samples according to beam_branch (will establish number of samples obtained)
     Returns: sample from the next_token probabilities
     """
+    next_token_probs = token_probs(lgts, strategy, sampling_value, temperature)
+    # change so it can return 2 samples if needed!
+    #sample = Categorical(logits=lgts).sample()
+    sample = torch.multinomial(next_token_probs, num_samples=beam_branch, replacement=True)
+    return sample, next_token_probs
+
+
+def token_probs(lgts, strategy='categorical', sampling_value=0.0, temperature=0.1):
+    """
+    lgts: tensor with shape batch_size, vocab_size
+    strategy, sampling_value, temperature: either one value for all rows, or 
+    per-row tensors of shape batch_size as returned by `per_sample_params`
+    Returns: next_token probabilities after temperature scaling and 
+    filtering with the sampling strategy, with shape batch_size, vocab_size
+    """
+    if torch.is_tensor(strategy):
+        # Per-row parameters: filter all rows in one go
+        return F.softmax(filter_logits(lgts / temperature.unsqueeze(-1), strategy, sampling_value), dim=-1)
+
     # First rescale with temperature -- is this right ? or should I rescale after filtering ?
     lgts = lgts / temperature
 
     if strategy.lower() == 'categorical':
         # Original code
-        next_token_probs = F.softmax(lgts, dim=-1) ## WOULD THIS BE CORRECT ? Debug later -- which to use ?
-        # change so it can return 2 samples if needed!
-        #sample = Categorical(logits=lgts).sample()
-        sample = torch.multinomial(next_token_probs, num_samples=beam_branch, replacement=True)
-        return sample, next_token_probs
+        return F.softmax(lgts, dim=-1) ## WOULD THIS BE CORRECT ? Debug later -- which to use ?
 
     elif strategy.lower() == 'top_k':
         # top-k logic
         filtered_lgts = top_k_filtering(lgts, sampling_value)
-        next_token_probs = F.softmax(filtered_lgts, dim=-1)
-        sample = torch.multinomial(next_token_probs, num_samples=beam_branch, replacement=True)
-        return sample, next_token_probs
+        return F.softmax(filtered_lgts, dim=-1)
     
     elif strategy.lower() == 'top_p':
         # top-p logic
         filtered_lgts = top_p_filtering(lgts, sampling_value)
-        next_token_probs = F.softmax(filtered_lgts, dim=-1)
-        sample = torch.multinomial(next_token_probs, num_samples=beam_branch, replacement=True)
-        return sample, next_token_probs
+        return F.softmax(filtered_lgts, dim=-1)
 
     elif strategy.lower() == 'min_p':
         # min-p logic
         filtered_lgts = min_p_sampling(lgts, sampling_value)
-        next_token_probs = F.softmax(filtered_lgts, dim=-1)
-        sample = torch.multinomial(next_token_probs, num_samples=beam_branch, replacement=True)
-
-        return sample, next_token_probs
+        return F.softmax(filtered_lgts, dim=-1)
     
     else:
         raise ValueError(f"Unknown sampling strategy: {strategy}")
+
+
+@torch.no_grad()
+def speculative_sample(
+        model, 
+        draft_model, 
+        batch, 
+        n_samples, 
+        temperature=0.1, 
+        draft_temperature=None,
+        logit_bias=None, 
+        return_logits=False, 
+        sampling_strategy='categorical', 
+        sampling_value=0.0,
+        max_temperature=0.5,
+        return_stats=False
+    ):
+    """
+    Speculative sampling from an autoregressive model (`AutoregressiveMultiGNNv1`
+    or `AutoregressiveMultiGNNv2`), with a non-autoregressive model 
+    (`NonAutoregressiveMultiGNNv1`) as draft.
+
+    The draft model proposes all positions of each sequence in one pass. The
+    autoregressive model then verifies the proposed tokens of all positions 
+    in one teacher-forced decoder pass: each copy accepts its longest prefix 
+    of draft tokens passing the speculative sampling test, and the first 
+    rejected token is resampled from the residual distribution. This repeats
+    until all positions of all copies are decoded, which takes as many 
+    verifier passes as the largest number of rejections in a copy (plus one).
+
+    Designed sequences follow the distribution of the autoregressive model,
+    i.e. that of `model.sample` with `beam_width=1`, `beam_branch=1` and a 
+    constant temperature (`temperature_factor=0`), including the clamping of
+    temperatures to `max_temperature`. Beam search, temperature schedules 
+    and `avoid_sequences` are not supported.
+
+    Args:
+        model (torch.nn.Module): autoregressive model to sample from
+        draft_model (torch.nn.Module): non-autoregressive draft model
+        batch (torch_geometric.data.Data): one RNA backbone to design sequences for
+        n_samples (int): number of samples
+        temperature (float): temperature of the autoregressive model
+        draft_temperature (float): temperature of the draft model 
+            (defaults to `temperature`)
+        logit_bias (torch.Tensor): bias to add to logits of both models,
+            of shape [n_nodes, 4]
+        return_logits (bool): whether to return logits
+        sampling_strategy (str): one of "categorical", "top_k", "top_p", "min_p"
+        sampling_value (float): value for sampling strategy
+        max_temperature (float): maximum temperature of both models, as in
+            `model.sample` (see `update_temperature`)
+        return_stats (bool): whether to return decoding statistics
+    Returns:
+        seq (torch.Tensor): int tensor of shape [n_samples, n_nodes]
+        logits (torch.Tensor): logits of the autoregressive model of shape
+            [n_samples, n_nodes, 4] (only if return_logits is True)
+        stats (dict): number of verifier passes, and number of draft tokens
+            proposed and accepted (only if return_stats is True)
+    """
+    if draft_temperature is None:
+        draft_temperature = temperature
+    # Temperatures clamped as in the first step of `model.sample`
+    temperature = update_temperature(temperature, 0, 0, max_temperature)
+    draft_temperature = update_temperature(draft_temperature, 0, 0, max_temperature)
+    edge_index = batch.edge_index
+    device = edge_index.device
+    num_nodes = batch.num_nodes
+    positions = torch.arange(num_nodes, device=device)
+
+    # Draft distribution and proposals: independent per position
+    draft_lgts = draft_model(batch)
+    if logit_bias is not None:
+        draft_lgts = draft_lgts + logit_bias
+    q = F.softmax(draft_lgts / draft_temperature, dim=-1)  # n_nodes x 4
+    draft = torch.multinomial(q, n_samples, replacement=True).t()  # n_samples x n_nodes
+    q_draft = q[positions, draft]  # n_samples x n_nodes
+
+    # Copies of the graph are offset by num_nodes when verifying,
+    # akin to 'batching' (in PyG style) n_samples copies of the graph
+    h_V, h_E = model.encode(batch)
+    h_V = (h_V[0].repeat(n_samples, 1), h_V[1].repeat(n_samples, 1, 1))
+    h_E = (h_E[0].repeat(n_samples, 1), h_E[1].repeat(n_samples, 1, 1))
+    offset = num_nodes * torch.arange(n_samples, device=device).view(1, n_samples, 1)
+    edge_index = (edge_index.unsqueeze(1) + offset).flatten(1)
+    copy_batch = torch.arange(n_samples, device=device).repeat_interleave(num_nodes)
+
+    # Current tokens per copy: decoded prefix followed by draft proposals
+    seq = draft.clone()
+    logits = torch.zeros(n_samples, num_nodes, model.out_dim, device=device)
+    n_decoded = torch.zeros(n_samples, dtype=torch.long, device=device)
+    n_passes, n_proposed, n_accepted = 0, 0, 0
+
+    while (n_decoded < num_nodes).any():
+        # Verify all positions in one teacher-forced pass
+        lgts = model.decode(h_V, h_E, edge_index, seq.flatten(), batch=copy_batch)
+        lgts = lgts.view(n_samples, num_nodes, -1)
+        if logit_bias is not None:
+            lgts = lgts + logit_bias
+        p = token_probs(lgts.flatten(0, 1), sampling_strategy, sampling_value, temperature)
+        p = p.view(n_samples, num_nodes, -1)
+        p_draft = p.gather(dim=-1, index=draft.unsqueeze(-1)).squeeze(-1)
+
+        # Accept each draft token with probability min(1, p / q)
+        accept = torch.rand_like(p_draft) * q_draft < p_draft
+        pending = positions.unsqueeze(0) >= n_decoded.unsqueeze(1)
+        # First rejected position per copy (num_nodes if all are accepted)
+        first_reject = torch.where(pending & ~accept, positions, num_nodes).min(dim=1)[0]
+
+        # Positions decoded in this pass: accepted prefix and first rejected position
+        decoded = pending & (positions.unsqueeze(0) <= first_reject.unsqueeze(1))
+        logits[decoded] = lgts[decoded]
+        n_passes += 1
+        n_proposed += decoded.sum().item()
+        n_accepted += (first_reject - n_decoded).sum().item()
+
+        # Resample rejected tokens from the residual distribution max(0, p - q)
+        rejected = (first_reject < num_nodes).nonzero().squeeze(1)
+        if rejected.numel() > 0:
+            pos = first_reject[rejected]
+            residual = (p[rejected, pos] - q[pos]).clamp(min=0)
+            # Residual is empty if p == q (up to numerical precision)
+            empty = residual.sum(dim=-1, keepdim=True) <= 0
+            residual = torch.where(empty, p[rejected, pos], residual)
+            seq[rejected, pos] = torch.multinomial(residual, 1).squeeze(1)
+
+        n_decoded = (first_reject + 1).clamp(max=num_nodes)
+
+    stats = {"n_passes": n_passes, "n_proposed": n_proposed, "n_accepted": n_accepted}
+    out = (seq, logits) if return_logits else (seq,)
+    if return_stats:
+        out = out + (stats,)
+    return out if len(out) > 1 else out[0]
     
 
+SAMPLING_STRATEGIES = ('categorical', 'top_k', 'top_p', 'min_p')
+
+
+def is_per_sample(*params):
+    """
+    Returns whether any of the sampling parameters is given per sample.
+    """
+    return any(isinstance(p, (list, tuple)) or torch.is_tensor(p) for p in params)
+
+
+def active_params(n_active, *params):
+    """
+    Returns per-copy sampling parameters of the first `n_active` copies
+    (parameters shared by all copies are returned as they are).
+    """
+    return tuple(p[:n_active] if torch.is_tensor(p) else p for p in params)
+
+
+def chunk_params(start, end, *params):
+    """
+    Returns the sampling parameters of samples `start` to `end`, e.g. to
+    sample in chunks (parameters given per sample, as lists or tensors, are
+    sliced; parameters shared by all samples are returned as they are).
+    """
+    return tuple(p[start:end] if is_per_sample(p) else p for p in params)
+
+
+def per_sample_params(n_samples, strategy, sampling_value, temperature, device):
+    """
+    Broadcasts sampling parameters given per sample (as lists or tensors of 
+    shape n_samples) or for all samples (as scalars) to tensors of shape 
+    n_samples, with strategies as indices into `SAMPLING_STRATEGIES`.
+    """
+    if isinstance(strategy, str):
+        strategy = [strategy] * n_samples
+    for _strategy in strategy:
+        if _strategy.lower() not in SAMPLING_STRATEGIES:
+            raise ValueError(f"Unknown sampling strategy: {_strategy}")
+    strategy = torch.tensor([SAMPLING_STRATEGIES.index(_strategy.lower()) for _strategy in strategy], device=device)
+    sampling_value = torch.as_tensor(sampling_value, dtype=torch.float, device=device).expand(n_samples).clone()
+    temperature = torch.as_tensor(temperature, dtype=torch.float, device=device).expand(n_samples).clone()
+    if strategy.size(0) != n_samples:
+        raise ValueError(f"Expected {n_samples} sampling strategies, got {strategy.size(0)}")
+    return strategy, sampling_value, temperature
+
+
+def filter_logits(logits, strategy, sampling_value, filter_value=-float('Inf')):
+    """ Filter a batch of logits distributions with a different sampling strategy
+        and value per row, in one pass over all rows
+        Args:
+            logits: logits distributions shape (batch size, vocabulary size)
+            strategy: index into `SAMPLING_STRATEGIES` per row, shape (batch size)
+            sampling_value: value for the sampling strategy per row, shape (batch size);
+                rows are filtered as in `top_k_filtering`, `top_p_filtering` and 
+                `min_p_sampling`, and left unchanged for values outside their valid range
+    """
+    vocab_size = logits.size(-1)
+    sampling_value = sampling_value.unsqueeze(-1)
+    strategy = strategy.unsqueeze(-1)
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+    sorted_probs = F.softmax(sorted_logits, dim=-1)
+
+    # top-k: remove all tokens with a logit less than the k-th largest
+    top_k = sampling_value.long().clamp(1, vocab_size)
+    is_top_k = (strategy == SAMPLING_STRATEGIES.index('top_k')) & (sampling_value > 1) & (sampling_value < vocab_size)
+    remove = is_top_k & (sorted_logits < sorted_logits.gather(-1, top_k - 1))
+
+    # top-p: remove tokens with cumulative probability above the threshold,
+    # keeping also the first token above the threshold
+    is_top_p = (strategy == SAMPLING_STRATEGIES.index('top_p')) & (sampling_value > 0.0) & (sampling_value < 1.0)
+    above_top_p = torch.cumsum(sorted_probs, dim=-1) > sampling_value
+    above_top_p = torch.cat([torch.zeros_like(above_top_p[:, :1]), above_top_p[:, :-1]], dim=-1)
+    remove = remove | (is_top_p & above_top_p)
+
+    # min-p: remove tokens with probability less than min_p times the maximum probability
+    is_min_p = (strategy == SAMPLING_STRATEGIES.index('min_p')) & (sampling_value > 0.0) & (sampling_value < 1.0)
+    remove = remove | (is_min_p & (sorted_probs < sampling_value * sorted_probs[:, :1]))
+
+    sorted_logits = sorted_logits.masked_fill(remove, filter_value)
+    return torch.empty_like(logits).scatter_(-1, sorted_indices, sorted_logits)
+
+
+def update_temperature(temperature, i, temperature_factor, max_temperature):
+    """
+    Make temperature dependent of sequence length being decoded to increase
+    stochasticity in beams as we progress through the sequence.
+    `temperature` is a scalar or a tensor of per-copy temperatures.
+    """
+    temperature = temperature + temperature * temperature_factor * i
+    if torch.is_tensor(temperature):
+        return temperature.clamp(max=max_temperature)
+    return min(temperature, max_temperature)
+
+
 def top_k_filtering(logits, top_k=2, filter_value=-float('Inf')):
     # Code from https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317 -- slightly modified
     """ Filter a distribution of logits using top-k and/or nucleus (top-p) filtering
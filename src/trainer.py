@@ -9,6 +9,7 @@ from torch.optim import Adam
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 
 from src.evaluator import evaluate
+from src.precision import autocast, grad_scaler
 from src.constants import NUM_TO_LETTER
 
 
@@ -41,6 +42,9 @@ def train(
     optimizer = Adam(model.parameters(), lr)
     scheduler = ReduceLROnPlateau(optimizer, mode='max', factor=0.9, patience=1, min_lr=0.00001)
 
+    # Loss scaling for mixed precision training (fp16 on GPU only)
+    scaler = grad_scaler(device, config.precision)
+
     if device.type == 'xpu':
         import intel_extension_for_pytorch as ipex
         model, optimizer = ipex.optimize(model, optimizer=optimizer)
@@ -59,7 +63,8 @@ def train(
         
         # Training iteration
         model.train()
-        train_loss, train_acc, train_confusion = loop(model, train_loader, train_loss_fn, optimizer, device)
+        train_loss, train_acc, train_confusion = loop(
+            model, train_loader, train_loss_fn, optimizer, device, config.precision, scaler)
         print_and_log(epoch, train_loss, train_acc, train_confusion, lr=lr, mode="train", lookup=lookup)
         
         if epoch % config.val_every == 0 or epoch == config.epochs - 1:
@@ -68,7 +73,7 @@ def train(
             with torch.no_grad(): 
                 
                 # Evaluate on validation set
-                val_loss, val_acc, val_confusion = loop(model, val_loader, eval_loss_fn, None, device)
+                val_loss, val_acc, val_confusion = loop(model, val_loader, eval_loss_fn, None, device, config.precision)
                 print_and_log(epoch, val_loss, val_acc, val_confusion, mode="val", lookup=lookup)
 
                 # LR scheduler step
@@ -80,7 +85,7 @@ def train(
                     best_epoch, best_val_loss, best_val_acc = epoch, val_loss, val_acc
 
                     # Evaluate on test set
-                    test_loss, test_acc, test_confusion = loop(model, test_loader, eval_loss_fn, None, device)
+                    test_loss, test_acc, test_confusion = loop(model, test_loader, eval_loss_fn, None, device, config.precision)
                     print_and_log(epoch, test_loss, test_acc, test_confusion, mode="test", lookup=lookup)
 
                     # Update wandb summary metrics
@@ -120,7 +125,9 @@ def train(
                 sampling_strategy=config.sampling_strategy,
                 sampling_value=config.sampling_value,
                 max_temperature=config.max_temperature,
-                temperature_factor=config.temperature_factor
+                temperature_factor=config.temperature_factor,
+                precision=config.precision,
+                batch_size=config.eval_batch_size
             )
             df, samples_list, recovery_list, perplexity_list, \
             scscore_list, scscore_ribonanza_list, \
@@ -164,7 +171,7 @@ def train(
             print(print_message)
 
 
-def loop(model, dataloader, loss_fn, optimizer=None, device='cpu'):
+def loop(model, dataloader, loss_fn, optimizer=None, device='cpu', precision='fp32', scaler=None):
     """
     Training loop for a single epoch over the data loader.
 
@@ -174,6 +181,8 @@ def loop(model, dataloader, loss_fn, optimizer=None, device='cpu'):
         loss_fn (nn.Module): loss function to compute the loss
         optimizer (torch.optim): optimizer to update model parameters
         device (torch.device): device to train the model on
+        precision (str): 'fp32', or 'bf16'/'fp16' for mixed precision via autocast
+        scaler (torch.amp.GradScaler): gradient scaler for fp16 training, see `grad_scaler`
     
     Note:
         This function is used for both training and evaluation loops.
@@ -196,7 +205,8 @@ def loop(model, dataloader, loss_fn, optimizer=None, device='cpu'):
         batch = batch.to(device)
         
         try:
-            logits = model(batch)
+            with autocast(device, precision):
+                logits = model(batch)
         except RuntimeError as e:
             if "CUDA out of memory" not in str(e): raise(e)
             print('Skipped batch due to OOM', flush=True)
@@ -206,13 +216,18 @@ def loop(model, dataloader, loss_fn, optimizer=None, device='cpu'):
             torch.cuda.empty_cache()
             continue
         
-        # compute loss
-        loss_value = loss_fn(logits, batch.seq)
+        # compute loss (in fp32)
+        loss_value = loss_fn(logits.float(), batch.seq)
         
         if optimizer:
             # backpropagate loss and update parameters
-            loss_value.backward()
-            optimizer.step()
+            if scaler is not None:
+                scaler.scale(loss_value).backward()
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                loss_value.backward()
+                optimizer.step()
 
         # update metrics
         num_nodes = int(batch.seq.size(0))
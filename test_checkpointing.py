@@ -0,0 +1,56 @@
+################################################################
+# Tests of activation checkpointing: losses and gradients of
+# checkpointed models match those of models keeping all
+# activations, on a demo backbone (without dropout).
+################################################################
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+import gRNAde as api
+from src.models import (
+    AutoregressiveMultiGNNv1, AutoregressiveMultiGNNv2, NonAutoregressiveMultiGNNv1
+)
+
+MODEL_CLASSES = {
+    "ARv1": (AutoregressiveMultiGNNv1, {}),
+    "ARv2": (AutoregressiveMultiGNNv2, {"attention_dropout": 0.0}),
+    "NARv1": (NonAutoregressiveMultiGNNv1, {}),
+}
+
+
+def train_model(model_type, checkpoint_every=None):
+    model_class, kwargs = MODEL_CLASSES[model_type]
+    torch.manual_seed(0)
+    return model_class(
+        node_in_dim=api.NODE_IN_DIM, node_h_dim=api.NODE_H_DIM,
+        edge_in_dim=api.EDGE_IN_DIM, edge_h_dim=api.EDGE_H_DIM,
+        num_layers=3, drop_rate=0.0, out_dim=api.OUT_DIM,
+        checkpoint_every=checkpoint_every, **kwargs
+    ).train()
+
+
+def loss_and_grads(model, data):
+    model.zero_grad()
+    loss = F.cross_entropy(model(data), data.seq)
+    loss.backward()
+    return loss.item(), {name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None}
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_CLASSES))
+@pytest.mark.parametrize("checkpoint_every", [1, 2])
+def test_checkpointing_matches_full_activations(featurized_rna, model_type, checkpoint_every):
+    loss, grads = loss_and_grads(train_model(model_type), featurized_rna)
+    loss_, grads_ = loss_and_grads(train_model(model_type, checkpoint_every), featurized_rna)
+    assert abs(loss_ - loss) <= 1e-5 * abs(loss)
+    assert grads_.keys() == grads.keys()
+    for name, grad in grads.items():
+        assert torch.allclose(grads_[name], grad, atol=1e-5), name
+
+
+def test_checkpointing_only_in_training(featurized_rna):
+    # Evaluation keeps the same outputs (no checkpointing without gradients)
+    model, model_ = train_model("ARv2").eval(), train_model("ARv2", 1).eval()
+    with torch.no_grad():
+        assert torch.equal(model_(featurized_rna), model(featurized_rna))
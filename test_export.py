@@ -0,0 +1,87 @@
+################################################################
+# Tests of the export-ready encoder and decoder step of ARv2:
+# outputs of the export modules, and of their TorchScript
+# traces, are checked against the eager model on the demo
+# backbones, with a randomly initialised model.
+################################################################
+
+import os
+
+import pytest
+import torch
+
+from conftest import demo_rna, grnade_designer, grnade_featurizer
+from src.constants import PROJECT_PATH
+from src.export import EncoderExport, DecoderStepExport, export_torchscript, teacher_forced_decode
+
+DEMO_PDB_FILEPATHS = [
+    os.path.join(PROJECT_PATH, "tutorial/demo_data", name)
+    for name in ("1ET4_1_A.pdb", "1L2X_1_A.pdb", "2GDI_1_X.pdb")
+]
+
+
+@pytest.fixture(scope="module")
+def model():
+    return grnade_designer("ARv2").model
+
+
+@pytest.fixture(scope="module")
+def demo_graphs():
+    featurizer = grnade_featurizer()
+    return [featurizer(demo_rna(pdb_filepath)) for pdb_filepath in DEMO_PDB_FILEPATHS]
+
+
+def assert_close(outputs, reference, atol):
+    for x, y in zip(outputs, reference):
+        assert x.shape == y.shape
+        assert torch.allclose(x, y, atol=atol)
+
+
+@torch.no_grad()
+def test_export_matches_eager(model, demo_graphs):
+    encoder, decoder_step = EncoderExport(model), DecoderStepExport(model)
+    for data in demo_graphs:
+        h_V, h_E = model.encode(data)
+        h_V_s, h_V_v, h_E_s, h_E_v = encoder(*EncoderExport.example_inputs(data))
+        assert_close((h_V_s, h_V_v, h_E_s, h_E_v), (*h_V, *h_E), atol=1e-4)
+
+        logits = model.decode(h_V, h_E, data.edge_index, data.seq)
+        logits_ = teacher_forced_decode(decoder_step, model, h_V, h_E, data.edge_index, data.seq)
+        assert_close((logits_,), (logits,), atol=1e-4)
+
+
+@torch.no_grad()
+def test_export_matches_eager_multi_conformer(model, rna):
+    # Pooling over conformations, with a padded (masked) conformation
+    generator = torch.Generator().manual_seed(0)
+    coords = rna['coords_list'][0]
+    rna_ = dict(rna, coords_list=[coords, coords + torch.randn(coords.shape, generator=generator)])
+    data = grnade_featurizer(max_num_conformers=3)(rna_)
+    assert not data.mask_confs.all()
+
+    h_V, h_E = model.encode(data)
+    outputs = EncoderExport(model)(*EncoderExport.example_inputs(data))
+    assert_close(outputs, (*h_V, *h_E), atol=1e-4)
+
+
+@torch.no_grad()
+def test_torchscript_export_matches_eager(model, demo_graphs, tmp_path):
+    # Traced for the first backbone, run on all of them (shapes are dynamic)
+    encoder, decoder_step = EncoderExport(model), DecoderStepExport(model)
+    data = demo_graphs[0]
+    encoder_inputs = EncoderExport.example_inputs(data)
+    h_V_s, h_V_v, h_E_s, h_E_v = encoder(*encoder_inputs)
+    step_inputs = DecoderStepExport.example_inputs(
+        model, (h_V_s, h_V_v), (h_E_s, h_E_v), data.edge_index, data.seq, data.num_nodes // 2)
+    encoder_ = export_torchscript(encoder, encoder_inputs, str(tmp_path / "encoder.pt"))
+    decoder_step_ = export_torchscript(decoder_step, step_inputs, str(tmp_path / "decoder_step.pt"))
+
+    for data in demo_graphs:
+        h_V, h_E = model.encode(data)
+        h_V_s, h_V_v, h_E_s, h_E_v = encoder_(*EncoderExport.example_inputs(data))
+        assert_close((h_V_s, h_V_v, h_E_s, h_E_v), (*h_V, *h_E), atol=1e-3)
+
+        logits = model.decode(h_V, h_E, data.edge_index, data.seq)
+        logits_ = teacher_forced_decode(
+            decoder_step_, model, (h_V_s, h_V_v), (h_E_s, h_E_v), data.edge_index, data.seq)
+        assert_close((logits_,), (logits,), atol=1e-3)
@@ -0,0 +1,196 @@
+################################################################
+# Tests of the RNA graph featurizer on the demo backbones:
+# optimized featurization paths are checked against reference
+# implementations, and the persistent cache of graphs against
+# featurization without cache.
+################################################################
+
+import glob
+import math
+import os
+
+import MDAnalysis as mda
+import numpy as np
+import torch
+
+from conftest import DEMO_PDB_FILEPATH, demo_rna, grnade_designer, grnade_featurizer
+from src.constants import FILL_VALUE, PROJECT_PATH
+from src.data.data_utils import cluster_frames, trajectory_to_tensor
+from src.data.featurizer import (
+    get_k_random_entries_and_masks, positional_encoding, posenc_frequencies,
+    rbf_centers, rbf_expansion
+)
+from src.models import edge_input_features
+
+
+def assert_graphs_equal(data, reference):
+    assert set(data.keys()) == set(reference.keys())
+    for attr in reference.keys():
+        assert torch.equal(data[attr], reference[attr]), attr
+
+
+def test_cache_hit_matches_featurization(rna, tmp_path):
+    featurizer = grnade_featurizer(cache_dir=str(tmp_path))
+    data = featurizer(rna)  # miss
+    assert os.path.exists(featurizer.cache.path(featurizer.cache.key(rna)))
+    assert_graphs_equal(featurizer(rna), data)  # hit
+    # Another featurizer (e.g. of another process) reads the same entry
+    assert_graphs_equal(grnade_featurizer(cache_dir=str(tmp_path))(rna), data)
+
+
+def test_cache_corrupt_entry_is_a_miss(rna, tmp_path):
+    featurizer = grnade_featurizer(cache_dir=str(tmp_path))
+    data = featurizer(rna)
+    path = featurizer.cache.path(featurizer.cache.key(rna))
+    with open(path, 'rb') as f:
+        entry = f.read()
+
+    for corrupt in (entry[:len(entry) // 2], b'', b'not a torch file'):
+        with open(path, 'wb') as f:
+            f.write(corrupt)
+        assert featurizer.cache.get(featurizer.cache.key(rna)) is None
+        # Featurized again and overwritten
+        assert_graphs_equal(featurizer(rna), data)
+        assert featurizer.cache.get(featurizer.cache.key(rna)) is not None
+
+
+def test_edge_confs_only_stored_when_asked(rna):
+    data = grnade_featurizer()(rna)
+    assert 'edge_confs' not in data
+    data_confs = grnade_featurizer(return_edge_confs=True)(rna)
+    assert data_confs.edge_confs.shape == (data.num_edges, 1)
+    assert bool(data_confs.edge_confs.all())
+    assert torch.equal(data_confs.edge_index, data.edge_index)
+
+
+def two_conformer_rna(rna):
+    generator = torch.Generator().manual_seed(0)
+    coords = torch.as_tensor(rna['coords_list'][0])
+    return dict(rna, coords_list=[coords, coords + torch.randn(coords.shape, generator=generator)])
+
+
+def reference_edge_s(featurizer, coords_list, data):
+    # Edge scalar features of the original featurizer: RBF features, 
+    # positional encodings repeated per conformer and log edge lengths,
+    # with RBF centers and frequencies recomputed for each graph
+    coords = torch.as_tensor(coords_list, dtype=torch.float32)[:, data.mask_coords].permute(1, 0, 2, 3)
+    src, dst = data.edge_index
+    edge_vectors = coords[src] - coords[dst]
+    edge_lengths = torch.sqrt((edge_vectors ** 2).sum(dim=-1) + featurizer.distance_eps)
+    centers = torch.linspace(0.0, 30.0, featurizer.num_rbf)
+    std = (centers[1] - centers[0]).item()
+    edge_rbf = torch.exp(-(((edge_lengths.unsqueeze(-1) - centers) / std) ** 2)).flatten(start_dim=2)
+    p = torch.logspace(0.0, 3.0, featurizer.num_posenc // 2, base=10.0)
+    h = (2 * math.pi / p) * (src - dst)[:, None]
+    edge_posenc = torch.cat([h.cos(), h.sin()], dim=-1).unsqueeze(1).repeat(1, coords.shape[1], 1)
+    edge_s = torch.cat([edge_rbf, edge_posenc, torch.log(edge_lengths)], dim=-1)
+    return torch.nan_to_num(edge_s)
+
+
+def test_precomputed_tables_match_recomputed():
+    generator = torch.Generator().manual_seed(0)
+    h = 30 * torch.rand(50, 2, 3, generator=generator)
+    assert torch.equal(
+        rbf_expansion(h, num_rbf=16, centers=rbf_centers(num_rbf=16)), rbf_expansion(h, num_rbf=16))
+    offsets = torch.randint(-200, 200, (50, 1), generator=generator)
+    assert torch.equal(
+        positional_encoding(offsets, 32, frequencies=posenc_frequencies(32)), positional_encoding(offsets, 32))
+
+
+def test_edge_input_features_match_original_layout(rna):
+    featurizer = grnade_featurizer(max_num_conformers=2)
+    coords_list, mask_coords, mask_confs = get_k_random_entries_and_masks(
+        two_conformer_rna(rna)['coords_list'], k=2, rng=np.random.default_rng(0))
+    data = featurizer._featurize(rna['sequence'], coords_list, mask_coords, mask_confs)
+    assert data.edge_posenc.shape == (data.num_edges, featurizer.num_posenc)
+
+    edge_s, edge_v = edge_input_features(data.edge_s, data.edge_v, data.edge_posenc)
+    edge_s_ = reference_edge_s(featurizer, coords_list, data)
+    assert edge_s.shape == edge_s_.shape
+    assert torch.allclose(edge_s, edge_s_, atol=1e-5)
+    assert edge_v is data.edge_v
+
+    # Graphs with positional encodings in edge_s (without edge_posenc) 
+    # have the same outputs
+    data_ = data.clone()
+    data_.edge_s = edge_s_
+    del data_.edge_posenc
+    model = grnade_designer("ARv2").model
+    with torch.no_grad():
+        assert torch.allclose(model(data_), model(data), atol=1e-4)
+
+
+def test_featurize_many_matches_serial_featurization():
+    # Without noise or conformer sampling, graphs featurized in worker 
+    # processes and batched match graphs featurized one by one
+    pdb_filepaths = sorted(glob.glob(os.path.join(PROJECT_PATH, "tutorial/demo_data/*.pdb")))[:4]
+    inputs = [demo_rna(pdb_filepath) for pdb_filepath in pdb_filepaths]
+    featurizer = grnade_featurizer()
+    reference = [featurizer(rna) for rna in inputs]
+
+    for n_workers in (0, 2):
+        batch, raw_data_list = featurizer.featurize_many(inputs, n_workers=n_workers, return_raw=True)
+        assert [raw['sequence'] for raw in raw_data_list] == [rna['sequence'] for rna in inputs]
+        assert batch.num_graphs == len(reference)
+        for data, data_ in zip(batch.to_data_list(), reference):
+            assert_graphs_equal(data, data_)
+
+    # Batches of consecutive graphs within a node budget
+    max_nodes = max(data.num_nodes for data in reference) + 1
+    batches = list(featurizer.featurize_many(inputs, n_workers=2, max_nodes=max_nodes))
+    assert all(batch.num_nodes <= max_nodes for batch in batches)
+    data_list = [data for batch in batches for data in batch.to_data_list()]
+    assert len(data_list) == len(reference)
+    for data, data_ in zip(data_list, reference):
+        assert_graphs_equal(data, data_)
+
+
+def centered(coords):
+    mask = (coords != FILL_VALUE).all(dim=-1)
+    return torch.where(mask[..., None], coords - coords[mask].mean(dim=0), coords)
+
+
+def write_trajectory(filepath, pdb_filepath, n_groups=3, n_frames_per_group=4, seed=0):
+    # Synthetic trajectory of groups of similar conformations (small noise
+    # around a perturbation of the structure per group), each frame rigidly
+    # rotated and translated
+    generator = np.random.default_rng(seed)
+    universe = mda.Universe(pdb_filepath)
+    reference = universe.atoms.positions.copy()
+    with mda.Writer(filepath, universe.atoms.n_atoms) as writer:
+        for _ in range(n_groups):
+            group = reference + generator.normal(scale=3.0, size=reference.shape)
+            for _ in range(n_frames_per_group):
+                rotation = np.linalg.qr(generator.normal(size=(3, 3)))[0]
+                rotation *= np.sign(np.linalg.det(rotation))
+                frame = group + generator.normal(scale=0.1, size=reference.shape)
+                universe.atoms.positions = frame @ rotation.T + generator.normal(scale=10.0, size=3)
+                writer.write(universe.atoms)
+
+
+def test_trajectory_to_tensor_matches_pdb_parsing(rna):
+    sequence, coords = trajectory_to_tensor(DEMO_PDB_FILEPATH)
+    assert sequence == rna['sequence']
+    assert coords.shape == (1, len(sequence), 3, 3)
+    assert torch.allclose(centered(coords[0]), centered(torch.as_tensor(rna['coords_list'][0])), atol=1e-3)
+
+
+def test_trajectory_frames_and_clusters(rna, tmp_path):
+    trajectory_filepath = str(tmp_path / "traj.xtc")
+    write_trajectory(trajectory_filepath, DEMO_PDB_FILEPATH)
+    sequence, coords = trajectory_to_tensor(DEMO_PDB_FILEPATH, trajectory_filepath)
+    assert sequence == rna['sequence']
+    assert coords.shape == (12, len(sequence), 3, 3)
+    _, coords_ = trajectory_to_tensor(DEMO_PDB_FILEPATH, trajectory_filepath, start=1, stop=10, stride=3)
+    assert torch.equal(coords_, coords[1:10:3])
+
+    # One representative frame per group, whatever the rigid motion of frames
+    frames = cluster_frames(coords, 3)
+    assert sorted((frames // 4).tolist()) == [0, 1, 2]
+    assert torch.equal(cluster_frames(coords, 12), torch.arange(12))
+
+    featurizer = grnade_featurizer(max_num_conformers=3)
+    data, rna_ = featurizer.featurize_from_trajectory(
+        DEMO_PDB_FILEPATH, trajectory_filepath, n_clusters=3, sec_struct=rna['sec_struct_list'][0])
+    assert len(rna_['coords_list']) == 3
+    assert data.node_s.shape[1] == 3
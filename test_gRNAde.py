@@ -0,0 +1,45 @@
+################################################################
+# Tests of the gRNAde design API on a demo backbone, with
+# randomly initialised models and a stub self consistency
+# score (EternaFold is not needed).
+################################################################
+
+import gRNAde as api
+from conftest import grnade_designer
+
+
+def stub_sc_score(samples, sec_struct_list, mask_coords):
+    return [float(sample.sum()) for sample in samples]
+
+
+def test_design_iter_drained_scores_resolve(rna, monkeypatch):
+    # All designs yielded by a drained iterator keep their self
+    # consistency score, including those of the last chunk
+    monkeypatch.setattr(api, "self_consistency_score_eternafold", stub_sc_score)
+    designer = grnade_designer()
+    designs = list(designer.design_iter(dict(rna), n_samples=6, chunk_size=4, n_workers=2))
+
+    assert [design["idx"] for design in designs] == list(range(6))
+    for design in designs:
+        assert not design["sc_score"].cancelled()
+        assert design["sc_score"].result(timeout=60) == float(design["sample"].sum())
+
+
+def test_design_iter_early_stop(rna, monkeypatch):
+    # Stopping early keeps the scores of yielded designs
+    monkeypatch.setattr(api, "self_consistency_score_eternafold", stub_sc_score)
+    designer = grnade_designer()
+    designs = designer.design_iter(dict(rna), n_samples=8, chunk_size=4, n_workers=1)
+    first = next(designs)
+    designs.close()
+
+    assert first["sc_score"].result(timeout=60) == float(first["sample"].sum())
+
+
+def test_encoder_cache_key_skips_missing_attributes(featurized_rna):
+    cache = api.EncoderCache(2, "checkpoint.h5")
+    data = featurized_rna.clone()
+    key = cache.key(data)
+    assert cache.key(featurized_rna.clone()) == key
+    del data.edge_posenc
+    assert cache.key(data) != key
@@ -0,0 +1,147 @@
+################################################################
+# Tests of the attention layers: block, chunked, edge and
+# conformer-batched attention are checked against dense
+# attention with an explicit additive mask, on random graphs.
+################################################################
+
+import pytest
+import torch
+
+from src.layers import GraphAttentionLayer, MultiAttentiveGVPLayer, graph_blocks
+
+GRAPH_SIZES = [7, 12, 3, 11]
+
+
+def random_nodes(n_nodes, dims=(16, 4), seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return (torch.randn(n_nodes, dims[0], generator=generator),
+            torch.randn(n_nodes, dims[1], 3, generator=generator))
+
+
+def attention_layer(dims=(16, 4), **kwargs):
+    torch.manual_seed(0)
+    return GraphAttentionLayer(*dims, n_heads=4, **kwargs).eval()
+
+
+def node_batch(sizes):
+    return torch.repeat_interleave(torch.arange(len(sizes)), torch.tensor(sizes))
+
+
+def same_graph_mask(batch):
+    # Additive mask of keys outside the graph of each query
+    return (batch.unsqueeze(1) != batch.unsqueeze(0)).float() * -1e9
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("causal", [False, True])
+def test_block_attention_matches_dense(causal):
+    batch = node_batch(GRAPH_SIZES)
+    x = random_nodes(batch.size(0))
+    layer = attention_layer()
+    blocks = graph_blocks(batch)
+    assert len(blocks) > 1
+    out, v = layer(x, blocks=blocks, causal=causal)
+    out_, _ = layer(x, mask=same_graph_mask(batch), causal=causal)
+    assert torch.allclose(out, out_, atol=1e-5)
+    assert v is x[1]
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("causal", [False, True])
+@pytest.mark.parametrize("chunk_size", [1, 5, 64])
+def test_chunked_attention_matches_dense(causal, chunk_size):
+    batch = node_batch(GRAPH_SIZES)
+    x = random_nodes(batch.size(0))
+    dense, chunked = attention_layer(), attention_layer(chunk_size=chunk_size)
+    mask = same_graph_mask(batch)
+    for kwargs in ({}, {"mask": mask}, {"blocks": graph_blocks(batch)}):
+        out, _ = chunked(x, causal=causal, **kwargs)
+        out_, _ = dense(x, causal=causal, **kwargs)
+        assert torch.allclose(out, out_, atol=1e-5)
+
+
+def random_graph(sizes, k=4, seed=0):
+    # Random edges between nodes of the same graph, without duplicates
+    generator = torch.Generator().manual_seed(seed)
+    batch = node_batch(sizes)
+    adjacency = torch.rand(batch.size(0), batch.size(0), generator=generator) < k / max(sizes)
+    adjacency &= batch.unsqueeze(1) == batch.unsqueeze(0)
+    adjacency.fill_diagonal_(False)
+    return batch, adjacency.nonzero().t()
+
+
+def reference_conformer_attention(layer, s, v, edge_index, batch, mask_confs):
+    # Attention over the valid nodes of each conformation separately, 
+    # with dense masked attention (or edge attention over the edges
+    # between valid nodes)
+    attn_s = torch.zeros_like(s)
+    for conf in range(s.size(1)):
+        kept = mask_confs[:, conf]
+        x_conf = (s[kept, conf], v[kept, conf])
+        if layer.attention.mode == 'edge':
+            local = torch.cumsum(kept.long(), dim=0) - 1
+            edges = edge_index[:, kept[edge_index].all(dim=0)]
+            attn_s[kept, conf] = layer.attention(x_conf, edge_index=local[edges])[0]
+        else:
+            attn_s[kept, conf] = layer.attention(x_conf, mask=same_graph_mask(batch[kept]))[0]
+    return attn_s
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("attention_mode", ["dense", "edge"])
+def test_conformer_batched_attention_matches_per_conformer(attention_mode):
+    n_conf, dims, edge_dims = 3, (16, 4), (8, 2)
+    batch, edge_index = random_graph(GRAPH_SIZES)
+    n_nodes, n_edges = batch.size(0), edge_index.size(1)
+    generator = torch.Generator().manual_seed(1)
+    s = torch.randn(n_nodes, n_conf, dims[0], generator=generator)
+    v = torch.randn(n_nodes, n_conf, dims[1], 3, generator=generator)
+    edge_attr = (torch.randn(n_edges, n_conf, edge_dims[0], generator=generator),
+                 torch.randn(n_edges, n_conf, edge_dims[1], 3, generator=generator))
+    # Graphs with padded conformations
+    mask_confs = torch.ones(n_nodes, n_conf, dtype=torch.bool)
+    mask_confs[batch == 1, 2] = False
+    mask_confs[batch == 3, 1:] = False
+
+    torch.manual_seed(0)
+    layer = MultiAttentiveGVPLayer(dims, edge_dims, attention_mode=attention_mode).eval()
+    out_s, out_v = layer((s, v), edge_index, edge_attr, batch=batch, mask_confs=mask_confs)
+
+    conv_s, conv_v = layer.conv((s, v), edge_index, edge_attr)
+    attn_s = reference_conformer_attention(layer, s, v, edge_index, batch, mask_confs)
+    out_s_, out_v_ = layer.norm((s + 0.5 * conv_s + 0.5 * attn_s, v + conv_v))
+    assert torch.allclose(out_s, out_s_, atol=1e-5)
+    assert torch.allclose(out_v, out_v_, atol=1e-5)
+
+
+def adjacency_mask(edge_index, n_nodes):
+    # Additive mask of keys that are neither incoming edges nor the query itself
+    mask = torch.full((n_nodes, n_nodes), -1e9)
+    mask[edge_index[1], edge_index[0]] = 0
+    return mask.fill_diagonal_(0)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("causal", [False, True])
+def test_edge_attention_matches_dense(causal):
+    batch, edge_index = random_graph(GRAPH_SIZES)
+    n_nodes = batch.size(0)
+    x = random_nodes(n_nodes)
+    edge_layer, dense = attention_layer(mode='edge'), attention_layer()
+    out, v = edge_layer(x, causal=causal, edge_index=edge_index)
+    out_, _ = dense(x, mask=adjacency_mask(edge_index, n_nodes), causal=causal)
+    assert torch.allclose(out, out_, atol=1e-5)
+    assert v is x[1]
+
+
+@torch.no_grad()
+def test_edge_decode_step_matches_causal_edge_attention():
+    batch, edge_index = random_graph(GRAPH_SIZES)
+    x = random_nodes(batch.size(0))
+    layer = attention_layer(mode='edge')
+    out, _ = layer(x, causal=True, edge_index=edge_index)
+    for start in range(3):
+        node_mask = torch.arange(start, batch.size(0), 3)
+        incoming = edge_index[:, torch.isin(edge_index[1], node_mask)]
+        out_step, _ = layer.edge_decode_step(x, incoming, node_mask)
+        assert torch.allclose(out_step, out[node_mask], atol=1e-5)
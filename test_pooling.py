@@ -0,0 +1,88 @@
+################################################################
+# Tests of tensor moment pooling of ARv2: pooling without
+# materializing moments is checked against the first layer of
+# psi applied to explicitly concatenated outer-product moments.
+################################################################
+
+import pytest
+import torch
+
+from src.models import AutoregressiveMultiGNNv2, low_rank_moment_pooling
+
+NODE_H_DIM = (16, 4)
+
+
+def small_model(**kwargs):
+    torch.manual_seed(0)
+    return AutoregressiveMultiGNNv2(
+        node_h_dim=NODE_H_DIM, num_layers=1, drop_rate=0.0, attention_dropout=0.0, **kwargs
+    ).eval()
+
+
+def masked_features(n_nodes=30, n_conf=4, seed=0):
+    # Node scalar features with padded (zeroed) conformations
+    generator = torch.Generator().manual_seed(seed)
+    X = torch.randn(n_nodes, n_conf, NODE_H_DIM[0], generator=generator)
+    mask_confs = torch.ones(n_nodes, n_conf, dtype=torch.bool)
+    mask_confs[n_nodes // 2:, 2:] = False
+    X = X * mask_confs.unsqueeze(2)
+    return X, mask_confs.sum(1, keepdim=True)
+
+
+def reference_moments(X, n_conf_true, moment_proj=None):
+    # Mean and mean outer product X_i ⊗ X_i over conformations (of
+    # projected features, if given), concatenated
+    Z = X if moment_proj is None else moment_proj(X)
+    outer = (Z.unsqueeze(3) * Z.unsqueeze(2)).sum(dim=1).flatten(start_dim=1)
+    return torch.cat([X.sum(dim=1) / n_conf_true, outer / n_conf_true], dim=-1)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("moment_rank", [None, 5])
+@pytest.mark.parametrize("chunk_size", [None, 7, 256])
+def test_moment_pooling_matches_outer_products(moment_rank, chunk_size):
+    model = small_model(moment_rank=moment_rank)
+    X, n_conf_true = masked_features()
+    out = model.moment_pooling(X, n_conf_true, chunk_size=chunk_size)
+    moment_proj = model.moment_proj if moment_rank is not None else None
+    out_ = model.psi[0](reference_moments(X, n_conf_true, moment_proj))
+    assert torch.allclose(out, out_, atol=1e-4)
+
+
+@torch.no_grad()
+def test_low_rank_moment_pooling_full_rank_is_exact():
+    d = NODE_H_DIM[0]
+    model = small_model()
+    state_dict, residual = low_rank_moment_pooling(model.state_dict(), d, d)
+    assert residual < 1e-6
+    low_rank_model = small_model(moment_rank=d)
+    low_rank_model.load_state_dict(state_dict)
+
+    X, n_conf_true = masked_features()
+    out = low_rank_model.moment_pooling(X, n_conf_true)
+    assert torch.allclose(out, model.moment_pooling(X, n_conf_true), atol=1e-4)
+
+
+@torch.no_grad()
+def test_low_rank_moment_pooling_residual():
+    # Residual of a truncation to fewer dimensions than the row space of
+    # the quadratic forms is positive, and 0 for rank-deficient forms
+    d, rank = NODE_H_DIM[0], 5
+    model = small_model()
+    state_dict = model.state_dict()
+    assert low_rank_moment_pooling(state_dict, rank, d)[1] > 0
+
+    weight = state_dict['psi.0.weight'].clone()
+    P = torch.linalg.qr(torch.randn(d, rank))[0]  # orthonormal basis [d, rank]
+    A = weight[:, d:d + d**2].view(-1, d, d)
+    weight[:, d:d + d**2] = (P @ P.t() @ A @ P @ P.t()).flatten(start_dim=1)
+    state_dict = dict(state_dict, **{'psi.0.weight': weight})
+    state_dict_, residual = low_rank_moment_pooling(state_dict, rank, d)
+    assert residual < 1e-5
+
+    low_rank_model = small_model(moment_rank=rank)
+    low_rank_model.load_state_dict(state_dict_)
+    model.load_state_dict(state_dict)
+    X, n_conf_true = masked_features()
+    out = low_rank_model.moment_pooling(X, n_conf_true)
+    assert torch.allclose(out, model.moment_pooling(X, n_conf_true), atol=1e-4)
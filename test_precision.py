@@ -0,0 +1,134 @@
+################################################################
+# Tests of mixed precision and INT8 quantization: outputs of
+# reduced precision models are compared to fp32 on the demo
+# backbones, with randomly initialised models.
+################################################################
+
+import glob
+import os
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from conftest import demo_rna, grnade_designer, grnade_featurizer
+from src.constants import PROJECT_PATH
+from src.layers import MultiGVPConv, gvp_message_passing, split_linear
+from src.precision import autocast, grad_scaler, quantize_linear_layers, quantized_fraction
+
+DEMO_PDB_FILEPATHS = sorted(glob.glob(os.path.join(PROJECT_PATH, "tutorial/demo_data/*.pdb")))
+
+
+@pytest.fixture(scope="module")
+def demo_graphs():
+    featurizer = grnade_featurizer()
+    return [featurizer(demo_rna(pdb_filepath)) for pdb_filepath in DEMO_PDB_FILEPATHS]
+
+
+def native_perplexity(logits, seq):
+    return torch.exp(F.cross_entropy(logits.float(), seq)).item()
+
+
+@torch.no_grad()
+def test_bf16_parity(demo_graphs):
+    # Teacher-forced probabilities and native sequence perplexity
+    # in bf16 autocast match fp32 (tolerances of the benchmark
+    # benchmarks/mixed_precision_parity.py)
+    model = grnade_designer().model
+    for data in demo_graphs:
+        logits = model(data)
+        with autocast("cpu", "bf16"):
+            logits_bf16 = model(data)
+
+        probs, probs_bf16 = logits.softmax(dim=-1), logits_bf16.float().softmax(dim=-1)
+        assert torch.allclose(probs_bf16, probs, atol=0.05)
+        perplexity = native_perplexity(logits, data.seq)
+        perplexity_bf16 = native_perplexity(logits_bf16, data.seq)
+        assert abs(perplexity_bf16 - perplexity) / perplexity <= 0.05
+
+
+def test_fp32_autocast_is_noop():
+    with autocast("cpu", "fp32"):
+        assert not torch.is_autocast_cpu_enabled()
+    with pytest.raises(ValueError):
+        autocast("cpu", "fp8")
+
+
+def test_grad_scaler_only_enabled_for_fp16_on_gpu():
+    assert not grad_scaler("cpu", "fp16").is_enabled()
+    assert not grad_scaler("cpu", "bf16").is_enabled()
+
+
+@torch.no_grad()
+def test_split_linear_blocks_match_fused_message_passing():
+    # Messages computed with the first message GVP split into separate
+    # block modules match messages computed by slicing its weights
+    torch.manual_seed(0)
+    n_nodes, n_edges, n_conf = 20, 60, 3
+    conv = MultiGVPConv((16, 4), (16, 4), (8, 2), aggr="mean", edge_chunk_size=16)
+    x = (torch.randn(n_nodes, n_conf, 16), torch.randn(n_nodes, n_conf, 4, 3))
+    edge_attr = (torch.randn(n_edges, n_conf, 8), torch.randn(n_edges, n_conf, 2, 3))
+    edge_index = torch.randint(0, n_nodes, (2, n_edges))
+
+    out_s, out_v = gvp_message_passing(conv.message_func, x, edge_index, edge_attr, aggr="mean")
+    conv.split_linear_blocks()
+    assert hasattr(conv.message_func[0], "ws_blocks")
+    split_s, split_v = conv(x, edge_index, edge_attr)
+    assert torch.allclose(split_s, out_s, atol=1e-5)
+    assert torch.allclose(split_v, out_v, atol=1e-5)
+
+    # Fewer edges than nodes (blocks applied per edge, as when decoding)
+    edge_index_, edge_attr_ = edge_index[:, :5], (edge_attr[0][:5], edge_attr[1][:5])
+    del conv.message_func[0].ws_blocks, conv.message_func[0].wh_blocks
+    out_s, out_v = conv(x, edge_index_, edge_attr_)
+    conv.split_linear_blocks()
+    split_s, split_v = conv(x, edge_index_, edge_attr_)
+    assert torch.allclose(split_s, out_s, atol=1e-5)
+    assert torch.allclose(split_v, out_v, atol=1e-5)
+
+
+@torch.no_grad()
+def test_split_linear_sums_to_linear():
+    torch.manual_seed(0)
+    linear = torch.nn.Linear(10, 6)
+    blocks = split_linear(linear, [3, 7], bias_block=1)
+    x = torch.randn(4, 10)
+    out = blocks[0](x[:, :3]) + blocks[1](x[:, 3:])
+    assert blocks[0].bias is None
+    assert torch.allclose(out, linear(x), atol=1e-6)
+
+
+@torch.no_grad()
+def test_split_moment_blocks_match_fused_pooling():
+    torch.manual_seed(0)
+    model = grnade_designer().model
+    X = torch.randn(30, 3, model.node_h_dim[0])
+    n_conf_true = torch.full((30, 1), 3.0)
+    out = model.moment_pooling(X, n_conf_true, chunk_size=8)
+    model.split_linear_blocks()
+    assert torch.allclose(model.moment_pooling(X, n_conf_true, chunk_size=8), out, atol=1e-4)
+
+
+@torch.no_grad()
+def test_quantized_model_tolerance(demo_graphs):
+    # INT8 dynamic quantization keeps the native sequence perplexity and
+    # the recovery of greedy (teacher-forced) predictions of the model
+    # within tolerances of fp32 (those of the benchmark 
+    # benchmarks/quantization_regression.py for perplexity; predictions
+    # of randomly initialised models are close to uniform, so that ties
+    # flip more often and recovery is given a looser tolerance)
+    model = grnade_designer().model
+    quantized_model = quantize_linear_layers(model)
+    assert quantized_fraction(quantized_model) == 1.0
+    assert quantized_fraction(model) == 0.0
+
+    perplexity_deltas, recovery_deltas = [], []
+    for data in demo_graphs:
+        logits, logits_int8 = model(data), quantized_model(data)
+        perplexity = native_perplexity(logits, data.seq)
+        perplexity_deltas.append((native_perplexity(logits_int8, data.seq) - perplexity) / perplexity)
+        recovery = logits.argmax(dim=-1).eq(data.seq).float().mean().item()
+        recovery_deltas.append(logits_int8.argmax(dim=-1).eq(data.seq).float().mean().item() - recovery)
+
+    assert abs(sum(perplexity_deltas) / len(perplexity_deltas)) <= 0.05
+    assert abs(sum(recovery_deltas) / len(recovery_deltas)) <= 0.05
@@ -0,0 +1,132 @@
+################################################################
+# Tests of sampling from the autoregressive models: optimized
+# decoding paths are checked against reference implementations
+# on a demo backbone, with randomly initialised models.
+################################################################
+
+import torch
+
+from conftest import grnade_designer
+from src.constants import NUM_TO_LETTER
+from src.sampling import BeamSearch, ForbiddenSequenceAutomaton, speculative_sample
+
+
+@torch.no_grad()
+def test_speculative_sample_clamps_temperatures(featurized_rna):
+    # Temperatures above max_temperature are clamped as in model.sample
+    model = grnade_designer("ARv2").model
+    draft_model = grnade_designer("NARv1", seed=1).model
+    outputs = []
+    for temperature in (0.5, 5.0):
+        torch.manual_seed(0)
+        outputs.append(speculative_sample(
+            model, draft_model, featurized_rna, 4, temperature,
+            return_logits=True, max_temperature=0.5
+        ))
+    assert torch.equal(outputs[0][0], outputs[1][0])
+    assert torch.allclose(outputs[0][1], outputs[1][1])
+
+
+@torch.no_grad()
+def test_kv_cache_sample_matches_teacher_forcing(featurized_rna):
+    # Logits of incremental decoding (with and without key/value caches)
+    # match the teacher-forced decoder on the sampled sequences
+    model = grnade_designer("ARv2").model
+    outputs = {}
+    for use_kv_cache in (True, False):
+        torch.manual_seed(0)
+        outputs[use_kv_cache] = model.sample(
+            featurized_rna, 4, temperature=0.5, return_logits=True,
+            beam_width=1, beam_branch=1, use_kv_cache=use_kv_cache
+        )
+    seqs, logits = outputs[True]
+    assert torch.equal(seqs, outputs[False][0])
+    assert torch.allclose(logits, outputs[False][1], atol=1e-4)
+
+    h_V, h_E = model.encode(featurized_rna)
+    for seq, lgts in zip(seqs, logits):
+        logits_ = model.decode(h_V, h_E, featurized_rna.edge_index, seq.long())
+        assert torch.allclose(lgts, logits_, atol=1e-4)
+
+
+def reference_beam_search(steps, n_samples, beam_width):
+    # Beam loop of the original ARv2.sample, on given candidate tokens,
+    # token scores and logits per step
+    n_copies, out_dim = beam_width * n_samples, steps[0][2].size(1)
+    scores = torch.zeros(n_copies)
+    seq = torch.zeros(n_copies, len(steps), dtype=torch.int)
+    logits = torch.zeros(n_copies, len(steps), out_dim)
+    for i, (top_tokens, token_scores, lgts) in enumerate(steps):
+        beam_branch = top_tokens.size(1)
+        new_beam_scores = scores.repeat(beam_branch, 1) + token_scores.gather(1, top_tokens).T
+        sorted_scores, sorted_indices = torch.sort(new_beam_scores, dim=0, descending=True)
+        seq[:, i] = torch.gather(top_tokens.T, 0, sorted_indices)[0]
+        logits[:, i] = lgts
+        scores = sorted_scores[0]
+    _, sorted_indices = torch.sort(scores.view(beam_width, -1), dim=0, descending=True)
+    copy = sorted_indices[0] * n_samples + torch.arange(n_samples)
+    return seq[copy], logits[copy]
+
+
+def test_beam_search_matches_reference():
+    generator = torch.Generator().manual_seed(0)
+    n_samples, beam_width, beam_branch, num_nodes, out_dim = 5, 3, 2, 12, 4
+    n_copies = beam_width * n_samples
+    steps = [(
+        torch.randint(0, out_dim, (n_copies, beam_branch), generator=generator),
+        torch.rand(n_copies, out_dim, generator=generator).softmax(dim=-1),
+        torch.randn(n_copies, out_dim, generator=generator),
+    ) for _ in range(num_nodes)]
+
+    beam = BeamSearch(n_samples, beam_width, beam_branch, num_nodes, out_dim, torch.device("cpu"))
+    for i, (top_tokens, token_scores, lgts) in enumerate(steps):
+        beam.step(i, top_tokens, token_scores, lgts)
+    seq, logits = beam.finalize()
+    seq_, logits_ = reference_beam_search(steps, n_samples, beam_width)
+    assert torch.equal(seq, seq_)
+    assert torch.equal(logits, logits_)
+
+
+def test_forbidden_sequence_automaton_matches_substring_check():
+    # A token is masked iff appending it completes a sequence to avoid
+    generator = torch.Generator().manual_seed(0)
+    avoid_sequences = ["GGG", "AUA", "CU", "UAUAU", "C"]
+    automaton = ForbiddenSequenceAutomaton(avoid_sequences, 4, torch.device("cpu"))
+    n_copies, num_nodes = 16, 12
+    tokens = torch.randint(0, 4, (n_copies, num_nodes), generator=generator)
+    states = automaton.init_states(n_copies)
+    for i in range(num_nodes):
+        banned = automaton.mask_logits(torch.zeros(n_copies, 4), states).isinf()
+        for copy in range(n_copies):
+            prefix = "".join(NUM_TO_LETTER[t] for t in tokens[copy, :i].tolist())
+            expected = [any((prefix + NUM_TO_LETTER[t]).endswith(s) for s in avoid_sequences)
+                        for t in range(4)]
+            assert banned[copy].tolist() == expected
+        states = automaton.step(states, tokens[:, i])
+
+
+@torch.no_grad()
+def test_sample_avoids_sequences(featurized_rna):
+    model = grnade_designer("ARv2").model
+    avoid_sequences = ["AA", "GUG"]
+    torch.manual_seed(0)
+    seqs = model.sample(featurized_rna, 8, temperature=0.5, avoid_sequences=avoid_sequences)
+    for seq in seqs:
+        seq = "".join(NUM_TO_LETTER[t] for t in seq.tolist())
+        assert not any(s in seq for s in avoid_sequences)
+
+
+@torch.no_grad()
+def test_share_prefixes_matches_independent_copies(featurized_rna):
+    # Sharing decoder states of copies with identical prefixes does not
+    # change designed sequences or logits (low temperature, so that
+    # many prefixes are shared)
+    model = grnade_designer("ARv2").model
+    outputs = {}
+    for share_prefixes in (True, False):
+        torch.manual_seed(0)
+        outputs[share_prefixes] = model.sample(
+            featurized_rna, 8, temperature=0.1, return_logits=True, share_prefixes=share_prefixes
+        )
+    assert torch.equal(outputs[True][0], outputs[False][0])
+    assert torch.allclose(outputs[True][1], outputs[False][1], atol=1e-5)